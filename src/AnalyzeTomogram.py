@@ -1,12 +1,155 @@
-def analyze_tomogram(tomogram, labeler, features_extractor, candidate_selector, tilt_finder, set_labels=False):
-    candidates = candidate_selector.select(tomogram)
-    feature_vectors = []
-    labels = []
+import numpy as np
 
-    for candidate in candidates:
-        feature_vectors.append(features_extractor.extract_features(tomogram, candidate))
+from CommonDataTypes import CandidateTable
+import Profiling
+import Observers
+
+# The outputs the stages produce
+CANDIDATES = 'candidates'
+FEATURES = 'features'
+LABELS = 'labels'
+TILTS = 'tilts'
+ALL_OUTPUTS = (CANDIDATES, FEATURES, LABELS, TILTS)
+
+# What each caller needs
+TRAIN_OUTPUTS = (FEATURES, LABELS)
+EVAL_OUTPUTS = (LABELS, TILTS)
+
+DEFAULT_BATCH_SIZE = 64
+
+# The Profiling timer of each stage
+STAGE_TIMERS = {CANDIDATES: Profiling.CANDIDATE_SELECTION, FEATURES: Profiling.FEATURE_EXTRACTION,
+                LABELS: Profiling.LABELING, TILTS: Profiling.TILT_FINDING}
+
+
+class Stage:
+    """
+    A node of the analysis graph. It produces a single output and declares the outputs it needs.
+    Stages other than the candidate selection run over batches of candidates.
+    """
+    def __init__(self, output, requires, run):
+        self.output = output        # the output name
+        self.requires = requires    # tuple of output names
+        self.run = run              # function(tomogram, candidates, results) -> list of results for the candidates
+
+
+def build_stages(labeler, features_extractor, candidate_selector, tilt_finder, set_labels, observers=()):
+    def select(tomogram, candidates, results):
+        return candidate_selector.select(tomogram, observers)
+
+    def extract(tomogram, candidates, results):
+        return [features_extractor.extract_features(tomogram, candidate) for candidate in candidates]
+
+    def label(tomogram, candidates, results):
         # this sets each candidate's label
-        labels.append(labeler.label(candidate, set_label=set_labels))
-        tilt_finder.find_best_tilt(tomogram, candidate)
+        labels = [labeler.label(candidate, set_label=set_labels) for candidate in candidates]
+        Observers.notify(observers, 'labels_assigned', candidates, labels)
+        return labels
+
+    def find_tilts(tomogram, candidates, results):
+        for candidate in candidates:
+            tilt_finder.find_best_tilt(tomogram, candidate)
+        return [candidate.six_position.tilt_id for candidate in candidates]
+
+    # Labelers which classify by the features need them computed first
+    label_requires = (CANDIDATES, FEATURES) if getattr(labeler, 'needs_features', False) else (CANDIDATES,)
+    return {CANDIDATES: Stage(CANDIDATES, (), select),
+            FEATURES: Stage(FEATURES, (CANDIDATES,), extract),
+            LABELS: Stage(LABELS, label_requires, label),
+            TILTS: Stage(TILTS, (CANDIDATES, LABELS), find_tilts)}
+
+
+def resolve_stages(stages, outputs):
+    """
+    Find the stages needed for the outputs, in an order where every stage comes after the stages it requires.
+    :param stages: Dictionary of output name to Stage.
+    :param outputs: The requested output names.
+    :return: List of stages.
+    """
+    ordered = []
+
+    def visit(output):
+        stage = stages[output]
+        if stage in ordered:
+            return
+        for required in stage.requires:
+            visit(required)
+        ordered.append(stage)
+
+    for output in outputs:
+        visit(output)
+    return ordered
+
+
+def run_stages(tomogram, labeler, features_extractor, candidate_selector, tilt_finder, set_labels=False,
+               outputs=ALL_OUTPUTS, batch_size=DEFAULT_BATCH_SIZE, observers=()):
+    """
+    Run only the analysis stages needed for the requested outputs.
+    :param tomogram: The tomogram to analyze.
+    :param labeler: The labeler of the candidates.
+    :param features_extractor: The features extractor.
+    :param candidate_selector: The candidate selector.
+    :param tilt_finder: The tilt finder.
+    :param set_labels: Bool indicating whether the labeler should set the labels on the candidates.
+    :param outputs: The outputs needed by the caller, from ALL_OUTPUTS.
+    :param batch_size: Number of candidates each batched stage processes at a time.
+    :param observers: Observers receiving the events of the analysis, see Observers.Observer. Stages are named as
+    their Profiling timers.
+    :return: A tuple of the candidates and a dictionary of output name to the list of results per candidate.
+    """
+    stages = resolve_stages(build_stages(labeler, features_extractor, candidate_selector, tilt_finder, set_labels,
+                                         observers), outputs)
+
+    Profiling.begin_tomogram()
+    with Profiling.timer(STAGE_TIMERS[stages[0].output]), Observers.stage(observers, STAGE_TIMERS[stages[0].output]):
+        candidates = stages[0].run(tomogram, None, None)
+    Profiling.count(Profiling.CANDIDATES, len(candidates))
+    results = dict([(stage.output, []) for stage in stages[1:]])
+
+    # Run all the stages on a batch before moving to the next one
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        for stage in stages[1:]:
+            with Profiling.timer(STAGE_TIMERS[stage.output]), Observers.stage(observers, STAGE_TIMERS[stage.output]):
+                results[stage.output].extend(stage.run(tomogram, batch, results))
+
+    Profiling.end_tomogram({'shape': list(tomogram.density_map.shape), 'candidates': len(candidates)})
+    return candidates, results
+
+
+def analyze_tomogram_table(tomogram, labeler, features_extractor, candidate_selector, tilt_finder, set_labels=False,
+                           outputs=ALL_OUTPUTS, batch_size=DEFAULT_BATCH_SIZE, observers=()):
+    """
+    Analyze the tomogram, see run_stages.
+    :return: A tuple of the candidates and their CandidateTable.
+    """
+    candidates, results = run_stages(tomogram, labeler, features_extractor, candidate_selector, tilt_finder,
+                                     set_labels, outputs, batch_size, observers)
+    return candidates, results_table(candidates, results)
+
+
+def analyze_tomogram(tomogram, labeler, features_extractor, candidate_selector, tilt_finder, set_labels=False,
+                     outputs=ALL_OUTPUTS, batch_size=DEFAULT_BATCH_SIZE, observers=()):
+    """
+    Analyze the tomogram, see run_stages.
+    :return: A tuple of the candidates, their feature vectors and their labels. Outputs not requested are None.
+    """
+    candidates, results = run_stages(tomogram, labeler, features_extractor, candidate_selector, tilt_finder,
+                                     set_labels, outputs, batch_size, observers)
+    return candidates, results.get(FEATURES), results.get(LABELS)
+
 
-    return candidates, feature_vectors, labels
+def results_table(candidates, results):
+    """
+    Build the columnar candidate table of the analysis results.
+    :param candidates: The candidates.
+    :param results: The results dictionary returned by run_stages.
+    :return: CandidateTable
+    """
+    labels = [np.ravel(label)[0] for label in results[LABELS]] if LABELS in results else None
+    if isinstance(candidates, CandidateTable):
+        # The stages already wrote the features and the tilts through the rows
+        if labels is not None:
+            candidates.records['label'] = labels
+        return candidates
+    return CandidateTable.fromCandidates(candidates, labels, results.get(FEATURES))
@@ -1,8 +1,10 @@
-from scipy import signal
 import numpy as np
 
-from CommonDataTypes import Candidate, SixPosition
-import PeakDetection
+from CommonDataTypes import Candidate, CandidateTable
+import Profiling
+from Observers import notify
+import TiledScan
+import MachineProfile
 
 # now they are arbitrary values
 KERNEL_GAUSSIAN = 'GAUSSIAN'
@@ -18,6 +20,8 @@ def create_kernel(name, dim):
     :param dim: Dimension of the kernel. Only 2 of 3.
     :return: 3 dimensional ndarray where the third dimension is of size 1 for the 2D case.
     """
+    # scipy.signal loads scipy.stats, it is imported where it is used so that the constants load fast (see JobPlanner)
+    from scipy import signal
     if KERNEL_GAUSSIAN == name:
         base = signal.gaussian(GAUSSIAN_SIZE, GAUSSIAN_STDEV)
         if 2 == dim:
@@ -41,50 +45,76 @@ class CandidateSelector:
     apply a blurring transformation to the max_correlation image (to unite close peaks), and then search for peaks
     """
 
-    def __init__(self, templates, dim=2):
+    def __init__(self, templates, dim=2, correlation_cache=None, threshold=CORRELATION_THRESHOLD, scan_settings=None):
+        """
+        :param scan_settings: Dictionary of the tile size and the batch size of the scan, see TiledScan.max_correlation.
+        None loads them from the machine profile (see MachineProfile.settings).
+        """
         self.templates = templates
         self.dim = dim
+        self.correlation_cache = correlation_cache      # optional CorrelationCache
+        self.threshold = threshold                      # minimal blurred correlation of a peak
+        scan_settings = scan_settings if scan_settings is not None else MachineProfile.settings()
+        self.tile_size = scan_settings['tile_size']
+        self.batch_size = scan_settings['batch_size']
         self.kernel = create_kernel(KERNEL_GAUSSIAN, dim=dim)
 
-        # these are for debug
-        self.max_correlation_per_3loc = None
-        self.blurred_correlation_array = None
-        self.positions = None
+    def blur(self, correlation_array):
+        from scipy import signal
+        # Blur the correlation to remove close peaks.
+        with Profiling.timer(Profiling.BLUR):
+            blurred_correlation_array = signal.fftconvolve(correlation_array, self.kernel, mode='same')
+        Profiling.count(Profiling.FFTS)
+        return blurred_correlation_array
+
+    def find_peaks(self, blurred_correlation_array):
+        """
+        :param blurred_correlation_array: The blurred correlation, see blur.
+        :return: A list of the coordinates of the peaks that are greater than the threshold.
+        """
+        import PeakDetection
+        with Profiling.timer(Profiling.PEAK_DETECTION):
+            res = np.transpose(np.nonzero(PeakDetection.detect_peaks(blurred_correlation_array, 3, 3)))
+        return [tuple(x) for x in res if blurred_correlation_array[tuple(x)] > self.threshold]
 
     def find_local_maxima(self, correlation_array):
-        """lation[position]
-    fig, ax = plt.subplots()
+        """
         Generates a list of coordinates of peaks that are greater than the threshold.
         :param correlation_array: The array of the correlation.
         :return: A list of the coordinates of the picks.
         """
-        # Blur the correlation to remove close peaks.
-        self.blurred_correlation_array = signal.fftconvolve(correlation_array, self.kernel, mode='same')
+        return self.find_peaks(self.blur(correlation_array))
 
-        # Return all the peaks that are more than the threshold
-        res = np.transpose(np.nonzero(PeakDetection.detect_peaks(self.blurred_correlation_array, 3, 3)))
-        return [tuple(x) for x in res if self.blurred_correlation_array[tuple(x)] > CORRELATION_THRESHOLD]
-
-    def select(self, tomogram):
+    def select(self, tomogram, observers=()):
         """
         Find candidates for the template positions using max correlation.
         :param tomogram: The tomogram to search in
-        :return: a list of candidates
+        :param observers: Observers receiving the scan progress, the correlation arrays and the candidates, see
+        Observers.Observer.
+        :return: a CandidateTable of the candidates
         """
-        self.max_correlation_per_3loc = signal.fftconvolve(tomogram.density_map, self.templates[0][0].density_map, mode='same')
-        for template_tuple in self.templates:
-            for tilted in template_tuple:
-                # max_correlation_per_3loc is an array representing the maximum on all correlations generated by all
-                # the templates and tilts for each 3-position.
-                self.max_correlation_per_3loc = np.maximum(self.max_correlation_per_3loc,
-                                                           signal.fftconvolve(tomogram.density_map, tilted.density_map,
-                                                                              mode='same'))
-
-        self.positions = self.find_local_maxima(self.max_correlation_per_3loc)
-        return [Candidate(SixPosition(position, None), None) for position in self.positions]
+        volumes = self.correlation_cache.volumes(tomogram, self.templates) if self.correlation_cache is not None else None
+        if volumes is not None:
+            scores, _ = volumes
+            return self.select_peaks(np.max(scores, axis=0), observers)
+
+        max_correlation_per_3loc = TiledScan.max_correlation(tomogram.density_map, self.templates, self.tile_size,
+                                                             self.batch_size, observers)
+        return self.select_peaks(max_correlation_per_3loc, observers)
+
+    def select_peaks(self, max_correlation_per_3loc, observers=()):
+        notify(observers, 'correlation_computed', max_correlation_per_3loc)
+        blurred_correlation_array = self.blur(max_correlation_per_3loc)
+        notify(observers, 'correlation_blurred', blurred_correlation_array)
+        positions = self.find_peaks(blurred_correlation_array)
+        scores = [blurred_correlation_array[position] for position in positions]
+        candidates = CandidateTable.fromPositions(positions, scores)
+        notify(observers, 'candidates_emitted', candidates)
+        return candidates
 
 
 if __name__ == '__main__':
+    from scipy import signal
     from TemplateGenerator import generate_tilted_templates
     from TomogramGenerator import generate_tomogram_with_given_candidates
     import matplotlib.pyplot as plt
@@ -0,0 +1,271 @@
+from sklearn.feature_selection import f_classif
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_predict
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+from scipy import sparse
+import numpy as np
+
+from Constants import JUNK_ID
+
+# Fraction of the real (non junk) training candidates that must pass the prefilter
+CASCADE_TARGET_RECALL = 0.99
+# Number of folds used to get out of sample junk probabilities for the threshold calibration
+CASCADE_CALIBRATION_FOLDS = 3
+
+# Minimal probability of a staged classifier for the lazy feature computation to stop early
+LAZY_CONFIDENCE = 0.95
+
+# Multiclass strategies
+MULTICLASS_OVO = 'ovo'
+MULTICLASS_OVR = 'ovr'
+SUPPORTED_MULTICLASS = (MULTICLASS_OVO, MULTICLASS_OVR)
+
+
+class CascadeClassifier:
+    """
+    A two stage classifier. A cheap linear model rejects the candidates which are confidently junk and only the
+    survivors are passed to the full (RBF) SVM.
+    The object exposes fit and predict so it can be pickled and used anywhere a plain SVM is used.
+    """
+
+    def __init__(self, svm=None, prefilter=None, target_recall=CASCADE_TARGET_RECALL):
+        """
+        :param svm: The second stage classifier. Defaults to SVC().
+        :param prefilter: The first stage linear model, must support predict_proba. Defaults to LogisticRegression.
+        :param target_recall: Fraction of the non junk training candidates the prefilter must let through.
+        """
+        self.svm = svm if svm is not None else SVC()
+        self.prefilter = prefilter if prefilter is not None else LogisticRegression(class_weight='balanced')
+        self.target_recall = target_recall
+        self.threshold = np.inf     # junk probability from which a candidate is rejected by the prefilter
+        self.prefilter_fitted = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        # stage_counts[i] is the number of candidates that reached stage i, the last entry counts the non junk results
+        self.stage_counts = [0, 0, 0]
+
+    def calibrate_threshold(self, x, is_junk):
+        """
+        Choose the junk probability threshold so that target_recall of the non junk candidates pass the prefilter.
+        The probabilities are taken out of fold when there are enough samples so the threshold is not over optimistic.
+        :param x: Feature vectors.
+        :param is_junk: Boolean array marking the junk candidates.
+        :return: The threshold.
+        """
+        junk_count = np.count_nonzero(is_junk)
+        if min(junk_count, len(is_junk) - junk_count) >= CASCADE_CALIBRATION_FOLDS:
+            probabilities = cross_val_predict(self.prefilter, x, is_junk, cv=CASCADE_CALIBRATION_FOLDS,
+                                              method='predict_proba')[:, 1]
+        else:
+            probabilities = self.prefilter.predict_proba(x)[:, 1]
+
+        real_probabilities = probabilities[~is_junk]
+        # Reject only above the quantile so exactly the target share of real candidates survives
+        return np.nextafter(np.quantile(real_probabilities, self.target_recall), np.inf)
+
+    def fit(self, x, y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        is_junk = y == JUNK_ID
+        self.reset_counters()
+
+        # The prefilter is only meaningful when both junk and real candidates are present
+        self.prefilter_fitted = 0 < np.count_nonzero(is_junk) < len(y)
+        if self.prefilter_fitted:
+            self.prefilter.fit(x, is_junk)
+            self.threshold = self.calibrate_threshold(x, is_junk)
+            survivors = self.junk_probability(x) < self.threshold
+        else:
+            self.threshold = np.inf
+            survivors = np.ones(len(y), dtype=bool)
+
+        # Train the full SVM on the hard cases only, unless the prefilter left a single label
+        if len(np.unique(y[survivors])) > 1:
+            self.svm.fit(x[survivors], y[survivors])
+        else:
+            self.svm.fit(x, y)
+        self.classes_ = self.svm.classes_
+
+        print('Cascade prefilter passes %d of %d training candidates (threshold %.3g)' %
+              (np.count_nonzero(survivors), len(y), self.threshold))
+        return self
+
+    def junk_probability(self, x):
+        if not self.prefilter_fitted:
+            return np.zeros(len(x))
+        junk_column = list(self.prefilter.classes_).index(True)
+        return self.prefilter.predict_proba(x)[:, junk_column]
+
+    def predict(self, x):
+        x = np.asarray(x)
+        survivors = self.junk_probability(x) < self.threshold
+
+        labels = np.full(len(x), JUNK_ID, dtype=self.classes_.dtype)
+        if np.any(survivors):
+            labels[survivors] = self.svm.predict(x[survivors])
+
+        self.stage_counts[0] += len(x)
+        self.stage_counts[1] += np.count_nonzero(survivors)
+        self.stage_counts[2] += np.count_nonzero(labels != JUNK_ID)
+        return labels
+
+    def pass_through_rates(self):
+        return pass_through_rates(self.stage_counts)
+
+
+def pass_through_rates(stage_counts):
+    """
+    :param stage_counts: The stage_counts of a CascadeClassifier, possibly summed over several classifiers.
+    :return: A list with the fraction of the candidates each stage passed on (prefilter, SVM).
+    """
+    return [passed / entered if entered != 0 else 0.0 for entered, passed in zip(stage_counts[:-1], stage_counts[1:])]
+
+
+def top_k_features(x, k):
+    """
+    Keep only the k highest template scores of every feature vector. The matrix keeps its width, a column per
+    template.
+    :param x: Dense feature matrix, a row per candidate and a column per template.
+    :param k: Number of scores to keep per row. None keeps all of them.
+    :return: A CSR matrix with at most k non zero entries per row.
+    """
+    x = np.asarray(x, dtype=float)
+    if k is None or k >= x.shape[1]:
+        return sparse.csr_matrix(x)
+
+    rows = np.repeat(np.arange(x.shape[0]), k)
+    columns = np.argpartition(-x, k - 1, axis=1)[:, :k].ravel()
+    return sparse.csr_matrix((x[rows, columns], (rows, columns)), shape=x.shape)
+
+
+class SparseOneVsRestClassifier:
+    """
+    A classifier meant for banks with many templates. Every class gets its own binary SVM, trained in parallel, so the
+    training and the prediction are linear in the number of classes (SVC alone is one-vs-one, quadratic).
+    The feature vectors are reduced to their top k template scores and kept sparse.
+    Only the input of the SVMs is sparse: the features are still extracted for every template (the top k are only
+    known once all the scores are) and arrive dense, and every per class SVM still predicts every candidate.
+    """
+
+    def __init__(self, top_k=None, n_jobs=None, estimator=None):
+        """
+        :param top_k: Number of template scores to keep per candidate. None keeps all of them.
+        :param n_jobs: Number of classes trained and predicted in parallel, -1 for all the cores.
+        :param estimator: The binary classifier. Defaults to SVC().
+        """
+        self.top_k = top_k
+        self.n_jobs = n_jobs
+        self.ovr = OneVsRestClassifier(estimator if estimator is not None else SVC(), n_jobs=n_jobs)
+
+    def fit(self, x, y):
+        self.ovr.fit(top_k_features(x, self.top_k), np.asarray(y))
+        self.classes_ = self.ovr.classes_
+        return self
+
+    def predict(self, x):
+        return self.ovr.predict(top_k_features(x, self.top_k))
+
+
+def create_classifier(multiclass=MULTICLASS_OVO, top_k=None, n_jobs=None):
+    """
+    Create a new untrained classifier.
+    :param multiclass: The multiclass strategy. Choose from SUPPORTED_MULTICLASS.
+    :param top_k: Number of template scores kept per candidate (one-vs-rest only).
+    :param n_jobs: Number of parallel jobs (one-vs-rest only).
+    :return: The classifier.
+    """
+    if multiclass == MULTICLASS_OVO:
+        return SVC()
+    elif multiclass == MULTICLASS_OVR:
+        return SparseOneVsRestClassifier(top_k=top_k, n_jobs=n_jobs)
+    else:
+        raise NotImplementedError('The multiclass strategy %s is not implemented' % multiclass)
+
+
+class StagedClassifier:
+    """
+    A classifier for the lazy feature computation. The templates are ranked by their discriminative power on the
+    training set and a cheap classifier is trained for every stage, a stage being a prefix of that ranking. The
+    templates which are not computed yet are imputed with their training mean, and the stage classifiers are trained
+    on data imputed the same way. The last stage, where all the templates are known, is the full SVM.
+    Missing features are marked with NaN in the feature vectors, so predict can tell which stage each row reached.
+    """
+
+    def __init__(self, svm=None, confidence=LAZY_CONFIDENCE):
+        """
+        :param svm: The classifier used once all the features are known. Defaults to SVC().
+        :param confidence: Minimal stage probability from which the feature computation stops.
+        """
+        self.svm = svm if svm is not None else SVC()
+        self.confidence = confidence
+        self.feature_order = None   # template indices, most discriminative first
+        self.means = None           # training mean of every feature, used for the imputation
+        self.stages = {}            # number of known features -> stage classifier
+
+    @staticmethod
+    def stage_sizes_for(feature_count):
+        # Stages grow geometrically so the number of stage classifiers is logarithmic in the number of templates
+        sizes = []
+        size = 1
+        while size < feature_count:
+            sizes.append(size)
+            size *= 2
+        return sizes
+
+    def stage_sizes(self):
+        return sorted(self.stages.keys())
+
+    def impute(self, x):
+        x = np.array(x, dtype=float)
+        missing = np.isnan(x)
+        x[missing] = np.broadcast_to(self.means, x.shape)[missing]
+        return x
+
+    def fit(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y)
+        scores, _ = f_classif(x, y)
+        self.feature_order = np.argsort(-np.nan_to_num(scores), kind='stable')
+        self.means = x.mean(axis=0)
+
+        self.stages = {}
+        for size in self.stage_sizes_for(x.shape[1]):
+            partial = x.copy()
+            partial[:, self.feature_order[size:]] = np.nan
+            self.stages[size] = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+            self.stages[size].fit(self.impute(partial), y)
+
+        self.svm.fit(x, y)
+        self.classes_ = self.svm.classes_
+        return self
+
+    def confident(self, features_vector, known_count):
+        """
+        :param features_vector: A partially computed feature vector, NaN where the feature is missing.
+        :param known_count: Number of features computed so far (in feature_order).
+        :return: True if the stage classifier for known_count features is confident enough to stop.
+        """
+        if known_count not in self.stages:
+            return False
+        probabilities = self.stages[known_count].predict_proba(self.impute([features_vector]))
+        return np.max(probabilities) >= self.confidence
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=float)
+        known_counts = np.count_nonzero(~np.isnan(x), axis=1)
+        labels = np.empty(len(x), dtype=self.classes_.dtype)
+
+        for known_count in np.unique(known_counts):
+            rows = known_counts == known_count
+            if known_count == x.shape[1]:
+                labels[rows] = self.svm.predict(x[rows])
+            else:
+                # Use the largest stage the rows reached
+                sizes = [size for size in self.stage_sizes() if size <= known_count]
+                stage = self.stages[sizes[-1]] if len(sizes) != 0 else self.stages[self.stage_sizes()[0]]
+                labels[rows] = stage.predict(self.impute(x[rows]))
+        return labels
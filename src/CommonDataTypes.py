@@ -1,8 +1,27 @@
-class EulerAngle:
+class Slotted:
+    """
+    Base of the small data classes. They use __slots__ to avoid a __dict__ per object, this keeps loading pickles made
+    before that (whose state is a dict) working.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name)])
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (__dict__, slots) state
+            state = dict(list((state[0] or {}).items()) + list((state[1] or {}).items()))
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class EulerAngle(Slotted):
     """
     This represents the angles of a rotated rigid body.
     alpha is ...
     """
+    __slots__ = ('Phi', 'Theta', 'Psi')
     Tilts = []
 
     def __init__(self, Phi, Theta, Psi):
@@ -44,7 +63,9 @@ EulerAngle.init_tilts(15,15,15)
 
 
 
-class SixPosition:
+class SixPosition(Slotted):
+    __slots__ = ('COM_position', 'tilt_id')
+
     def __init__(self, COM_position, tilt_id):
         """
         :param COM_position: 3 tuple
@@ -59,11 +80,12 @@ class SixPosition:
 
 
 
-class Candidate:
+class Candidate(Slotted):
     """
     This is a way to associate metadata to a posistion:
     label, suggested label, and feature vector
     """
+    __slots__ = ('six_position', 'label', 'suggested_label', 'features')
 
     def __init__(self, six_position, suggested_label=None, label = None):
         self.six_position = six_position            # SixPosition
@@ -84,15 +106,14 @@ class Candidate:
     def set_features(self, features):
         self.features = features
 
-    def set_features(self, features):
-        self.features = features
-
     def set_label(self, label):
         self.label = label
 
 
 
-class TiltedTemplate:
+class TiltedTemplate(Slotted):
+    __slots__ = ('template_id', 'density_map', 'tilt_id')
+
     def __init__(self, density_map, tilt_id, template_id):
         self.template_id = template_id      # int
         self.density_map = density_map      # numpy 3d array
@@ -102,11 +123,360 @@ class TiltedTemplate:
 
 
 
+class TemplateView:
+    """
+    The tilts of one template in a TemplateBank. Behaves like the tuple of TiltedTemplates it replaces, the density maps
+    are views of the bank's array.
+    """
+    def __init__(self, bank, template_index):
+        self.bank = bank
+        self.template_index = template_index
+        self.start = bank.offsets[template_index]
+        self.stop = bank.offsets[template_index + 1]
+
+    @property
+    def density_maps(self):
+        return self.bank.density_maps[self.start:self.stop]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, tilt_index):
+        if isinstance(tilt_index, slice):
+            return tuple([self[i] for i in range(*tilt_index.indices(len(self)))])
+        if tilt_index < 0:
+            tilt_index += len(self)
+        if not 0 <= tilt_index < len(self):
+            raise IndexError('tilt index %d out of range' % tilt_index)
+        return self.bank.tilted_template(self.start + tilt_index)
+
+    def __iter__(self):
+        for tilt_index in range(len(self)):
+            yield self[tilt_index]
+
+
+class TemplateBank:
+    """
+    All the tilted templates in a single contiguous array, ordered by template and then by tilt, with parallel
+    template_id and tilt_id arrays. Indexing (bank[template_index][tilt_index]) and iteration behave like the tuple of
+    tuples of TiltedTemplates, while batched consumers can work on the arrays directly.
+    """
+    def __init__(self, density_maps, template_ids, tilt_ids):
+        """
+        :param density_maps: numpy array (tilted templates, d, d, d) ordered by template and then by tilt.
+        :param template_ids: numpy array with the template_id of every tilted template.
+        :param tilt_ids: numpy array with the tilt_id of every tilted template.
+        """
+        import numpy as np
+        self.density_maps = density_maps
+        self.template_ids = np.asarray(template_ids)
+        self.tilt_ids = np.asarray(tilt_ids)
+        # offsets[i]:offsets[i + 1] are the tilts of the i-th template
+        starts = np.flatnonzero(np.r_[True, self.template_ids[1:] != self.template_ids[:-1]])
+        self.offsets = np.r_[starts, len(self.template_ids)]
+        self._norms = None
+        self._masks = None
+
+    @classmethod
+    def fromTemplates(cls, templates):
+        """
+        Copy a tuple of tuples of TiltedTemplates into a bank. Templates smaller than the largest one are zero padded so
+        that their center, as used by the 'same' mode correlations, is kept.
+        """
+        import numpy as np
+        flat = [tilted for template_tuple in templates for tilted in template_tuple]
+        shape = tuple(np.max([tilted.density_map.shape for tilted in flat], axis=0))
+        density_maps = np.zeros((len(flat),) + shape, dtype=flat[0].density_map.dtype)
+        for index, tilted in enumerate(flat):
+            before = [(size - 1) // 2 - (own - 1) // 2 for size, own in zip(shape, tilted.density_map.shape)]
+            density_maps[index][tuple([slice(start, start + own)
+                                       for start, own in zip(before, tilted.density_map.shape)])] = tilted.density_map
+        return cls(density_maps, [tilted.template_id for tilted in flat], [tilted.tilt_id for tilted in flat])
+
+    @classmethod
+    def fromPacked(cls, path):
+        """
+        Map a packed template bank without copying it.
+        """
+        import numpy as np
+        from PackedTemplates import open_packed
+        data, template_ids, tilt_ids = open_packed(path)
+        template_count, tilt_count = data.shape[:2]
+        return cls(data.reshape((template_count * tilt_count,) + data.shape[2:]),
+                   np.repeat(sorted(template_ids.keys()), tilt_count),
+                   np.tile(sorted(tilt_ids.keys()), template_count))
+
+    @property
+    def norms(self):
+        # L2 norm of every tilted template
+        if self._norms is None:
+            import numpy as np
+            self._norms = np.sqrt(np.square(self.density_maps.reshape(len(self.density_maps), -1)).sum(axis=1))
+        return self._norms
+
+    @property
+    def masks(self):
+        # The support (non zero voxels) of every tilted template
+        if self._masks is None:
+            self._masks = self.density_maps != 0
+        return self._masks
+
+    def tilted_template(self, index):
+        return TiltedTemplate(self.density_maps[index], self.tilt_ids[index], self.template_ids[index])
+
+    def iter_flat(self):
+        """
+        Iterate over all the tilted templates regardless of their template.
+        :return: Generator of (index in the bank, template_id, tilt_id, density map)
+        """
+        for index in range(len(self.density_maps)):
+            yield index, self.template_ids[index], self.tilt_ids[index], self.density_maps[index]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, template_index):
+        if isinstance(template_index, slice):
+            return tuple([self[i] for i in range(*template_index.indices(len(self)))])
+        if template_index < 0:
+            template_index += len(self)
+        if not 0 <= template_index < len(self):
+            raise IndexError('template index %d out of range' % template_index)
+        return TemplateView(self, template_index)
+
+    def __iter__(self):
+        for template_index in range(len(self)):
+            yield self[template_index]
+
+
+
+
+
 class Tomogram:
     """
     composition is a list of labeled candidates, that represents the ground truth
     """
-    def __init__(self, density_map, composition):
+    def __init__(self, density_map, composition, voxel_size=None):
         self.density_map = density_map      # numpy 3d array
         self.composition = composition      # list of labeled candidates
+        self.voxel_size = voxel_size        # angstroms per voxel along x, y, z, None if unknown
+
+
+
+
+class CandidateTable:
+    """
+    The candidates of a tomogram stored by column in a numpy structured array (a record per candidate) and a features
+    matrix, instead of a Python object per candidate. Indexing and iteration give CandidateRow views which behave like
+    Candidate, so the pipeline stages work on either.
+    """
+    # Stored for None in the integer columns
+    NONE_ID = -2 ** 31
+
+    def __init__(self, records, features=None):
+        """
+        :param records: numpy structured array of record_dtype().
+        :param features: numpy (n, templates) float array, None until the first features are set.
+        """
+        self.records = records
+        self.features = features
+
+    @staticmethod
+    def record_dtype():
+        import numpy as np
+        return np.dtype([('position', np.int32, 3), ('tilt_id', np.int32), ('label', np.int32),
+                         ('suggested_label', np.int32), ('score', np.float32), ('has_features', np.bool_)])
+
+    @classmethod
+    def empty(cls, size):
+        import numpy as np
+        records = np.zeros(size, dtype=cls.record_dtype())
+        records['tilt_id'] = records['label'] = records['suggested_label'] = cls.NONE_ID
+        return cls(records)
 
+    @classmethod
+    def fromPositions(cls, positions, scores=None):
+        """
+        :param positions: Sequence of position tuples (2 or 3 coordinates).
+        :param scores: Optional score of every position.
+        """
+        table = cls.empty(len(positions))
+        for index, position in enumerate(positions):
+            table.records['position'][index, :len(position)] = position
+        if scores is not None:
+            table.records['score'] = scores
+        return table
+
+    @classmethod
+    def fromCandidates(cls, candidates, labels=None, features=None):
+        """
+        Build a table from Candidate objects.
+        :param candidates: The candidates.
+        :param labels: Optional labels overriding the candidates labels.
+        :param features: Optional feature vectors overriding the candidates features.
+        """
+        table = cls.fromPositions([c.six_position.COM_position for c in candidates])
+        for index, candidate in enumerate(candidates):
+            row = table[index]
+            row.six_position.tilt_id = candidate.six_position.tilt_id
+            row.label = candidate.label if labels is None else labels[index]
+            row.suggested_label = candidate.suggested_label
+            if features is not None or candidate.features is not None:
+                row.set_features(features[index] if features is not None else candidate.features)
+        return table
+
+    def to_candidates(self):
+        """
+        :return: A list of independent Candidate objects.
+        """
+        candidates = []
+        for row in self:
+            candidate = Candidate(SixPosition(row.six_position.COM_position, row.six_position.tilt_id),
+                                  row.suggested_label, row.label)
+            candidate.set_features(None if row.features is None else list(row.features))
+            candidates.append(candidate)
+        return candidates
+
+    def id_column(self, name):
+        # An integer column with None stored as -1, for array consumers
+        import numpy as np
+        column = self.records[name]
+        return np.where(column == self.NONE_ID, -1, column)
+
+    @property
+    def positions(self):
+        return self.records['position']
+
+    @property
+    def tilt_ids(self):
+        return self.id_column('tilt_id')
+
+    @property
+    def labels(self):
+        return self.id_column('label')
+
+    @property
+    def suggested_labels(self):
+        return self.id_column('suggested_label')
+
+    @property
+    def scores(self):
+        return self.records['score']
+
+    def set_row_features(self, index, features):
+        import numpy as np
+        if self.features is None or self.features.shape[1] != len(features):
+            if self.features is not None and np.any(self.records['has_features']):
+                raise ValueError('All the feature vectors must have the same length')
+            self.features = np.full((len(self.records), len(features)), np.nan)
+        self.features[index] = features
+        self.records['has_features'][index] = True
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [CandidateRow(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('candidate index %d out of range' % index)
+        return CandidateRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CandidateRow(self, index)
+
+
+class RowSixPosition:
+    """
+    The SixPosition of a CandidateRow, reading and writing through to the table.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def COM_position(self):
+        return tuple(self.table.records['position'][self.index].tolist())
+
+    @COM_position.setter
+    def COM_position(self, position):
+        self.table.records['position'][self.index] = 0
+        self.table.records['position'][self.index, :len(position)] = position
+
+    @property
+    def tilt_id(self):
+        value = int(self.table.records['tilt_id'][self.index])
+        return None if value == CandidateTable.NONE_ID else value
+
+    @tilt_id.setter
+    def tilt_id(self, tilt_id):
+        self.table.records['tilt_id'][self.index] = CandidateTable.NONE_ID if tilt_id is None else tilt_id
+
+    def __str__(self):
+        return str(self.COM_position) + " " + str(self.tilt_id)
+
+
+class CandidateRow:
+    """
+    A view of a single row of a CandidateTable that behaves like a Candidate.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def _get_id(self, name):
+        value = int(self.table.records[name][self.index])
+        return None if value == CandidateTable.NONE_ID else value
+
+    def _set_id(self, name, value):
+        import numpy as np
+        self.table.records[name][self.index] = CandidateTable.NONE_ID if value is None else np.ravel(value)[0]
+
+    @property
+    def six_position(self):
+        return RowSixPosition(self.table, self.index)
+
+    @property
+    def label(self):
+        return self._get_id('label')
+
+    @label.setter
+    def label(self, label):
+        self._set_id('label', label)
+
+    @property
+    def suggested_label(self):
+        return self._get_id('suggested_label')
+
+    @suggested_label.setter
+    def suggested_label(self, suggested_label):
+        self._set_id('suggested_label', suggested_label)
+
+    @property
+    def score(self):
+        return float(self.table.records['score'][self.index])
+
+    @property
+    def features(self):
+        if not self.table.records['has_features'][self.index]:
+            return None
+        return self.table.features[self.index]
+
+    def set_features(self, features):
+        self.table.set_row_features(self.index, features)
+
+    def set_label(self, label):
+        self.label = label
+
+    def __str__(self):
+        return "Position: " + str(self.six_position) + "\n" +\
+               "Suggested Label: " + str(self.suggested_label) + "\n" +\
+               "Label: " + str(self.label) + "\n" +\
+               "Features: " + str(self.features) + "\n"
@@ -0,0 +1,171 @@
+from scipy import signal
+import hashlib
+import json
+import os
+import numpy as np
+
+from Hashing import array_hash, templates_hash
+from Pipeline import atomic_write
+import Profiling
+
+DEFAULT_CACHE_BYTES = 4 << 30   # 4 GB
+# Changing how the volumes are computed must change this so old entries are not served
+SCAN_PARAMETERS = {'correlation': 'fftconvolve', 'mode': 'same', 'reduce': 'max over tilts', 'version': 1}
+
+SCORES_SUFFIX = '.scores.npy'
+TILTS_SUFFIX = '.tilts.npy'
+
+
+def correlation_volumes(density_map, templates, scores, tilts):
+    """
+    Correlate the tomogram with every tilted template and keep, per template, the best score and its tilt.
+    :param density_map: The tomogram's density map.
+    :param templates: tuple of tuples of TiltedTemplates, or a template bank indexed the same way.
+    :param scores: Output float32 array (templates,) + density_map.shape of the maximal correlation over the tilts.
+    :param tilts: Output int32 array of the same shape with the tilt_id of the maximum.
+    """
+    for template_index, template_tuple in enumerate(templates):
+        # Let a lazy template bank load the next template while this one is scanned
+        if template_index + 1 < len(templates) and hasattr(templates[template_index + 1], 'prefetch'):
+            templates[template_index + 1].prefetch()
+        Profiling.count(Profiling.TEMPLATES_SCANNED)
+        Profiling.count(Profiling.FFTS, len(template_tuple))
+        best = None
+        for tilted in template_tuple:
+            correlation = signal.fftconvolve(density_map, tilted.density_map, mode='same')
+            if best is None:
+                best = correlation
+                best_tilt = np.full(correlation.shape, tilted.tilt_id, dtype=np.int32)
+            else:
+                better = correlation > best
+                best = np.where(better, correlation, best)
+                best_tilt[better] = tilted.tilt_id
+        scores[template_index] = best
+        tilts[template_index] = best_tilt
+
+
+class CorrelationCache:
+    """
+    On disk cache of the correlation volumes of the tomograms with the templates. An entry is a pair of .npy files
+    (see correlation_volumes) keyed by the hashes of the tomogram content, the templates and SCAN_PARAMETERS, served
+    as read only memory maps. The least recently used entries are evicted above max_bytes.
+    Entries are computed straight into memory mapped files, never whole in memory. A tomogram whose entry alone is
+    larger than max_bytes is not cached, volumes returns None and the callers compute the correlations themselves.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        :param path: The cache directory, created if missing. Several processes may share it.
+        :param max_bytes: Maximal total size of the entries.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        # The volumes of the last tomogram, the selector and the extractor ask for the same tomogram many times
+        self.current = None
+        self.bank = None        # (templates, their hash), hashing a large bank for every tomogram would be slow
+        self.hits = 0
+        self.misses = 0
+        self.too_large = 0
+
+    @staticmethod
+    def key(density_map, bank_hash):
+        identity = json.dumps([array_hash(density_map), bank_hash, SCAN_PARAMETERS], sort_keys=True)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def entry_paths(self, key):
+        return os.path.join(self.path, key + SCORES_SUFFIX), os.path.join(self.path, key + TILTS_SUFFIX)
+
+    def volumes(self, tomogram, templates):
+        """
+        :param tomogram: The tomogram.
+        :param templates: The templates the volumes are computed with.
+        :return: A tuple of the scores and the tilts arrays, see correlation_volumes. None when the entry would be larger
+        than the whole cache.
+        """
+        if self.current is not None and self.current[0] is tomogram and self.current[1] is templates:
+            return self.current[2]
+
+        if self.entry_bytes(tomogram.density_map, templates) > self.max_bytes:
+            self.too_large += 1
+            self.current = (tomogram, templates, None)
+            return None
+
+        if self.bank is None or self.bank[0] is not templates:
+            self.bank = (templates, templates_hash(templates))
+        key = self.key(tomogram.density_map, self.bank[1])
+        scores_path, tilts_path = self.entry_paths(key)
+        try:
+            result = np.load(scores_path, mmap_mode='r'), np.load(tilts_path, mmap_mode='r')
+            # Mark as recently used
+            os.utime(scores_path)
+            os.utime(tilts_path)
+            self.hits += 1
+        except (OSError, ValueError):
+            # Missing, or evicted by another process in between
+            result = self.compute(key, tomogram.density_map, templates)
+            self.misses += 1
+
+        self.current = (tomogram, templates, result)
+        return result
+
+    @staticmethod
+    def entry_bytes(density_map, templates):
+        # float32 scores and int32 tilts per template
+        return len(templates) * density_map.size * (np.dtype(np.float32).itemsize + np.dtype(np.int32).itemsize)
+
+    def compute(self, key, density_map, templates):
+        shape = (len(templates),) + density_map.shape
+        scores_path, tilts_path = self.entry_paths(key)
+
+        def write_scores(scores_temporary_path):
+            scores = np.lib.format.open_memmap(scores_temporary_path, mode='w+', dtype=np.float32, shape=shape)
+
+            def write_tilts(tilts_temporary_path):
+                tilts = np.lib.format.open_memmap(tilts_temporary_path, mode='w+', dtype=np.int32, shape=shape)
+                correlation_volumes(density_map, templates, scores, tilts)
+                tilts.flush()
+                del tilts
+            # The tilts are renamed first, an entry is complete once the scores exist
+            atomic_write(tilts_path, write_tilts)
+            scores.flush()
+            del scores
+        atomic_write(scores_path, write_scores)
+
+        # Opened before the eviction, another process may evict the entry but the maps stay valid
+        result = np.load(scores_path, mmap_mode='r'), np.load(tilts_path, mmap_mode='r')
+        self.evict(keep=key)
+        return result
+
+    def evict(self, keep):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        :param keep: Key of an entry never to evict.
+        """
+        entries = {}    # key -> [last use, bytes]
+        for name in os.listdir(self.path):
+            for suffix in (SCORES_SUFFIX, TILTS_SUFFIX):
+                if name.endswith(suffix) and '.partial' not in name:
+                    try:
+                        stat = os.stat(os.path.join(self.path, name))
+                    except OSError:
+                        continue
+                    entry = entries.setdefault(name[:-len(suffix)], [0, 0])
+                    entry[0] = max(entry[0], stat.st_mtime)
+                    entry[1] += stat.st_size
+
+        total = sum([size for _, size in entries.values()])
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in self.entry_paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'too_large': self.too_large}
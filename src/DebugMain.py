@@ -2,13 +2,14 @@ from TomogramGenerator import *
 from TemplateGenerator import generate_tilted_templates
 from Constants import JUNK_ID
 from FeaturesExtractor import FeaturesExtractor
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
+from VisualUtils import pyplot
 import CandidateSelector
 import Labeler
 import TiltFinder
 import Noise
+from Observers import DebugObserver
+
+plt = pyplot()
 
 
 def print_candidate_list(candidates):
@@ -53,7 +54,7 @@ def show_tomogram(tomogram, criteria):
     ax.imshow(tomogram.density_map[:, :, 0])
     plt.show()
 
-def show_candidates(selector, candidates, tomogram):
+def show_candidates(debug_observer, candidates, tomogram):
     print_candidate_list(candidates)
 
     fig = plt.figure(3)
@@ -65,11 +66,11 @@ def show_candidates(selector, candidates, tomogram):
 
     ax = plt.subplot(142)
     ax.set_title('Max Correlation')
-    ax.imshow(selector.max_correlation_per_3loc[:,:,0])
+    ax.imshow(debug_observer.max_correlation_per_3loc[:,:,0])
 
     ax = plt.subplot(143)
     ax.set_title('Blurred Correlation')
-    ax.imshow(selector.blurred_correlation_array[:,:,0])
+    ax.imshow(debug_observer.blurred_correlation_array[:,:,0])
 
     ax = plt.subplot(144)
     ax.set_title('Selected Candidates')
@@ -129,8 +130,9 @@ if __name__ == '__main__':
 
     tomogram = Noise.make_noisy_tomogram(truth_tomogram)
     selector = CandidateSelector.CandidateSelector(templates)
-    candidates = selector.select(tomogram)
-    #show_candidates(selector, candidates, tomogram)
+    debug_observer = DebugObserver()
+    candidates = selector.select(tomogram, [debug_observer])
+    #show_candidates(debug_observer, candidates, tomogram)
 
 
     labeler = Labeler.PositionLabeler(tomogram.composition)
@@ -3,9 +3,6 @@ from TemplateGenerator import generate_tilted_templates, load_templates_3d
 from Constants import JUNK_ID
 from FeaturesExtractor import FeaturesExtractor
 from CommonDataTypes import Candidate
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
 import VisualUtils
 import CandidateSelector
 import Labeler
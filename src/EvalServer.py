@@ -0,0 +1,384 @@
+from collections import deque
+import socketserver
+import threading
+import copy
+import signal
+import socket
+import queue
+import json
+import time
+import os
+import numpy as np
+
+from TemplateFactory import TemplateFactory, Generator
+from TomogramFactory import load_tomogram
+from AnalyzeTomogram import analyze_tomogram_table, EVAL_OUTPUTS
+from CorrelationCache import CorrelationCache, DEFAULT_CACHE_BYTES
+from Pipeline import atomic_write
+from SvmEval import load_svm, create_analyzers, write_output
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_POLL_INTERVAL = 1.0     # seconds between two scans of the spool directory
+DEFAULT_LEASE_SECONDS = 60.0    # a .running job not renewed for this long belongs to a dead server
+LATENCY_WINDOW = 1000           # number of last jobs the latency percentiles are computed on
+
+# A spool job is a JSON file {"tomogram": path, "out": path}. It is renamed as it goes through the states.
+# The server holding a .running job touches it every poll, the servers watching the spool requeue the expired ones.
+JOB_SUFFIX = '.job'
+RUNNING_SUFFIX = '.running'
+DONE_SUFFIX = '.done'
+FAILED_SUFFIX = '.failed'
+METRICS_NAME = 'metrics.json'
+
+
+class Job:
+    def __init__(self, job_id, tomogram_path, out_path, spool_path=None):
+        self.job_id = job_id
+        self.tomogram_path = tomogram_path
+        self.out_path = out_path
+        self.spool_path = spool_path    # the .running file of a spool job
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.candidates = None
+        self.error = None
+        self.done = threading.Event()
+
+    def result(self):
+        result = {'job': self.job_id, 'tomogram': self.tomogram_path, 'out': self.out_path,
+                  'ok': self.error is None}
+        if self.finished is not None:
+            result.update(queue_seconds=self.started - self.submitted, seconds=self.finished - self.started)
+        if self.error is not None:
+            result['error'] = self.error
+        else:
+            result['candidates'] = self.candidates
+        return result
+
+
+class ServerMetrics:
+    """
+    Counters and latencies of the jobs, updated by the workers and read by the metrics requests.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queue_seconds = deque(maxlen=LATENCY_WINDOW)
+        self.seconds = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, job):
+        with self.lock:
+            if job.error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.queue_seconds.append(job.started - job.submitted)
+            self.seconds.append(job.finished - job.started)
+
+    @staticmethod
+    def summary(values):
+        if len(values) == 0:
+            return None
+        return {'mean': float(np.mean(values)), 'p50': float(np.percentile(values, 50)),
+                'p95': float(np.percentile(values, 95)), 'max': float(np.max(values))}
+
+    def snapshot(self, queue_depth, busy_workers):
+        with self.lock:
+            return {'uptime': time.time() - self.start, 'queue_depth': queue_depth, 'busy_workers': busy_workers,
+                    'submitted': self.submitted, 'completed': self.completed, 'failed': self.failed,
+                    'rejected': self.rejected, 'queue_seconds': self.summary(self.queue_seconds),
+                    'seconds': self.summary(self.seconds)}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    A request per line, each a JSON object answered by a JSON line:
+    {"command": "eval", "tomogram": path, "out": path, "wait": true}, {"command": "metrics"} or {"command": "stop"}.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.eval_server.handle_request(json.loads(line))
+            except (ValueError, KeyError, TypeError) as error:
+                response = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class EvalServer:
+    """
+    Keeps the SVM and the templates loaded and evaluates tomograms as jobs arrive from a Unix socket and from a spool
+    directory, with a bounded queue and a fixed number of worker threads.
+    """
+
+    def __init__(self, svm_path, template_paths, socket_path=None, spool_path=None, n_workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, correlation_cache_path=None,
+                 correlation_cache_bytes=DEFAULT_CACHE_BYTES, poll_interval=DEFAULT_POLL_INTERVAL,
+                 lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        :param svm_path: Path from which the SVM will be loaded.
+        :param template_paths: List of paths to the templates.
+        :param socket_path: Path of the Unix socket to listen on, None for no socket.
+        :param spool_path: Directory watched for .job files, None for no spool.
+        :param n_workers: Number of jobs evaluated at the same time.
+        :param queue_size: Maximal number of jobs waiting, further jobs are rejected (socket) or left in the spool.
+        :param correlation_cache_path: Directory of a CorrelationCache, None to always compute the correlations.
+        :param correlation_cache_bytes: Maximal size of the CorrelationCache.
+        :param poll_interval: Seconds between two scans of the spool directory.
+        :param lease_seconds: Seconds after which a .running job not renewed is requeued, more than poll_interval.
+        """
+        assert socket_path is not None or spool_path is not None
+        self.svm, self.full_svm = load_svm(svm_path)
+        self.templates = list(TemplateFactory(Generator.LOAD).set_paths(template_paths).build())
+        self.socket_path = socket_path
+        self.spool_path = spool_path
+        self.n_workers = n_workers
+        self.correlation_cache_path = correlation_cache_path
+        self.correlation_cache_bytes = correlation_cache_bytes
+        self.poll_interval = poll_interval
+        self.lease_seconds = max(lease_seconds, 3 * poll_interval)
+        self.held = set()       # .running paths of the queued and running spool jobs
+
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.metrics = ServerMetrics()
+        self.busy_workers = 0
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def submit(self, tomogram_path, out_path, spool_path=None):
+        """
+        :return: The queued Job, or None if the queue is full.
+        """
+        with self.lock:
+            self.next_id += 1
+            job = Job(self.next_id, tomogram_path, out_path, spool_path)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            with self.metrics.lock:
+                self.metrics.rejected += 1
+            return None
+        with self.metrics.lock:
+            self.metrics.submitted += 1
+        return job
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot(self.jobs.qsize(), self.busy_workers)
+
+    def handle_request(self, request):
+        command = request['command']
+        if command == 'eval':
+            job = self.submit(request['tomogram'], request['out'])
+            if job is None:
+                return {'ok': False, 'error': 'queue full'}
+            if request.get('wait', True):
+                job.done.wait()
+                return job.result()
+            return {'ok': True, 'job': job.job_id}
+        if command == 'metrics':
+            return dict(ok=True, **self.metrics_snapshot())
+        if command == 'stop':
+            self.stopping.set()
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown command %s' % command}
+
+    def work(self):
+        # Every worker has its own analyzers, the candidate selector and the extractors keep per tomogram state, and
+        # its own copy of the SVM whose cascade counts the candidates of every stage
+        correlation_cache = CorrelationCache(self.correlation_cache_path, self.correlation_cache_bytes) \
+            if self.correlation_cache_path is not None else None
+        labeler, features_extractor, candidate_selector, tilt_finder = \
+            create_analyzers(copy.deepcopy(self.svm), self.templates, correlation_cache)
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            with self.lock:
+                self.busy_workers += 1
+            job.started = time.time()
+            try:
+                tomogram = load_tomogram(job.tomogram_path)
+                (candidates, table) = analyze_tomogram_table(tomogram, labeler, features_extractor,
+                                                             candidate_selector, tilt_finder, set_labels=True,
+                                                             outputs=EVAL_OUTPUTS)
+                write_output(job.out_path, tomogram, table, job.tomogram_path)
+                job.candidates = len(table)
+            except Exception as error:
+                job.error = '%s: %s' % (type(error).__name__, error)
+            job.finished = time.time()
+            with self.lock:
+                self.busy_workers -= 1
+
+            self.metrics.record(job)
+            if job.spool_path is not None:
+                self.finish_spool_job(job)
+            job.done.set()
+
+    def finish_spool_job(self, job):
+        base = job.spool_path[:-len(RUNNING_SUFFIX)]
+        result_path = base + (DONE_SUFFIX if job.error is None else FAILED_SUFFIX)
+        atomic_write(result_path, lambda temporary_path: json_dump(temporary_path, job.result()))
+        with self.lock:
+            self.held.discard(job.spool_path)
+        try:
+            os.remove(job.spool_path)
+        except OSError:
+            # The lease expired and another server requeued the job, it runs again there
+            pass
+
+    def renew_leases(self):
+        with self.lock:
+            held = list(self.held)
+        for path in held:
+            try:
+                os.utime(path)
+            except OSError:
+                continue
+
+    def requeue_spool(self):
+        # Jobs left running by a killed server start over, the ones of live servers are renewed and left alone
+        for name in os.listdir(self.spool_path):
+            if not name.endswith(RUNNING_SUFFIX):
+                continue
+            path = os.path.join(self.spool_path, name)
+            try:
+                if time.time() - os.stat(path).st_mtime < self.lease_seconds:
+                    continue
+                os.rename(path, path[:-len(RUNNING_SUFFIX)] + JOB_SUFFIX)
+            except OSError:
+                # Finished or requeued by another server in between
+                continue
+
+    def poll_spool(self):
+        for name in sorted(os.listdir(self.spool_path)):
+            if not name.endswith(JOB_SUFFIX) or self.jobs.full():
+                continue
+            path = os.path.join(self.spool_path, name)
+            running_path = path[:-len(JOB_SUFFIX)] + RUNNING_SUFFIX
+            try:
+                # The rename claims the job, another server watching the directory gets an error
+                os.rename(path, running_path)
+                # The rename keeps the time the job was written, start the lease now
+                os.utime(running_path)
+            except OSError:
+                continue
+            try:
+                with open(running_path, 'r') as file:
+                    request = json.load(file)
+                tomogram_path, out_path = request['tomogram'], request['out']
+            except (ValueError, KeyError, TypeError) as error:
+                failed = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+                atomic_write(path[:-len(JOB_SUFFIX)] + FAILED_SUFFIX,
+                             lambda temporary_path: json_dump(temporary_path, failed))
+                os.remove(running_path)
+                continue
+            with self.lock:
+                self.held.add(running_path)
+            if self.submit(tomogram_path, out_path, running_path) is None:
+                with self.lock:
+                    self.held.discard(running_path)
+                os.replace(running_path, path)
+
+        metrics = self.metrics_snapshot()
+        atomic_write(os.path.join(self.spool_path, METRICS_NAME),
+                     lambda temporary_path: json_dump(temporary_path, metrics))
+
+    def watch_spool(self):
+        while not self.stopping.is_set():
+            self.renew_leases()
+            self.requeue_spool()
+            self.poll_spool()
+            self.stopping.wait(self.poll_interval)
+
+    def start(self):
+        for _ in range(self.n_workers):
+            self.threads.append(threading.Thread(target=self.work, daemon=True))
+        if self.spool_path is not None:
+            os.makedirs(self.spool_path, exist_ok=True)
+            self.requeue_spool()
+            self.threads.append(threading.Thread(target=self.watch_spool, daemon=True))
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = UnixServer(self.socket_path, RequestHandler)
+            self.server.eval_server = self
+            self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop taking jobs, finish the queued ones and stop the workers.
+        """
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_path)
+        for _ in range(self.n_workers):
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def serve_forever(self):
+        self.start()
+        print('Serving with %d workers%s%s' % (self.n_workers,
+                                              ', socket %s' % self.socket_path if self.socket_path else '',
+                                              ', spool %s' % self.spool_path if self.spool_path else ''))
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        try:
+            while not self.stopping.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        print('Stopping, finishing %d queued jobs' % self.jobs.qsize())
+        self.stop()
+        print(json.dumps(self.metrics_snapshot()))
+
+
+def json_dump(path, value):
+    with open(path, 'w') as file:
+        json.dump(value, file)
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to a running server and wait for its response.
+    :param socket_path: The server's Unix socket.
+    :param request: The request dictionary, see RequestHandler.
+    :return: The response dictionary.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with client.makefile('r') as file:
+            return json.loads(file.readline())
+
+
+def serve(svm_path, template_paths, socket_path=None, spool_path=None, n_workers=DEFAULT_WORKERS,
+          queue_size=DEFAULT_QUEUE_SIZE, correlation_cache_path=None, correlation_cache_bytes=DEFAULT_CACHE_BYTES,
+          lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Run an EvalServer until it is stopped by a signal or a stop request.
+    """
+    print('Loading the SVM and the templates')
+    EvalServer(svm_path, template_paths, socket_path, spool_path, n_workers, queue_size, correlation_cache_path,
+               correlation_cache_bytes, lease_seconds=lease_seconds).serve_forever()
+
+
+if __name__ == '__main__':
+    import sys
+    print(send_request(sys.argv[1], json.loads(sys.argv[2])))
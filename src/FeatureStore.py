@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+from Hashing import file_hash
+from Pipeline import atomic_write
+
+INDEX_NAME = 'index.jsonl'
+
+
+class FeatureStore:
+    """
+    Append-only directory of the training features, one .npz entry per tomogram. An entry is written completely before
+    its line is appended to the index, so a run killed at any point loses at most the tomogram it was working on.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The store directory, created if missing.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.entries = {}       # key -> entry file name
+        index_path = os.path.join(path, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as file:
+                lines = file.readlines()
+            if len(lines) != 0 and not lines[-1].endswith('\n'):
+                # End the line cut by a killed run so the next entry starts on its own line
+                with open(index_path, 'a') as file:
+                    file.write('\n')
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run killed while appending
+                    continue
+                if os.path.exists(os.path.join(path, entry['file'])):
+                    self.entries[entry['key']] = entry['file']
+
+    @staticmethod
+    def key(tomogram_path, bank_hash):
+        """
+        :param tomogram_path: Path of the tomogram.
+        :param bank_hash: Hash of the templates the features are computed with, see Hashing.templates_hash.
+        :return: The key of the tomogram's entry, from its path, its content and the templates.
+        """
+        identity = json.dumps([os.path.abspath(tomogram_path), file_hash(tomogram_path), bank_hash])
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, key):
+        """
+        :return: A tuple of the feature matrix and the labels of the entry.
+        """
+        with np.load(os.path.join(self.path, self.entries[key])) as entry:
+            return entry['x'], entry['y']
+
+    def append(self, key, tomogram_path, x, y):
+        """
+        Save the features and the labels of a tomogram.
+        :param key: The entry key, see key.
+        :param tomogram_path: Path of the tomogram, kept for reference.
+        :param x: Feature matrix, a row per candidate.
+        :param y: The labels of the candidates.
+        """
+        file_name = key + '.npz'
+
+        def write(temporary_path):
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, x=x, y=y)
+        atomic_write(os.path.join(self.path, file_name), write)
+
+        with open(os.path.join(self.path, INDEX_NAME), 'a') as file:
+            file.write(json.dumps({'key': key, 'file': file_name, 'tomogram_path': tomogram_path,
+                                   'candidates': len(y)}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.entries[key] = file_name
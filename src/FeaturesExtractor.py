@@ -1,22 +1,72 @@
 from scipy import signal
+import numpy as np
+
+import Profiling
 
 
 class FeaturesExtractor:
-    def __init__(self, templates):
+    def __init__(self, templates, correlation_cache=None):
         self.templates = templates
+        self.correlation_cache = correlation_cache      # optional CorrelationCache
+
+    def template_feature(self, tomogram, candidate, template_index):
+        volumes = self.correlation_cache.volumes(tomogram, self.templates) if self.correlation_cache is not None else None
+        if volumes is not None:
+            scores, _ = volumes
+            return max(0, float(scores[template_index][candidate.six_position.COM_position]))
+
+        max_correlation = 0
+        Profiling.count(Profiling.FFTS, len(self.templates[template_index]))
+        for tilted_template in self.templates[template_index]:
+            correlation = signal.fftconvolve(tomogram.density_map, tilted_template.density_map, mode='same')
+            #pos = tuple([candidate.six_position.COM_position[0], candidate.six_position.COM_position[1]])
+            max_correlation = max(max_correlation, correlation[candidate.six_position.COM_position])
+        return max_correlation
 
     def extract_features(self, tomogram, candidate, set_features=True):
         features_vector = []
-        for template_group in self.templates:
-            max_correlation = 0
-            for tilted_template in template_group:
-                correlation = signal.fftconvolve(tomogram.density_map, tilted_template.density_map, mode='same')
-                #pos = tuple([candidate.six_position.COM_position[0], candidate.six_position.COM_position[1]])
-                max_correlation = max(max_correlation, correlation[candidate.six_position.COM_position])
-            features_vector.append(max_correlation)
+        for template_index in range(len(self.templates)):
+            features_vector.append(self.template_feature(tomogram, candidate, template_index))
+        if set_features:
+            candidate.set_features(features_vector)
+        return features_vector
+
+
+class LazyFeaturesExtractor(FeaturesExtractor):
+    """
+    Computes the features in the order of the templates discriminative power and stops as soon as the staged
+    classifier is confident. The features which were not computed are left as NaN, the classifier imputes them.
+    """
+
+    def __init__(self, templates, classifier, correlation_cache=None):
+        """
+        :param templates: The templates.
+        :param classifier: A trained StagedClassifier.
+        :param correlation_cache: Optional CorrelationCache.
+        """
+        FeaturesExtractor.__init__(self, templates, correlation_cache)
+        self.classifier = classifier
+        self.features_computed = 0
+        self.candidates_count = 0
+
+    def extract_features(self, tomogram, candidate, set_features=True):
+        features_vector = [np.nan] * len(self.templates)
+        known_count = 0
+        for template_id in self.classifier.feature_order:
+            features_vector[template_id] = self.template_feature(tomogram, candidate, template_id)
+            known_count += 1
+            if self.classifier.confident(features_vector, known_count):
+                break
+
+        self.features_computed += known_count
+        self.candidates_count += 1
         if set_features:
             candidate.set_features(features_vector)
         return features_vector
 
+    def mean_features_computed(self):
+        return self.features_computed / self.candidates_count if self.candidates_count != 0 else 0.0
+
+
 if __name__ == '__main__':
-    print("HI")
\ No newline at end of file
+    print("HI")
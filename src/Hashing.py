@@ -0,0 +1,62 @@
+import hashlib
+import os
+import numpy as np
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """
+    :param path: Path of the file to hash.
+    :return: The hex SHA-256 of the file content, read a block at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def templates_hash(templates):
+    """
+    :param templates: tuple of tuples of TiltedTemplates, or a template bank indexed the same way.
+    :return: The hex SHA-256 of the ids and the density maps of all the tilted templates.
+    """
+    digest = hashlib.sha256()
+    for template_tuple in templates:
+        for tilted in template_tuple:
+            density_map = np.ascontiguousarray(tilted.density_map)
+            digest.update(repr((tilted.template_id, tilted.tilt_id, density_map.shape, density_map.dtype.str)).encode())
+            digest.update(density_map.tobytes())
+    return digest.hexdigest()
+
+
+def array_hash(array):
+    """
+    :param array: numpy array, possibly memory mapped.
+    :return: The hex SHA-256 of the array's shape, dtype and content.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    # A plane at a time so memory mapped arrays are never copied whole
+    for plane in np.atleast_1d(array):
+        digest.update(np.ascontiguousarray(plane).tobytes())
+    return digest.hexdigest()
+
+
+def paths_hash(paths):
+    """
+    :param paths: Paths of files or directories, the files of a directory are hashed in the order of their names.
+    :return: The hex SHA-256 of the contents of all the files, in the order of the paths.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted([os.path.relpath(os.path.join(root, name), path)
+                            for root, _, files in os.walk(path) for name in files])
+            digest.update(repr(names).encode())
+            for name in names:
+                digest.update(file_hash(os.path.join(path, name)).encode())
+        else:
+            digest.update(file_hash(path).encode())
+    return digest.hexdigest()
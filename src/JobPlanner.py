@@ -0,0 +1,375 @@
+import json
+import os
+import pickle
+import numpy as np
+
+import MrcFile
+import PackedTemplates
+import ResultWriter
+import TiledScan
+import MachineProfile
+from CandidateSelector import CandidateSelector, GAUSSIAN_SIZE
+from CommonDataTypes import Tomogram
+from TemplateFactory import TemplateFactory, Generator
+from TomogramFactory import load_tomogram
+from PerfTuner import TILE_SIZES, BATCH_SIZES, calibration_volume
+
+FLOAT_BYTES = np.dtype(np.float64).itemsize
+COMPLEX_BYTES = np.dtype(np.complex128).itemsize
+
+# Bytes of a candidate row of the result formats: the records of CandidateTable, and a particle line of the text
+# formats besides the tomogram path
+NPZ_ROW_BYTES = 28
+STAR_ROW_BYTES = 40
+COORDS_ROW_BYTES = 30
+# Bytes of a Candidate object in the pickle of a tomogram
+PICKLED_CANDIDATE_BYTES = 300
+# Side of the center of a tomogram on which the candidates are selected to estimate their number
+SAMPLE_SIDE = 64
+
+
+class TomogramHeader:
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = tuple(shape)       # x, y, z, z is 1 for 2D tomograms
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def voxels(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def dim(self):
+        return 2 if self.shape[2] == 1 else 3
+
+
+class BankHeader:
+    def __init__(self, tilt_counts, kernel_shape, nbytes):
+        self.tilt_counts = tilt_counts      # number of tilts of every template
+        self.kernel_shape = tuple([int(side) for side in kernel_shape])
+        self.nbytes = nbytes
+
+    @property
+    def templates(self):
+        return len(self.tilt_counts)
+
+    @property
+    def tilts(self):
+        return sum(self.tilt_counts)
+
+
+def read_tomogram_header(path):
+    """
+    :return: The TomogramHeader of an MRC file, read from its header alone. Pickled tomograms have no header so they are
+    loaded.
+    """
+    if MrcFile.is_mrc_path(path):
+        header = MrcFile.read_header(path)
+        return TomogramHeader(path, header.shape, header.dtype)
+    with open(path, 'rb') as file:
+        density_map = pickle.load(file).density_map
+    return TomogramHeader(path, density_map.shape, density_map.dtype)
+
+
+def read_bank_header(paths):
+    """
+    :param paths: Paths of the templates, packed banks (read from their header alone) or pickles (loaded).
+    :return: The BankHeader of all the templates together, with the largest kernel shape.
+    """
+    tilt_counts, kernel_shapes, nbytes = [], [], 0
+    for path in paths:
+        if PackedTemplates.is_packed(path):
+            header, _ = PackedTemplates.read_header(path)
+            shape = header['shape']
+            tilt_counts += [shape[1]] * shape[0]
+            kernel_shapes.append(shape[2:])
+            nbytes += int(np.prod(shape)) * np.dtype(header['dtype']).itemsize
+            continue
+        with open(path, 'rb') as file:
+            template = pickle.load(file)
+        tilt_counts.append(len(template))
+        kernel_shapes += [tilted.density_map.shape for tilted in template]
+        nbytes += sum([tilted.density_map.nbytes for tilted in template])
+    return BankHeader(tilt_counts, np.max(kernel_shapes, axis=0), nbytes)
+
+
+def complex_bytes(padded_shape):
+    # A real FFT keeps half of the last axis
+    return int(np.prod(padded_shape[:-1])) * (padded_shape[-1] // 2 + 1) * COMPLEX_BYTES if padded_shape else 0
+
+
+def scan_shapes(shape, kernel_shape, tile_size):
+    """
+    :return: The shape of the largest region convolved and the padded shapes of all the regions, see TiledScan.regions.
+    """
+    regions = [tuple([piece.stop - piece.start for piece in region])
+               for _, region, _ in TiledScan.regions(shape, tile_size, kernel_shape)]
+    largest = max(regions, key=lambda region: np.prod(region))
+    return largest, sorted(set([TiledScan.fft_shape(region, kernel_shape) for region in regions]))
+
+
+def scan_bytes(shape, kernel_shape, tile_size, batch_size):
+    """
+    Model of the memory allocated by TiledScan.max_correlation besides its result: the FFTs of the batch of kernels
+    kept for every padded shape, and for the largest region its FFT, the products, the inverse transforms (which copy
+    the products) and the maximum over the batch.
+    """
+    region, padded_shapes = scan_shapes(shape, kernel_shape, tile_size)
+    padded = max(padded_shapes, key=lambda padded_shape: np.prod(padded_shape))
+    kernels = batch_size * sum([complex_bytes(padded_shape) for padded_shape in padded_shapes])
+    return kernels + (1 + 2 * batch_size) * complex_bytes(padded) + \
+        batch_size * int(np.prod(padded)) * FLOAT_BYTES + 2 * int(np.prod(region)) * FLOAT_BYTES
+
+
+def blur_bytes(shape, dim):
+    kernel_shape = (GAUSSIAN_SIZE, GAUSSIAN_SIZE, GAUSSIAN_SIZE if dim == 3 else 1)
+    return scan_bytes(shape, kernel_shape, None, 1)
+
+
+def memory_factor(profile, kernel_shape, tile_size, batch_size):
+    """
+    :return: The ratio of the peak the machine profile measured for the scan settings to the model's, at least 1. 1
+    without a measurement.
+    """
+    if profile is None:
+        return 1.0
+    for scan in profile.get('scans', []):
+        if scan['tile_size'] == tile_size and scan['batch_size'] == batch_size:
+            modeled = scan_bytes(tuple(profile['calibration']['shape']), kernel_shape, tile_size, batch_size)
+            return max(1.0, scan['peak_bytes'] / modeled)
+    return 1.0
+
+
+def peak_bytes(tomogram, bank, tile_size, batch_size, profile=None):
+    """
+    :return: The peak bytes of a worker evaluating the tomogram: the bank, the tomogram and its max correlation, and
+    the largest of the scan and the blur (which also holds the blurred correlation).
+    """
+    scan = scan_bytes(tomogram.shape, bank.kernel_shape, tile_size, batch_size) * \
+        memory_factor(profile, bank.kernel_shape, tile_size, batch_size)
+    blur = blur_bytes(tomogram.shape, tomogram.dim) + tomogram.voxels * FLOAT_BYTES
+    return int(bank.nbytes + tomogram.voxels * (tomogram.dtype.itemsize + FLOAT_BYTES) + max(scan, blur))
+
+
+def fft_count(bank, tile_size, batch_size, candidates):
+    # Counted as Profiling.FFTS: the scan (a convolution per tilt, the first one twice by the whole volume scan), the
+    # blur, and the feature extraction convolving the whole volume with every tilt for every candidate
+    return bank.tilts + (1 if tile_size is None and batch_size == 1 else 0) + 1 + candidates * bank.tilts
+
+
+def correlation_count(bank, candidates):
+    # Counted as Profiling.CORRELATIONS: the tilt finder correlates the whole volume with every tilt of the template of
+    # a particle, at most every candidate is one
+    return int(round(candidates * bank.tilts / float(bank.templates)))
+
+
+def selection_density(templates, tomogram_path, side=SAMPLE_SIDE):
+    """
+    Run the candidate selection on the center of the tomogram, at least four kernels wide.
+    :param templates: The loaded templates.
+    :return: The candidates selected per voxel.
+    """
+    density_map = load_tomogram(tomogram_path).density_map
+    kernel_side = max([max(tilted.density_map.shape) for template in templates for tilted in template])
+    sample = calibration_volume(density_map, max(side, 4 * kernel_side))
+    selector = CandidateSelector(templates, 2 if sample.shape[2] == 1 else 3,
+                                 scan_settings=MachineProfile.DEFAULT_SETTINGS)
+    return len(selector.select(Tomogram(sample, ()))) / float(sample.size)
+
+
+def estimated_candidates(tomogram, density):
+    """
+    :param density: Candidates per voxel, see selection_density.
+    :return: The expected number of candidates.
+    """
+    return int(round(tomogram.voxels * density))
+
+
+def output_bytes(out_path, tomogram, bank, candidates):
+    """
+    :return: The bytes written for the tomogram, uncompressed for .npz.
+    """
+    lower_path = str(out_path).lower()
+    if lower_path.endswith(ResultWriter.NPZ_EXTENSION):
+        return candidates * (NPZ_ROW_BYTES + bank.templates * FLOAT_BYTES)
+    if lower_path.endswith(ResultWriter.STAR_EXTENSION):
+        return candidates * (STAR_ROW_BYTES + len(os.path.abspath(tomogram.path)))
+    if lower_path.endswith(ResultWriter.COORDS_EXTENSIONS):
+        return candidates * COORDS_ROW_BYTES
+    # The legacy outputs hold the whole tomogram
+    return MrcFile.HEADER_SIZE + tomogram.voxels * tomogram.dtype.itemsize + \
+        (0 if MrcFile.is_mrc_path(out_path) else candidates * PICKLED_CANDIDATE_BYTES)
+
+
+def scan_rate(profile, bench, tile_size, batch_size, dim):
+    """
+    :return: Voxels times tilts scanned per second, from the machine profile's scan with the settings or else the select
+    stage of the benchmark results. None without either.
+    """
+    scans = [scan for scan in (profile.get('scans', []) if profile is not None else [])
+             if scan['tile_size'] == tile_size and scan['batch_size'] == batch_size]
+    if scans:
+        calibration = profile['calibration']
+        return scans[0]['voxels_per_second'] * calibration['templates'] * calibration['tilts']
+    if bench is not None:
+        rates = [case['size'] ** case['dim'] * case['templates'] * case['tilts'] / case['stages']['select']['seconds']
+                 for case in bench['cases'].values() if case['dim'] == dim and case['stages'].get('select')]
+        if rates:
+            return float(np.median(rates))
+    return None
+
+
+def estimated_seconds(tomogram, bank, rate, whole_rate, ffts, correlations):
+    """
+    :param rate: The scan rate of the settings, see scan_rate.
+    :param whole_rate: The scan rate of whole volumes a tilt at a time, the cost of a feature FFT or a correlation.
+    :return: The seconds of the scan, the feature extraction and the tilt finding of the tomogram.
+    """
+    scan_ffts = fft_count(bank, None, 1, 0)
+    return tomogram.voxels * bank.tilts / rate + tomogram.voxels * (ffts - scan_ffts + correlations) / whole_rate
+
+
+def speedup(profile, workers):
+    # The throughput of the workers measured by tune-perf relative to a single one, else linear
+    if profile is None or not profile.get('scaling'):
+        return float(workers)
+    scaling = dict([(point['workers'], point['scans_per_second']) for point in profile['scaling']])
+    measured = [count for count in scaling if count <= workers]
+    if 1 not in scaling or not measured:
+        return float(workers)
+    return scaling[max(measured)] / scaling[1]
+
+
+def settings_to_try(tile_size, batch_size, profile, shape):
+    """
+    :return: The scan settings to try in order: the given ones, then the tilings, the fastest first when the machine
+    profile measured them and else the largest tile first.
+    """
+    tilings = [(tile, batch) for tile in TILE_SIZES if tile < max(shape) for batch in BATCH_SIZES]
+    speed = {}
+    if profile is not None:
+        speed = dict([((scan['tile_size'], scan['batch_size']), scan['voxels_per_second'])
+                      for scan in profile.get('scans', [])])
+    tilings.sort(key=lambda setting: (-speed.get(setting, 0), -setting[0], setting[1]))
+    return [(tile_size, batch_size)] + [setting for setting in tilings if setting != (tile_size, batch_size)]
+
+
+def plan(template_paths, tomogram_paths, out_paths=None, workers=None, memory_limit=None,
+         profile_path=MachineProfile.DEFAULT_PATH, bench_path=None):
+    """
+    Estimate the cost of evaluating the tomograms from the headers of the tomograms and the templates. Only the
+    number of candidates is measured, by selecting them on the center of the first tomogram of every dimension (see
+    selection_density). When a worker would go over its share of the memory limit the scan is tiled, and failing that
+    the workers are fewer.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_paths: List of paths to the tomograms.
+    :param out_paths: The eval output paths, None to skip the disk estimate.
+    :param workers: Number of worker processes, default is the machine profile's.
+    :param memory_limit: Maximal bytes of all the workers together, default is the machine profile's memory ceiling.
+    :param profile_path: Path of the machine profile, see PerfTuner.tune.
+    :param bench_path: Optional results of "Main.py bench" to time the scan when the machine profile does not.
+    :return: The plan dictionary: the settings, whether they fit the limit, and the estimates of every tomogram and in
+    total. Seconds are None when neither the profile nor the benchmark results can time the scan.
+    """
+    profile = MachineProfile.load(profile_path)
+    bench = None
+    if bench_path is not None:
+        with open(bench_path) as file:
+            bench = json.load(file)
+    settings = MachineProfile.settings(profile_path)
+    workers = min(workers if workers is not None else settings['workers'], len(tomogram_paths))
+    if memory_limit is None and profile is not None:
+        memory_limit = profile.get('memory_ceiling')
+
+    bank = read_bank_header(template_paths)
+    tomograms = [read_tomogram_header(path) for path in tomogram_paths]
+
+    def job_bytes(option):
+        return max([peak_bytes(tomogram, bank, option[0], option[1], profile) for tomogram in tomograms])
+
+    # The first settings and worker count under the limit, else the settings using the least memory
+    largest_shape = tuple(np.max([tomogram.shape for tomogram in tomograms], axis=0))
+    options = [(tile, batch, count) for count in range(workers, 0, -1)
+               for tile, batch in settings_to_try(settings['tile_size'], settings['batch_size'], profile,
+                                                  largest_shape)]
+    fits = True
+    for tile_size, batch_size, count in options:
+        if memory_limit is None or job_bytes((tile_size, batch_size)) * count <= memory_limit:
+            break
+    else:
+        fits = False
+        tile_size, batch_size, count = min([option for option in options if option[2] == 1], key=job_bytes)
+
+    templates = list(TemplateFactory(Generator.LOAD).set_paths(template_paths).build())
+    densities = {}      # dimension -> candidates per voxel
+    estimates = []
+    for index, tomogram in enumerate(tomograms):
+        if tomogram.dim not in densities:
+            densities[tomogram.dim] = selection_density(templates, tomogram.path)
+        rate = scan_rate(profile, bench, tile_size, batch_size, tomogram.dim)
+        whole_rate = scan_rate(profile, bench, None, 1, tomogram.dim) or rate
+        candidates = estimated_candidates(tomogram, densities[tomogram.dim])
+        ffts = fft_count(bank, tile_size, batch_size, candidates)
+        correlations = correlation_count(bank, candidates)
+        estimates.append({
+            'path': tomogram.path, 'shape': list(tomogram.shape), 'dtype': tomogram.dtype.str,
+            'fft_count': ffts, 'correlations': correlations,
+            'padded_shapes': [list(shape) for shape in scan_shapes(tomogram.shape, bank.kernel_shape, tile_size)[1]],
+            'peak_bytes': peak_bytes(tomogram, bank, tile_size, batch_size, profile), 'candidates': candidates,
+            'output_bytes': output_bytes(out_paths[index], tomogram, bank, candidates)
+            if out_paths is not None else None,
+            'seconds': estimated_seconds(tomogram, bank, rate, whole_rate, ffts, correlations)
+            if rate is not None else None})
+
+    seconds = [estimate['seconds'] for estimate in estimates]
+    return {'templates': bank.templates, 'tilts': bank.tilts, 'kernel_shape': list(bank.kernel_shape),
+            'bank_bytes': bank.nbytes, 'memory_limit': memory_limit, 'fits': fits,
+            'settings': {'tile_size': tile_size, 'batch_size': batch_size, 'workers': count},
+            'adjusted': (tile_size, batch_size, count) != (settings['tile_size'], settings['batch_size'], workers),
+            'tomograms': estimates, 'peak_bytes_per_worker': max([estimate['peak_bytes'] for estimate in estimates]),
+            'output_bytes': sum([estimate['output_bytes'] for estimate in estimates])
+            if out_paths is not None else None,
+            'fft_count': sum([estimate['fft_count'] for estimate in estimates]),
+            'correlations': sum([estimate['correlations'] for estimate in estimates]),
+            'wall_seconds': sum(seconds) / speedup(profile, count) if None not in seconds else None}
+
+
+def megabytes(nbytes):
+    return '%.1f MB' % (nbytes / float(1 << 20))
+
+
+def shapes_text(shapes):
+    # The tiles of a volume have a few padded shapes, list them up to the largest
+    text = ['x'.join(map(str, shape)) for shape in shapes]
+    return ', '.join(text) if len(text) <= 3 else '%d shapes up to %s' % (len(text), text[-1])
+
+
+def print_plan(job_plan):
+    print('%d templates, %d tilts of up to %s voxels, %s' %
+          (job_plan['templates'], job_plan['tilts'], 'x'.join(map(str, job_plan['kernel_shape'])),
+           megabytes(job_plan['bank_bytes'])))
+    for estimate in job_plan['tomograms']:
+        print('%s %s %s: %d FFTs padded to %s, %d correlations, peak %s, ~%d candidates%s%s' %
+              (estimate['path'], 'x'.join(map(str, estimate['shape'])), estimate['dtype'], estimate['fft_count'],
+               shapes_text(estimate['padded_shapes']), estimate['correlations'],
+               megabytes(estimate['peak_bytes']), estimate['candidates'],
+               ', output %s' % megabytes(estimate['output_bytes']) if estimate['output_bytes'] is not None else '',
+               ', %.1fs' % estimate['seconds'] if estimate['seconds'] is not None else ''))
+    settings = job_plan['settings']
+    print('Tile size %s, batch size %d, %d workers%s' % (settings['tile_size'], settings['batch_size'],
+                                                         settings['workers'],
+                                                         ' (adjusted to the memory limit)'
+                                                         if job_plan['adjusted'] else ''))
+    print('Peak memory per worker %s, %s together%s' %
+          (megabytes(job_plan['peak_bytes_per_worker']),
+           megabytes(job_plan['peak_bytes_per_worker'] * settings['workers']),
+           ' of the %s limit' % megabytes(job_plan['memory_limit']) if job_plan['memory_limit'] is not None else ''))
+    print('%d FFTs and %d correlations in total%s' %
+          (job_plan['fft_count'], job_plan['correlations'],
+           ', output %s' % megabytes(job_plan['output_bytes']) if job_plan['output_bytes'] is not None else ''))
+    if job_plan['wall_seconds'] is not None:
+        print('Expected wall time %.1fs' % job_plan['wall_seconds'])
+    else:
+        print('No wall time estimate, run tune-perf or pass benchmark results')
+    if not job_plan['fits']:
+        print('The job does not fit the memory limit with any tiling on a single worker')
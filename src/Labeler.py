@@ -3,12 +3,17 @@ from Constants import JUNK_ID, DISTANCE_THRESHOLD
 import numpy as np
 
 class Labeler:
+    # whether the candidates features must be extracted before labeling
+    needs_features = False
+
     #make abstract method
     #find out the appropriate label
     def label(self, candidate):
         return None
 
 class PositionLabeler:
+    needs_features = False
+
     def __init__(self, composition):
         self.composition = composition
         #elements of composition who were found during labeling
@@ -28,6 +33,8 @@ class PositionLabeler:
 
 
 class SvmLabeler(Labeler):
+    needs_features = True
+
     def __init__(self, svm):
         self.svm = svm
 
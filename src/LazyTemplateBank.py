@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import sqrt
+import threading
+import pickle
+import os
+import numpy as np
+
+from CommonDataTypes import TiltedTemplate
+import PackedTemplates
+
+DEFAULT_BYTE_BUDGET = 1 << 30   # 1 GB
+DEFAULT_PREFETCH_WORKERS = 2
+
+
+class DirectorySource:
+    """
+    Reads tilts from the directory layout of load_templates_3d, a <template_id>_<tilt_id>.npy file per tilt.
+    """
+    def __init__(self, templates_path):
+        self.templates_path = templates_path
+        with open(os.path.join(templates_path, 'template_ids.p'), 'rb') as file:
+            self.template_ids = pickle.load(file)
+        with open(os.path.join(templates_path, 'tilt_ids.p'), 'rb') as file:
+            self.tilt_ids = pickle.load(file)
+        self.template_keys = sorted(self.template_ids.keys())
+        self.tilt_keys = sorted(self.tilt_ids.keys())
+
+    def load(self, template_index, tilt_index):
+        return np.load(os.path.join(self.templates_path, '%s_%s.npy' % (self.template_keys[template_index],
+                                                                       self.tilt_keys[tilt_index])))
+
+
+class PackedSource:
+    """
+    Reads tilts from a packed template bank.
+    """
+    def __init__(self, path):
+        self.data, self.template_ids, self.tilt_ids = PackedTemplates.open_packed(path)
+        self.template_keys = sorted(self.template_ids.keys())
+        self.tilt_keys = sorted(self.tilt_ids.keys())
+
+    def load(self, template_index, tilt_index):
+        return np.array(self.data[template_index, tilt_index])
+
+
+def open_source(path):
+    return DirectorySource(path) if os.path.isdir(path) else PackedSource(path)
+
+
+def normalize_transform(density_map):
+    # Same as NormalizedTemplateFactory, divide by the L2 norm
+    factor = sqrt(np.sum(np.square(density_map)))
+    if factor == 0:
+        print("Error normalizing template: L2 norm is zero")
+        return density_map
+    return density_map / factor
+
+
+def fft_transform(shape):
+    """
+    :param shape: The padded shape of the spectra, usually the tomogram shape.
+    :return: A transform replacing the density map with its real FFT at the padded shape.
+    """
+    return lambda density_map: np.fft.rfftn(density_map, shape)
+
+
+class LazyTemplateGroup:
+    """
+    The tilts of a single template, loaded on access. Behaves like the tuple of TiltedTemplates it replaces.
+    """
+    def __init__(self, bank, template_index):
+        self.bank = bank
+        self.template_index = template_index
+
+    def __len__(self):
+        return len(self.bank.source.tilt_keys)
+
+    def __getitem__(self, tilt_index):
+        if isinstance(tilt_index, slice):
+            return tuple([self[i] for i in range(*tilt_index.indices(len(self)))])
+        if tilt_index < 0:
+            tilt_index += len(self)
+        if not 0 <= tilt_index < len(self):
+            raise IndexError('tilt index %d out of range' % tilt_index)
+        return self.bank.get(self.template_index, tilt_index)
+
+    def __iter__(self):
+        for tilt_index in range(len(self)):
+            yield self[tilt_index]
+
+    def prefetch(self):
+        self.bank.prefetch(self.template_index)
+
+
+class LazyTemplateBank:
+    """
+    A template bank indexed like the tuple of tuples of TiltedTemplates (templates[template_id][tilt_id]) that loads
+    the tilts on first access and keeps them in an LRU cache limited by bytes.
+    """
+
+    def __init__(self, source, transform=None, byte_budget=DEFAULT_BYTE_BUDGET,
+                 prefetch_workers=DEFAULT_PREFETCH_WORKERS):
+        """
+        :param source: A DirectorySource, a PackedSource or a path to open as one.
+        :param transform: Optional function applied to every density map when it is loaded (e.g. normalize_transform).
+        :param byte_budget: Maximal number of bytes of density maps kept in the cache.
+        :param prefetch_workers: Number of threads loading the prefetched tilts.
+        """
+        self.source = open_source(source) if isinstance(source, str) else source
+        self.template_ids = self.source.template_ids
+        self.tilt_ids = self.source.tilt_ids
+        self.transform = transform
+        self.byte_budget = byte_budget
+        self.prefetch_workers = prefetch_workers
+
+        self.cache = OrderedDict()      # (template_index, tilt_index) -> TiltedTemplate, least recently used first
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = {}               # (template_index, tilt_index) -> Future of the prefetch
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.source.template_keys)
+
+    def __getitem__(self, template_index):
+        if isinstance(template_index, slice):
+            return tuple([self[i] for i in range(*template_index.indices(len(self)))])
+        if template_index < 0:
+            template_index += len(self)
+        if not 0 <= template_index < len(self):
+            raise IndexError('template index %d out of range' % template_index)
+        return LazyTemplateGroup(self, template_index)
+
+    def __iter__(self):
+        for template_index in range(len(self)):
+            yield self[template_index]
+
+    # The cache and the prefetch futures are not picklable, a copy starts empty
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(cache=OrderedDict(), cached_bytes=0, lock=None, executor=None, pending={})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def load(self, template_index, tilt_index):
+        density_map = self.source.load(template_index, tilt_index)
+        if self.transform is not None:
+            density_map = self.transform(density_map)
+        return TiltedTemplate(density_map, self.source.tilt_keys[tilt_index], self.source.template_keys[template_index])
+
+    def insert(self, key, tilted):
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            self.cache[key] = tilted
+            self.cached_bytes += tilted.density_map.nbytes
+            # Evict the least recently used tilts, never the one just inserted
+            while self.cached_bytes > self.byte_budget and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= evicted.density_map.nbytes
+                self.evictions += 1
+            return tilted
+
+    def get(self, template_index, tilt_index):
+        key = (template_index, tilt_index)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+            future = self.pending.get(key)
+
+        if future is not None:
+            return self.insert(key, future.result())
+        return self.insert(key, self.load(template_index, tilt_index))
+
+    def prefetch(self, template_index, tilt_indices=None):
+        """
+        Hint that the tilts are about to be used, they are loaded in the background.
+        :param template_index: The template to prefetch.
+        :param tilt_indices: The tilts to prefetch, all the tilts if None.
+        """
+        if self.prefetch_workers == 0:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+        if tilt_indices is None:
+            tilt_indices = range(len(self.source.tilt_keys))
+
+        submitted = []
+        with self.lock:
+            for tilt_index in tilt_indices:
+                key = (template_index, tilt_index)
+                if key in self.cache or key in self.pending:
+                    continue
+                self.pending[key] = self.executor.submit(self.load, template_index, tilt_index)
+                submitted.append(key)
+
+        # Outside the lock, a callback of a finished future runs right away in this thread
+        for key in submitted:
+            self.pending[key].add_done_callback(lambda done, key=key: self.prefetch_done(key, done))
+
+    def prefetch_done(self, key, future):
+        if future.exception() is None:
+            self.insert(key, future.result())
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'cached_bytes': self.cached_bytes, 'cached_tilts': len(self.cache)}
+
+
+if __name__ == '__main__':
+    import sys
+    bank = LazyTemplateBank(sys.argv[1], transform=normalize_transform, byte_budget=1 << 20)
+    for template_group in bank:
+        for tilted in template_group:
+            pass
+    print(bank.stats())
@@ -0,0 +1,73 @@
+import json
+import os
+
+from Pipeline import atomic_write
+
+# Written by "Main.py tune-perf" and loaded by the scanning engine
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cryoem', 'machine_profile.json')
+
+# The settings without a profile: every tomogram scanned whole, a tilt at a time, in a single process
+DEFAULT_SETTINGS = {'tile_size': None, 'batch_size': 1, 'workers': 1}
+
+# A worker count is good enough when it reaches this fraction of the best measured throughput
+SCALING_TOLERANCE = 0.9
+
+
+def load(path=DEFAULT_PATH):
+    """
+    :return: The machine profile, None when there is none or it cannot be read.
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save(path, profile):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    def write(temporary_path):
+        with open(temporary_path, 'w') as file:
+            json.dump(profile, file, indent=2)
+    atomic_write(path, write)
+
+
+def settings(path=DEFAULT_PATH):
+    """
+    :return: Dictionary of the tile size, the batch size and the worker count of the machine profile, the defaults
+    for those it does not set.
+    """
+    profile = load(path)
+    return dict(DEFAULT_SETTINGS, **(profile.get('settings', {}) if profile is not None else {}))
+
+
+def choose_scan(scans, memory_ceiling=None):
+    """
+    :param scans: The measured scan configurations, dictionaries of the tile size, the batch size, the voxels scanned
+    per second and the peak bytes, on the calibration crop and scaled to the whole sample tomogram.
+    :param memory_ceiling: Maximal peak bytes on the whole sample tomogram, None for no limit.
+    :return: The fastest configuration within the ceiling, the one using the least memory when none is.
+    """
+    peak = lambda scan: scan.get('tomogram_peak_bytes', scan['peak_bytes'])
+    fitting = [scan for scan in scans if memory_ceiling is None or peak(scan) <= memory_ceiling]
+    if not fitting:
+        return min(scans, key=peak)
+    return max(fitting, key=lambda scan: scan['voxels_per_second'])
+
+
+def choose_workers(scaling, job_bytes, memory_ceiling=None):
+    """
+    :param scaling: List of dictionaries of a worker count and the scans per second it reached.
+    :param job_bytes: Peak bytes of a single worker.
+    :param memory_ceiling: Maximal bytes of all the workers together, None for no limit.
+    :return: The fewest workers reaching SCALING_TOLERANCE of the best throughput, within the ceiling.
+    """
+    limit = max(1, memory_ceiling // job_bytes) if memory_ceiling is not None and job_bytes > 0 else None
+    allowed = [point for point in scaling if limit is None or point['workers'] <= limit]
+    if not allowed:
+        return 1
+    best = max([point['scans_per_second'] for point in allowed])
+    return min([point['workers'] for point in allowed if point['scans_per_second'] >= SCALING_TOLERANCE * best])
@@ -1,67 +1,519 @@
 import sys
+import json
 import argparse
-from TemplateFactory import Generator
-from SvmTrain import svm_train
-from SvmEval import svm_eval
+import Profiling
+import MachineProfile
+
+# The commands and their arguments import the modules they need when they run, so that the help and the light
+# commands do not load sklearn, scipy and the whole pipeline.
+
+MEGABYTE = 1 << 20
 
 # TODO: Add generate subcommand
-SUPPORTED_COMMANDS = ('train', 'eval')  # , 'generate')
+SUPPORTED_COMMANDS = ('train', 'eval', 'tune', 'serve', 'shard', 'worker', 'merge', 'bench',
+                      'sweep', 'tune-perf', 'plan')  # , 'generate')
+
+
+def correlation_cache_bytes(args):
+    from CorrelationCache import DEFAULT_CACHE_BYTES
+    return args.correlation_cache_size[0] * MEGABYTE if args.correlation_cache_size is not None else DEFAULT_CACHE_BYTES
+
+
+def bench(args):
+    from benchmarks import StageBench, ImportBench
+    if args.imports:
+        results = ImportBench.run_import_benchmarks(repeat=args.repeat[0] if args.repeat is not None
+                                                    else ImportBench.DEFAULT_REPEAT)
+        ImportBench.print_results(results)
+        compare_results = ImportBench.compare_results
+    else:
+        cases = StageBench.case_matrix(
+            dims=args.dims if args.dims is not None else StageBench.DEFAULT_DIMS,
+            sizes_2d=args.sizes if args.sizes is not None else StageBench.DEFAULT_SIZES_2D,
+            sizes_3d=args.sizes_3d if args.sizes_3d is not None else StageBench.DEFAULT_SIZES_3D,
+            template_counts=args.template_counts if args.template_counts is not None
+            else StageBench.DEFAULT_TEMPLATE_COUNTS,
+            tilt_counts=args.tilt_counts if args.tilt_counts is not None else StageBench.DEFAULT_TILT_COUNTS)
+        results = StageBench.run_benchmarks(cases, repeat=args.repeat[0] if args.repeat is not None
+                                            else StageBench.DEFAULT_REPEAT,
+                                            seed=args.seed[0] if args.seed is not None else StageBench.DEFAULT_SEED)
+        StageBench.print_results(results)
+        compare_results = StageBench.compare_results
+    if args.out_path is not None:
+        StageBench.save_results(args.out_path[0], results)
+        print('Saved the results to %s' % args.out_path[0])
+    if args.baseline_path is not None:
+        baseline = StageBench.load_results(args.baseline_path[0])
+        if baseline['environment'] != results['environment']:
+            print('Warning: the baseline was run in another environment %s' % baseline['environment'])
+        if 'cases' in results and baseline.get('scan_settings') != results.get('scan_settings'):
+            print('Warning: the baseline was run with other scan settings %s' % baseline.get('scan_settings'))
+        comparisons = compare_results(results, baseline, threshold=args.threshold[0]
+                                      if args.threshold is not None else StageBench.DEFAULT_THRESHOLD)
+        StageBench.print_comparisons(comparisons)
+        regressions = [comparison for comparison in comparisons if comparison['regression']]
+        if regressions:
+            print('%d regressions against %s' % (len(regressions), args.baseline_path[0]))
+            sys.exit(1)
+    if args.imports:
+        for command, modules in ImportBench.heavy_imports(results):
+            print('The light command %s loads %s' % (command, ' '.join(modules)))
+        if ImportBench.heavy_imports(results):
+            sys.exit(1)
+
+
+def sweep(args):
+    from benchmarks import AccuracySweep
+    configs = AccuracySweep.config_grid(
+        tilt_counts=args.tilt_counts if args.tilt_counts is not None else AccuracySweep.DEFAULT_TILT_COUNTS,
+        binnings=args.binnings if args.binnings is not None else AccuracySweep.DEFAULT_BINNINGS,
+        thresholds=args.thresholds if args.thresholds is not None else AccuracySweep.DEFAULT_THRESHOLDS,
+        dtypes=args.dtypes if args.dtypes is not None else AccuracySweep.DEFAULT_DTYPES)
+    results = AccuracySweep.run_sweep(
+        configs, n_tomograms=args.tomograms[0] if args.tomograms is not None else AccuracySweep.DEFAULT_TOMOGRAMS,
+        size=args.size[0] if args.size is not None else AccuracySweep.DEFAULT_SIZE,
+        n_templates=args.templates[0] if args.templates is not None else AccuracySweep.DEFAULT_TEMPLATES,
+        noise=not args.clean, seed=args.seed[0] if args.seed is not None else AccuracySweep.DEFAULT_SEED)
+    AccuracySweep.print_pareto_table(results)
+    if args.out_path is not None:
+        AccuracySweep.save_sweep(args.out_path[0], results)
+        print('Saved the results to %s' % args.out_path[0])
+
+
+def plan(args):
+    import JobPlanner
+    job_plan = JobPlanner.plan(args.template_paths, args.tomogram_paths, out_paths=args.out_path,
+                               workers=args.jobs[0] if args.jobs is not None else None,
+                               memory_limit=args.memory_limit[0] * MEGABYTE if args.memory_limit is not None else None,
+                               profile_path=args.machine_profile_path[0] if args.machine_profile_path is not None
+                               else MachineProfile.DEFAULT_PATH,
+                               bench_path=args.bench_path[0] if args.bench_path is not None else None)
+    JobPlanner.print_plan(job_plan)
+    if args.save_path is not None:
+        with open(args.save_path[0], 'w') as file:
+            json.dump(job_plan, file, indent=2)
+        print('Saved the plan to %s' % args.save_path[0])
+    if not job_plan['fits']:
+        sys.exit(1)
+
+
+def eval_settings(args):
+    """
+    :return: A tuple of the number of workers and the scan settings of the evaluation. With --memorylimit, or a memory
+    ceiling in the machine profile, the job is planned first on the real tomogram sizes and refused when it cannot fit,
+    see JobPlanner.plan.
+    """
+    n_jobs = args.jobs[0] if args.jobs is not None else MachineProfile.settings()['workers']
+    profile = MachineProfile.load()
+    if args.memory_limit is None and (profile is None or profile.get('memory_ceiling') is None):
+        return n_jobs, None
+    import JobPlanner
+    job_plan = JobPlanner.plan(args.template_paths, args.tomogram_paths, out_paths=args.out_path, workers=n_jobs,
+                               memory_limit=args.memory_limit[0] * MEGABYTE if args.memory_limit is not None else None)
+    if not job_plan['fits']:
+        JobPlanner.print_plan(job_plan)
+        sys.exit(1)
+    settings = job_plan['settings']
+    if job_plan['adjusted']:
+        print('Adjusted to the memory limit: tile size %s, batch size %d, %d workers' %
+              (settings['tile_size'], settings['batch_size'], settings['workers']))
+    return settings['workers'], settings
+
+
+def add_train_arguments(parser):
+    from TemplateFactory import Generator
+    from Classifiers import SUPPORTED_MULTICLASS
+    from CorrelationCache import DEFAULT_CACHE_BYTES
+    parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
+                        help='Path to save in the created svm.')
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
+                        type=str,
+                        required=True,
+                        help='Paths to the templates to be trained with.')
+    parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
+                        required=True,
+                        help='Paths to the tomograms to be trained on. If used with -g only the first path will be '
+                             'used and it will be used to save the generated tomograms into.')
+    parser.add_argument('-g', '--generator', choices=Generator.keys(), dest='template_generator', nargs=1,
+                        type=str,
+                        help='The generator to be used in generation of the templates. Default is LOAD.')
+    parser.add_argument('-s', '--source', dest='source_svm', nargs=1, type=str,
+                        help='An SVM pickle which will be used to start with.')
+    parser.add_argument('-c', '--cascade', dest='cascade', action='store_true',
+                        help='Reject confident junk with a linear prefilter before the SVM.')
+    parser.add_argument('-m', '--multiclass', choices=SUPPORTED_MULTICLASS, dest='multiclass', nargs=1,
+                        type=str,
+                        help='Multiclass strategy, use ovr for banks with many templates. Default is ovo.')
+    parser.add_argument('-k', '--topk', dest='top_k', nargs=1, type=int,
+                        help='Keep only the k best template scores per candidate (ovr only).')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Number of classes trained in parallel (ovr only).')
+    parser.add_argument('-l', '--lazy', dest='lazy', action='store_true',
+                        help='Train staged classifiers so evaluation computes only the features it needs.')
+    parser.add_argument('--checkpoint', dest='checkpoint_path', nargs=1, type=str,
+                        help='Directory in which the features of every tomogram are saved as they are computed. '
+                             'A restarted run skips the tomograms already there. Not with -g.')
+    parser.add_argument('--profile', dest='profile_path', nargs=1, type=str,
+                        help='Save the time of every stage and the counters, per tomogram and in total, to this '
+                             'JSON file.')
+    parser.add_argument('--memory', dest='profile_memory', action='store_true',
+                        help='With --profile, also record the peak memory of every stage and the source lines of '
+                             'its largest allocations. Slows the run down.')
+    parser.add_argument('-f', '--features', dest='features_path', nargs=1, type=str,
+                        help='Fit on the features of an .npz file (from tune -f or merge) built from the same '
+                             'paths instead of extracting them.')
+    parser.add_argument('--corrcache', dest='correlation_cache_path', nargs=1, type=str,
+                        help='Directory caching the correlation volumes of the tomograms with the templates, so '
+                             'runs on the same tomograms and templates skip the correlations.')
+    parser.add_argument('--corrcachesize', dest='correlation_cache_size', nargs=1, type=int,
+                        help='Maximal megabytes of the correlation cache. Default is %d.' %
+                             (DEFAULT_CACHE_BYTES // MEGABYTE))
+
+
+def add_eval_arguments(parser):
+    from CorrelationCache import DEFAULT_CACHE_BYTES
+    parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
+                        help='Path to the pickle of the svm to use.')
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+', type=str,
+                        required=True,
+                        help='Path to the templates to be used by the SVM.')
+    parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
+                        required=True,
+                        help='Path to the tomograms to be evaluated.')
+    parser.add_argument('-o', '--outpath', dest='out_path', nargs='+', type=str, required=True,
+                        help='Path to which the results will be saved. Should have the same number of elements as '
+                             'datapath. Use .npz, .star or .coords for a compact candidate table.')
+    parser.add_argument('--prefetch', dest='prefetch', nargs=1, type=int,
+                        help='Number of tomograms loaded ahead in the background. Default is 1, 0 disables.')
+    parser.add_argument('--memorycap', dest='memory_cap', nargs=1, type=int,
+                        help='Maximal megabytes of tomograms held in memory by the prefetching.')
+    parser.add_argument('--profile', dest='profile_path', nargs=1, type=str,
+                        help='Save the time of every stage and the counters, per tomogram and in total, to this '
+                             'JSON file.')
+    parser.add_argument('--memory', dest='profile_memory', action='store_true',
+                        help='With --profile, also record the peak memory of every stage and the source lines of '
+                             'its largest allocations. Slows the run down.')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Number of tomograms evaluated in parallel by worker processes. Default is the '
+                             'machine profile\'s (see tune-perf), else 1.')
+    parser.add_argument('--corrcache', dest='correlation_cache_path', nargs=1, type=str,
+                        help='Directory caching the correlation volumes of the tomograms with the templates, so '
+                             'runs on the same tomograms and templates skip the correlations.')
+    parser.add_argument('--corrcachesize', dest='correlation_cache_size', nargs=1, type=int,
+                        help='Maximal megabytes of the correlation cache. Default is %d.' %
+                             (DEFAULT_CACHE_BYTES // MEGABYTE))
+    parser.add_argument('--memorylimit', dest='memory_limit', nargs=1, type=int,
+                        help='Maximal megabytes of all the workers together. The job is planned first (see plan) '
+                             'and its scan tiled or its workers reduced to fit, or it is refused.')
+
+
+def add_tune_arguments(parser):
+    from TemplateFactory import Generator
+    from SvmTune import SUPPORTED_SEARCHES
+    parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
+                        help='Path to save in the best svm found.')
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
+                        type=str,
+                        required=True,
+                        help='Paths to the templates to be trained with.')
+    parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
+                        required=True,
+                        help='Paths to the tomograms to be trained on.')
+    parser.add_argument('-g', '--generator', choices=Generator.keys(), dest='template_generator', nargs=1,
+                        type=str,
+                        help='The generator to be used in generation of the templates. Default is LOAD.')
+    parser.add_argument('-f', '--features', dest='features_path', nargs=1, type=str,
+                        help='Path of an .npz file caching the extracted features between runs.')
+    parser.add_argument('--search', choices=SUPPORTED_SEARCHES, dest='search', nargs=1, type=str,
+                        help='The hyperparameter search strategy. Default is grid.')
+    parser.add_argument('--profile', dest='profile_path', nargs=1, type=str,
+                        help='Save the time of every stage and the counters, per tomogram and in total, to this '
+                             'JSON file.')
+    parser.add_argument('--memory', dest='profile_memory', action='store_true',
+                        help='With --profile, also record the peak memory of every stage and the source lines of '
+                             'its largest allocations. Slows the run down.')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Number of worker processes. Default is all the cores.')
+
+
+def add_serve_arguments(parser):
+    from EvalServer import DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE, DEFAULT_LEASE_SECONDS
+    from CorrelationCache import DEFAULT_CACHE_BYTES
+    parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
+                        help='The path to the SVM to evaluate with.')
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
+                        type=str, required=True, help='Paths to the templates.')
+    parser.add_argument('--socket', dest='socket_path', nargs=1, type=str,
+                        help='Unix socket taking JSON line requests, see EvalServer.RequestHandler.')
+    parser.add_argument('--spool', dest='spool_path', nargs=1, type=str,
+                        help='Directory watched for .job files ({"tomogram": path, "out": path}).')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Number of tomograms evaluated at the same time. Default is %d.' % DEFAULT_WORKERS)
+    parser.add_argument('--queue', dest='queue_size', nargs=1, type=int,
+                        help='Maximal number of waiting jobs. Default is %d.' % DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--corrcache', dest='correlation_cache_path', nargs=1, type=str,
+                        help='Directory caching the correlation volumes of the tomograms with the templates.')
+    parser.add_argument('--corrcachesize', dest='correlation_cache_size', nargs=1, type=int,
+                        help='Maximal megabytes of the correlation cache. Default is %d.' %
+                             (DEFAULT_CACHE_BYTES // MEGABYTE))
+    parser.add_argument('--lease', dest='lease_seconds', nargs=1, type=float,
+                        help='Seconds after which a spool job not renewed by its server is requeued. Default is %d.'
+                             % DEFAULT_LEASE_SECONDS)
+
+
+def add_shard_arguments(parser):
+    import ShardSpool
+    parser.add_argument('spool_path', metavar='spool', nargs=1, type=str,
+                        help='The spool directory to create, on a filesystem all the nodes share.')
+    parser.add_argument('--kind', choices=ShardSpool.SUPPORTED_KINDS, dest='kind', nargs=1, type=str,
+                        required=True, help='eval to evaluate the tomograms, features for the feature phase '
+                                            'of the training.')
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
+                        type=str, required=True, help='Paths to the templates.')
+    parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
+                        required=True, help='Paths to the tomograms.')
+    parser.add_argument('-o', '--outpath', dest='out_path', nargs='+', type=str,
+                        help='eval only: paths of the results of the tomograms, see eval -o.')
+    parser.add_argument('-s', '--svm', dest='svm_path', nargs=1, type=str,
+                        help='eval only: the path to the SVM to evaluate with.')
+    parser.add_argument('--size', dest='shard_size', nargs=1, type=int,
+                        help='Number of tomograms per shard. Default is %d.' % ShardSpool.DEFAULT_SHARD_SIZE)
+    parser.add_argument('--local', dest='local_workers', nargs=1, type=int,
+                        help='Run this many worker processes on this machine and merge into --merged.')
+    parser.add_argument('--merged', dest='merged_path', nargs=1, type=str,
+                        help='With --local, the path of the merged output, see merge.')
+
+
+def add_worker_arguments(parser):
+    import ShardSpool
+    parser.add_argument('spool_path', metavar='spool', nargs=1, type=str, help='The spool directory.')
+    parser.add_argument('--lease', dest='lease_seconds', nargs=1, type=float,
+                        help='Seconds after which the shard of a worker which stopped renewing is requeued. '
+                             'Default is %g.' % ShardSpool.DEFAULT_LEASE_SECONDS)
+    parser.add_argument('--id', dest='worker_id', nargs=1, type=str,
+                        help='Name of the worker in the lease files. Default is <host>-<pid>.')
+
+
+def add_merge_arguments(parser):
+    parser.add_argument('spool_path', metavar='spool', nargs=1, type=str, help='The spool directory.')
+    parser.add_argument('out_path', metavar='out', nargs=1, type=str,
+                        help='The merged output: a features .npz for train -f / tune -f, or the candidates of '
+                             'all the tomograms as .npz or .star.')
+
+
+def add_bench_arguments(parser):
+    from benchmarks import StageBench, ImportBench
+    parser.add_argument('-o', '--out', dest='out_path', nargs=1, type=str,
+                        help='Save the results to this JSON file.')
+    parser.add_argument('--baseline', dest='baseline_path', nargs=1, type=str,
+                        help='Compare with the results saved in this JSON file and fail on regressions.')
+    parser.add_argument('--threshold', dest='threshold', nargs=1, type=float,
+                        help='Fraction by which a stage may be slower than the baseline. Default is %.2f.' %
+                             StageBench.DEFAULT_THRESHOLD)
+    parser.add_argument('--dims', dest='dims', nargs='+', type=int, choices=(2, 3),
+                        help='The dimensions to benchmark. Default is 2 and 3.')
+    parser.add_argument('--sizes', dest='sizes', nargs='+', type=int,
+                        help='The sides of the 2D tomograms. Default is %s.' %
+                             ' '.join(map(str, StageBench.DEFAULT_SIZES_2D)))
+    parser.add_argument('--sizes3d', dest='sizes_3d', nargs='+', type=int,
+                        help='The sides of the 3D tomograms. Default is %s.' %
+                             ' '.join(map(str, StageBench.DEFAULT_SIZES_3D)))
+    parser.add_argument('--templates', dest='template_counts', nargs='+', type=int,
+                        help='The numbers of templates. Default is %s.' %
+                             ' '.join(map(str, StageBench.DEFAULT_TEMPLATE_COUNTS)))
+    parser.add_argument('--tilts', dest='tilt_counts', nargs='+', type=int,
+                        help='The numbers of tilts per template. Default is %s.' %
+                             ' '.join(map(str, StageBench.DEFAULT_TILT_COUNTS)))
+    parser.add_argument('--repeat', dest='repeat', nargs=1, type=int,
+                        help='Times every stage is run, the best is kept. Default is %d, %d with --imports.' %
+                             (StageBench.DEFAULT_REPEAT, ImportBench.DEFAULT_REPEAT))
+    parser.add_argument('--imports', dest='imports', action='store_true',
+                        help='Time the startup of the commands and the imports of the main modules, in new '
+                             'interpreters, instead of the stages. Fails when a light command loads sklearn, '
+                             'scipy.signal or matplotlib.')
+    parser.add_argument('--seed', dest='seed', nargs=1, type=int,
+                        help='Seed of the generated tomograms. Default is %d.' % StageBench.DEFAULT_SEED)
+
+
+def add_sweep_arguments(parser):
+    from benchmarks import AccuracySweep
+    parser.add_argument('-o', '--out', dest='out_path', nargs=1, type=str,
+                        help='Save the results to this JSON file.')
+    parser.add_argument('--tomograms', dest='tomograms', nargs=1, type=int,
+                        help='Number of tomograms to train on, and to evaluate. Default is %d.' %
+                             AccuracySweep.DEFAULT_TOMOGRAMS)
+    parser.add_argument('--size', dest='size', nargs=1, type=int,
+                        help='The side of the tomograms. Default is %d.' % AccuracySweep.DEFAULT_SIZE)
+    parser.add_argument('--templates', dest='templates', nargs=1, type=int,
+                        help='Number of templates. Default is %d.' % AccuracySweep.DEFAULT_TEMPLATES)
+    parser.add_argument('--clean', dest='clean', action='store_true',
+                        help='Do not add noise to the tomograms.')
+    parser.add_argument('--seed', dest='seed', nargs=1, type=int,
+                        help='Seed of the generated tomograms. Default is %d.' % AccuracySweep.DEFAULT_SEED)
+    parser.add_argument('--tilts', dest='tilt_counts', nargs='+', type=int,
+                        help='The numbers of tilts searched per template, out of %d. Default is %s.' %
+                             (AccuracySweep.FULL_TILTS, ' '.join(map(str, AccuracySweep.DEFAULT_TILT_COUNTS))))
+    parser.add_argument('--binning', dest='binnings', nargs='+', type=int,
+                        help='The binning factors. Default is %s.' %
+                             ' '.join(map(str, AccuracySweep.DEFAULT_BINNINGS)))
+    parser.add_argument('--thresholds', dest='thresholds', nargs='+', type=float,
+                        help='The correlation thresholds of the candidate selection. Default is %s.' %
+                             ' '.join(map(str, AccuracySweep.DEFAULT_THRESHOLDS)))
+    parser.add_argument('--dtypes', dest='dtypes', nargs='+', type=str, choices=AccuracySweep.DEFAULT_DTYPES,
+                        help='The dtypes of the density maps. Default is both.')
+
+
+def add_tune_perf_arguments(parser):
+    parser.add_argument('-t', '--templates', dest='template_paths', nargs='+', type=str, required=True,
+                        help='Paths to the templates scanned in production.')
+    parser.add_argument('-d', '--datapath', dest='tomogram_path', nargs=1, type=str, required=True,
+                        help='Path to a sample tomogram, its center is scanned.')
+    parser.add_argument('-o', '--out', dest='out_path', nargs=1, type=str,
+                        help='Path of the machine profile. Default is %s, which the scanning engine loads.' %
+                             MachineProfile.DEFAULT_PATH)
+    parser.add_argument('--memoryceiling', dest='memory_ceiling', nargs=1, type=int,
+                        help='Maximal megabytes used by all the workers scanning together.')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Most workers tried. Default is the number of cores.')
+
+
+def add_plan_arguments(parser):
+    parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
+                        type=str, required=True, help='Paths to the templates of the evaluation.')
+    parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
+                        required=True, help='Paths to the tomograms of the evaluation. Only the headers of MRC '
+                                            'files are read.')
+    parser.add_argument('-o', '--outpath', dest='out_path', nargs='+', type=str,
+                        help='The output paths of the evaluation, to estimate their size.')
+    parser.add_argument('-j', '--jobs', dest='jobs', nargs=1, type=int,
+                        help='Number of workers. Default is the machine profile\'s, else 1.')
+    parser.add_argument('--memorylimit', dest='memory_limit', nargs=1, type=int,
+                        help='Maximal megabytes of all the workers together. Default is the machine profile\'s '
+                             'memory ceiling.')
+    parser.add_argument('--machineprofile', dest='machine_profile_path', nargs=1, type=str,
+                        help='Path of the machine profile. Default is %s.' % MachineProfile.DEFAULT_PATH)
+    parser.add_argument('--bench', dest='bench_path', nargs=1, type=str,
+                        help='Results of bench -o, to time the stages the machine profile does not.')
+    parser.add_argument('--save', dest='save_path', nargs=1, type=str,
+                        help='Save the plan to this JSON file.')
+
+
+COMMAND_ARGUMENTS = dict(zip(SUPPORTED_COMMANDS, (
+    add_train_arguments, add_eval_arguments, add_tune_arguments, add_serve_arguments, add_shard_arguments,
+    add_worker_arguments, add_merge_arguments, add_bench_arguments, add_sweep_arguments, add_tune_perf_arguments,
+    add_plan_arguments)))
 
 
 def main(argv):
+    argv = sys.argv[1:] if argv is None else argv
     parser = argparse.ArgumentParser(description='Train or evaluate an SVM to classify electron density maps.')
     subparsers = parser.add_subparsers(dest='command', help='Command to initiate.')
+    for command in SUPPORTED_COMMANDS:
+        command_parser = subparsers.add_parser(command)
+        # Only the command run has its arguments defined, their defaults come from the modules it needs
+        if argv[:1] == [command]:
+            COMMAND_ARGUMENTS[command](command_parser)
 
-    train_parser = subparsers.add_parser(SUPPORTED_COMMANDS[0])
-    train_parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
-                              help='Path to save in the created svm.')
-    train_parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+',
-                              type=str,
-                              required=True,
-                              help='Paths to the templates to be trained with.')
-    train_parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
-                              required=True,
-                              help='Paths to the tomograms to be trained on. If used with -g only the first path will be '
-                                   'used and it will be used to save the generated tomograms into.')
-    train_parser.add_argument('-g', '--generator', choices=Generator.keys(), dest='template_generator', nargs=1,
-                              type=str,
-                              help='The generator to be used in generation of the templates. Default is LOAD.')
-    train_parser.add_argument('-s', '--source', dest='source_svm', nargs=1, type=str,
-                              help='An SVM pickle which will be used to start with.')
-
-    eval_parser = subparsers.add_parser(SUPPORTED_COMMANDS[1])
-    eval_parser.add_argument('svm_path', metavar='svm', nargs=1, type=str,
-                             help='Path to the pickle of the svm to use.')
-    eval_parser.add_argument('-t', '--templatepath', metavar='templatepath', dest='template_paths', nargs='+', type=str,
-                             required=True,
-                             help='Path to the templates to be used by the SVM.')
-    eval_parser.add_argument('-d', '--datapath', metavar='datapath', dest='tomogram_paths', nargs='+', type=str,
-                             required=True,
-                             help='Path to the tomograms to be evaluated.')
-    eval_parser.add_argument('-o', '--outpath', dest='out_path', nargs='+', type=str, required=True,
-                             help='Path to which the results will be saved. Should have the same number of elements as '
-                                  'datapath.')
-
-    # generator_parser = subparsers.add_parser(SUPPORTED_COMMANDS[2])
+    # generator_parser = subparsers.add_parser(SUPPORTED_COMMANDS[11])
     # generator_parser.add_argument('generator', choices=SUPPORTED_GENERATORS, nargs=1, type=str,
     #                               help='The generator to use.')
     # generator_parser.add_argument()
 
     # Parse the arguments
     args = parser.parse_args(argv)
+    profile_path = getattr(args, 'profile_path', None)
+    if profile_path is not None:
+        Profiling.enable(memory=args.profile_memory, path=profile_path[0] if args.profile_memory else None)
 
     if args.command == SUPPORTED_COMMANDS[0]:
+        from SvmTrain import svm_train
+        from Classifiers import SUPPORTED_MULTICLASS
+        if args.template_generator is not None and args.checkpoint_path is not None:
+            parser.error('train --checkpoint needs loaded tomograms, -g generates new ones on every run')
         svm_train(args.svm_path[0], args.template_paths, args.tomogram_paths,
                   source_svm=args.source_svm[0] if args.source_svm is not None else None,
                   template_generator=args.template_generator[0] if args.template_generator is not None else None,
-                  generate_tomograms=True)
+                  generate_tomograms=args.template_generator is not None, cascade=args.cascade,
+                  multiclass=args.multiclass[0] if args.multiclass is not None else SUPPORTED_MULTICLASS[0],
+                  top_k=args.top_k[0] if args.top_k is not None else None,
+                  n_jobs=args.jobs[0] if args.jobs is not None else None, lazy=args.lazy,
+                  checkpoint_path=args.checkpoint_path[0] if args.checkpoint_path is not None else None,
+                  correlation_cache_path=args.correlation_cache_path[0] if args.correlation_cache_path is not None
+                  else None, correlation_cache_bytes=correlation_cache_bytes(args),
+                  features_path=args.features_path[0] if args.features_path is not None else None)
         pass
     elif args.command == SUPPORTED_COMMANDS[1]:
-        svm_eval(args.svm_path[0], args.template_paths, args.tomogram_paths, args.out_path)
+        from SvmEval import svm_eval
+        from Pipeline import DEFAULT_PREFETCH_DEPTH
+        n_jobs, scan_settings = eval_settings(args)
+        svm_eval(args.svm_path[0], args.template_paths, args.tomogram_paths, args.out_path,
+                 prefetch_depth=args.prefetch[0] if args.prefetch is not None else DEFAULT_PREFETCH_DEPTH,
+                 memory_cap=args.memory_cap[0] * MEGABYTE if args.memory_cap is not None else None,
+                 n_jobs=n_jobs,
+                 correlation_cache_path=args.correlation_cache_path[0] if args.correlation_cache_path is not None
+                 else None, correlation_cache_bytes=correlation_cache_bytes(args), scan_settings=scan_settings)
         pass
+    elif args.command == SUPPORTED_COMMANDS[2]:
+        from SvmTune import svm_tune, SUPPORTED_SEARCHES
+        svm_tune(args.svm_path[0], args.template_paths, args.tomogram_paths,
+                 features_path=args.features_path[0] if args.features_path is not None else None,
+                 template_generator=args.template_generator[0] if args.template_generator is not None else None,
+                 search=args.search[0] if args.search is not None else SUPPORTED_SEARCHES[0],
+                 n_jobs=args.jobs[0] if args.jobs is not None else -1)
+    elif args.command == SUPPORTED_COMMANDS[3]:
+        if args.socket_path is None and args.spool_path is None:
+            parser.error('serve needs --socket, --spool or both')
+        from EvalServer import serve, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE, DEFAULT_LEASE_SECONDS
+        serve(args.svm_path[0], args.template_paths,
+              socket_path=args.socket_path[0] if args.socket_path is not None else None,
+              spool_path=args.spool_path[0] if args.spool_path is not None else None,
+              n_workers=args.jobs[0] if args.jobs is not None else DEFAULT_WORKERS,
+              queue_size=args.queue_size[0] if args.queue_size is not None else DEFAULT_QUEUE_SIZE,
+              correlation_cache_path=args.correlation_cache_path[0] if args.correlation_cache_path is not None
+              else None, correlation_cache_bytes=correlation_cache_bytes(args),
+              lease_seconds=args.lease_seconds[0] if args.lease_seconds is not None else DEFAULT_LEASE_SECONDS)
+    elif args.command == SUPPORTED_COMMANDS[4]:
+        import ShardSpool
+        if args.kind[0] == ShardSpool.KIND_EVAL and args.svm_path is None:
+            parser.error('shard --kind eval needs --svm')
+        ShardSpool.create_spool(args.spool_path[0], args.kind[0], args.template_paths, args.tomogram_paths,
+                                out_paths=args.out_path,
+                                svm_path=args.svm_path[0] if args.svm_path is not None else None,
+                                shard_size=args.shard_size[0] if args.shard_size is not None
+                                else ShardSpool.DEFAULT_SHARD_SIZE)
+        if args.local_workers is not None:
+            ShardSpool.run_local(args.spool_path[0], args.local_workers[0])
+            if args.merged_path is not None:
+                ShardSpool.merge(args.spool_path[0], args.merged_path[0])
+    elif args.command == SUPPORTED_COMMANDS[5]:
+        import ShardSpool
+        ShardSpool.ShardWorker(args.spool_path[0], worker_id=args.worker_id[0] if args.worker_id is not None else None,
+                               lease_seconds=args.lease_seconds[0] if args.lease_seconds is not None
+                               else ShardSpool.DEFAULT_LEASE_SECONDS).run()
+    elif args.command == SUPPORTED_COMMANDS[6]:
+        import ShardSpool
+        ShardSpool.merge(args.spool_path[0], args.out_path[0])
+    elif args.command == SUPPORTED_COMMANDS[7]:
+        bench(args)
+    elif args.command == SUPPORTED_COMMANDS[8]:
+        sweep(args)
+    elif args.command == SUPPORTED_COMMANDS[9]:
+        import PerfTuner
+        PerfTuner.tune(args.template_paths, args.tomogram_path[0],
+                       out_path=args.out_path[0] if args.out_path is not None else MachineProfile.DEFAULT_PATH,
+                       memory_ceiling=args.memory_ceiling[0] * MEGABYTE if args.memory_ceiling is not None else None,
+                       max_workers=args.jobs[0] if args.jobs is not None else None)
+    elif args.command == SUPPORTED_COMMANDS[10]:
+        plan(args)
     else:
         raise NotImplementedError('Command %s is not implemented.' % args.command)
 
+    if profile_path is not None:
+        Profiling.active.save(profile_path[0])
+        if args.profile_memory:
+            Profiling.active.print_memory()
+        print('Saved the profile to %s' % profile_path[0])
+
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         from TemplateFactory import TemplateFactory, NormalizedTemplateFactory, Generator
@@ -69,7 +521,7 @@ if __name__ == '__main__':
         from CandidateSelector import CandidateSelector
         from FeaturesExtractor import FeaturesExtractor
         from TiltFinder import TiltFinder
-        from SvmEval import analyze_tomogram
+        from AnalyzeTomogram import analyze_tomogram
         import Labeler
 
         print('Starting test...')
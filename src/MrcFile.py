@@ -0,0 +1,214 @@
+import mmap
+import numpy as np
+
+# Reference: https://www.ccpem.ac.uk/mrc_format/mrc2014.php
+HEADER_SIZE = 1024
+MRC_EXTENSIONS = ('.mrc', '.mrcs', '.map', '.rec', '.st')
+
+# Data mode -> dtype of the voxels
+MODE_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 4: np.complex64, 6: np.uint16, 12: np.float16}
+
+HEADER_DTYPE = np.dtype([
+    ('nx', 'i4'), ('ny', 'i4'), ('nz', 'i4'),               # number of columns, rows and sections
+    ('mode', 'i4'),
+    ('nxstart', 'i4'), ('nystart', 'i4'), ('nzstart', 'i4'),
+    ('mx', 'i4'), ('my', 'i4'), ('mz', 'i4'),               # grid size
+    ('cella', 'f4', 3),                                     # cell size in angstroms
+    ('cellb', 'f4', 3),                                     # cell angles
+    ('mapc', 'i4'), ('mapr', 'i4'), ('maps', 'i4'),         # axis (1, 2, 3 for x, y, z) of the columns, rows, sections
+    ('dmin', 'f4'), ('dmax', 'f4'), ('dmean', 'f4'),
+    ('ispg', 'i4'),
+    ('nsymbt', 'i4'),                                       # extended header size in bytes
+    ('extra1', 'V8'),
+    ('exttyp', 'S4'),
+    ('nversion', 'i4'),
+    ('extra2', 'V84'),
+    ('origin', 'f4', 3),
+    ('map', 'S4'),
+    ('machst', 'u1', 4),
+    ('rms', 'f4'),
+    ('nlabl', 'i4'),
+    ('label', 'S80', 10)])
+
+MACHST_LITTLE = (0x44, 0x44, 0x00, 0x00)
+MACHST_BIG = (0x11, 0x11, 0x00, 0x00)
+
+
+class MrcHeader:
+    def __init__(self, fields):
+        self.fields = fields                                    # numpy record of HEADER_DTYPE
+        self.byte_order = '>' if fields['machst'][0] == MACHST_BIG[0] else '<'
+
+    @property
+    def dtype(self):
+        mode = int(self.fields['mode'])
+        if mode not in MODE_DTYPES:
+            raise NotImplementedError('MRC mode %d is not supported' % mode)
+        return np.dtype(MODE_DTYPES[mode]).newbyteorder(self.byte_order)
+
+    @property
+    def data_offset(self):
+        return HEADER_SIZE + int(self.fields['nsymbt'])
+
+    @property
+    def disk_shape(self):
+        # sections, rows, columns (the columns are the fastest changing axis)
+        return int(self.fields['nz']), int(self.fields['ny']), int(self.fields['nx'])
+
+    @property
+    def axes_permutation(self):
+        # The disk axes to take for x, y, z. Standard files (mapc, mapr, maps) = (1, 2, 3) give (2, 1, 0)
+        disk_axes = [int(self.fields['maps']), int(self.fields['mapr']), int(self.fields['mapc'])]
+        if sorted(disk_axes) != [1, 2, 3]:
+            disk_axes = [3, 2, 1]
+        return tuple([disk_axes.index(axis) for axis in (1, 2, 3)])
+
+    @property
+    def shape(self):
+        return tuple([self.disk_shape[axis] for axis in self.axes_permutation])
+
+    @property
+    def voxel_size(self):
+        """
+        :return: The voxel size in angstroms along x, y, z.
+        """
+        grid = np.array([self.fields['mx'], self.fields['my'], self.fields['mz']], dtype=float)
+        grid[grid == 0] = 1
+        return tuple((np.array(self.fields['cella'], dtype=float) / grid).tolist())
+
+
+def read_header(path):
+    """
+    Read only the header of an MRC file.
+    :param path: Path of the MRC file.
+    :return: MrcHeader
+    """
+    with open(path, 'rb') as file:
+        raw = file.read(HEADER_SIZE)
+    if len(raw) != HEADER_SIZE:
+        raise ValueError('%s is too short to be an MRC file' % path)
+
+    fields = np.frombuffer(raw, dtype=HEADER_DTYPE)[0]
+    if fields['machst'][0] == MACHST_BIG[0]:
+        fields = np.frombuffer(raw, dtype=HEADER_DTYPE.newbyteorder('>'))[0]
+    return MrcHeader(fields)
+
+
+def open_mrc(path, mode='r'):
+    """
+    Map the density of an MRC file. Nothing is read until it is accessed.
+    :param path: Path of the MRC file.
+    :param mode: np.memmap mode, 'r' to read only or 'r+' to update the file.
+    :return: A tuple of the np.memmap indexed [x, y, z] and the header.
+    """
+    header = read_header(path)
+    data = np.memmap(path, dtype=header.dtype, mode=mode, offset=header.data_offset, shape=header.disk_shape)
+    return data.transpose(header.axes_permutation), header
+
+
+def read_ahead(density_map):
+    """
+    Read the pages of a mapped density into the page cache, so that accessing it later does not wait for the disk.
+    One byte of every page is read, the density stays mapped.
+    :param density_map: The np.memmap of open_mrc, or a view of it.
+    :return: The number of bytes read ahead.
+    """
+    mapped = density_map.base if isinstance(density_map.base, np.memmap) else density_map
+    raw = np.asarray(mapped).reshape(-1).view(np.uint8)
+    int(raw[::mmap.PAGESIZE].sum())
+    return raw.size
+
+
+def create_header(shape, dtype, voxel_size=1.0):
+    """
+    :param shape: The x, y, z shape of the density. For 2D use a z size of 1.
+    :param dtype: The voxels dtype, one of MODE_DTYPES.
+    :param voxel_size: The voxel size in angstroms, a number or an x, y, z tuple.
+    :return: The header record of a standard (x fastest) file.
+    """
+    modes = dict([(np.dtype(value), key) for key, value in MODE_DTYPES.items()])
+    if np.dtype(dtype) not in modes:
+        raise NotImplementedError('dtype %s can\'t be saved as MRC' % np.dtype(dtype))
+
+    fields = np.zeros((), dtype=HEADER_DTYPE)
+    fields['nx'], fields['ny'], fields['nz'] = shape
+    fields['mx'], fields['my'], fields['mz'] = shape
+    fields['mode'] = modes[np.dtype(dtype)]
+    fields['cella'] = np.array(shape, dtype=float) * np.broadcast_to(np.array(voxel_size, dtype=float), (3,))
+    fields['cellb'] = (90, 90, 90)
+    fields['mapc'], fields['mapr'], fields['maps'] = 1, 2, 3
+    # dmax < dmin marks the statistics as unknown
+    fields['dmin'], fields['dmax'], fields['dmean'], fields['rms'] = 0, -1, -2, -1
+    fields['ispg'] = 1 if shape[2] > 1 else 0
+    fields['exttyp'] = b'MRCO'
+    fields['nversion'] = 20140
+    fields['map'] = b'MAP '
+    fields['machst'] = MACHST_LITTLE
+    return fields
+
+
+def create_mrc(path, shape, dtype=np.float32, voxel_size=1.0):
+    """
+    Create an MRC file and map it for writing, so outputs can be written a slab at a time.
+    :param path: Path of the MRC file.
+    :param shape: The x, y, z shape of the density.
+    :param dtype: The voxels dtype.
+    :param voxel_size: The voxel size in angstroms.
+    :return: A writable np.memmap indexed [x, y, z].
+    """
+    fields = create_header(shape, dtype, voxel_size)
+    with open(path, 'wb') as file:
+        file.write(fields.tobytes())
+    header = MrcHeader(fields)
+    data = np.memmap(path, dtype=header.dtype, mode='r+', offset=HEADER_SIZE, shape=header.disk_shape)
+    return data.transpose(header.axes_permutation)
+
+
+def write_mrc(path, density_map, voxel_size=1.0):
+    """
+    Save a density map as MRC. float64 maps are saved as float32.
+    :param path: Path of the MRC file.
+    :param density_map: numpy array indexed [x, y, z].
+    :param voxel_size: The voxel size in angstroms.
+    """
+    dtype = np.float32 if density_map.dtype == np.float64 else density_map.dtype
+    fields = create_header(density_map.shape, dtype, voxel_size)
+
+    with open(path, 'wb') as file:
+        file.write(fields.tobytes())
+        # Write a section at a time so memory mapped inputs are never loaded whole, the statistics are summed
+        # over the sections and the header is written again at the end
+        dmin, dmax, total, squares = np.inf, -np.inf, 0.0, 0.0
+        for z in range(density_map.shape[2]):
+            section = np.ascontiguousarray(density_map[:, :, z].T, dtype=np.dtype(dtype).newbyteorder('<'))
+            file.write(section.tobytes())
+            values = np.real(section).astype(np.float64)
+            if values.size:
+                dmin, dmax = min(dmin, values.min()), max(dmax, values.max())
+                total += values.sum()
+                squares += np.square(values).sum()
+
+        if density_map.size:
+            mean = total / density_map.size
+            fields['dmin'], fields['dmax'], fields['dmean'] = dmin, dmax, mean
+            fields['rms'] = np.sqrt(max(squares / density_map.size - mean ** 2, 0.0))
+            file.seek(0)
+            file.write(fields.tobytes())
+
+
+def is_mrc_path(path):
+    return str(path).lower().endswith(MRC_EXTENSIONS)
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    density = np.random.rand(30, 20, 10).astype(np.float32)
+    path = os.path.join(tempfile.mkdtemp(), 'test.mrc')
+    write_mrc(path, density, 2.5)
+
+    mapped, header = open_mrc(path)
+    print(type(mapped), mapped.shape, header.voxel_size)
+    assert (mapped == density).all()
+    assert np.isclose(header.fields['rms'], density.std()) and header.fields['dmax'] == density.max()
@@ -0,0 +1,113 @@
+import time
+
+# The stages reported by stage_started and stage_ended are named as the Profiling timers
+
+
+class Observer:
+    """
+    Receives the events of the analysis of a tomogram, see AnalyzeTomogram.run_stages and CandidateSelector.select.
+    Every event does nothing here, subclasses override those they need.
+    """
+
+    def stage_started(self, stage):
+        """
+        :param stage: Name of the stage, a batched stage starts once per batch.
+        """
+        pass
+
+    def stage_ended(self, stage, seconds):
+        """
+        :param stage: Name of the stage.
+        :param seconds: Wall seconds the stage took.
+        """
+        pass
+
+    def template_scanned(self, template_index, template_count):
+        """
+        A template was correlated with the tomogram by the candidate selector. Not sent when the correlation volumes
+        come from a CorrelationCache.
+        """
+        pass
+
+    def correlation_computed(self, max_correlation):
+        """
+        :param max_correlation: Array of the maximal correlation over all the templates and tilts per position.
+        """
+        pass
+
+    def correlation_blurred(self, blurred_correlation):
+        """
+        :param blurred_correlation: The max correlation array blurred, in which the peaks are searched.
+        """
+        pass
+
+    def candidates_emitted(self, candidates):
+        """
+        :param candidates: The CandidateTable of the selected candidates.
+        """
+        pass
+
+    def labels_assigned(self, candidates, labels):
+        """
+        :param candidates: A batch of candidates.
+        :param labels: Their labels, in the same order.
+        """
+        pass
+
+
+class DebugObserver(Observer):
+    """
+    Keeps the intermediate arrays of the candidate selection for inspection, see DebugMain.show_candidates.
+    """
+
+    def __init__(self):
+        self.max_correlation_per_3loc = None
+        self.blurred_correlation_array = None
+        self.positions = None
+
+    def correlation_computed(self, max_correlation):
+        self.max_correlation_per_3loc = max_correlation
+
+    def correlation_blurred(self, blurred_correlation):
+        self.blurred_correlation_array = blurred_correlation
+
+    def candidates_emitted(self, candidates):
+        self.positions = [tuple(position) for position in candidates.positions]
+
+
+def notify(observers, event, *args):
+    for observer in observers:
+        getattr(observer, event)(*args)
+
+
+class ObservedStage:
+    def __init__(self, observers, stage):
+        self.observers = observers
+        self.stage = stage
+
+    def __enter__(self):
+        notify(self.observers, 'stage_started', self.stage)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        notify(self.observers, 'stage_ended', self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(observers, name):
+    """
+    :return: A context manager sending stage_started and stage_ended to the observers, doing nothing without any.
+    """
+    return ObservedStage(observers, name) if observers else NULL_STAGE
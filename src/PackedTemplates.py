@@ -0,0 +1,142 @@
+import sys
+import json
+import pickle
+import argparse
+import numpy as np
+
+from CommonDataTypes import TiltedTemplate
+
+# File layout: MAGIC, the header length (uint32 little endian), a JSON header and then, aligned to DATA_ALIGNMENT,
+# a single C ordered array of shape (templates, tilts, d, d, d).
+MAGIC = b'CRYOTPL1'
+DATA_ALIGNMENT = 64
+
+
+def json_value(value):
+    # tuples become lists in JSON, make the round trip return tuples like the original pickles
+    return tuple([json_value(x) for x in value]) if isinstance(value, list) else value
+
+
+def write_header(file, shape, dtype, template_ids, tilt_ids):
+    header = {'shape': list(shape),
+              'dtype': np.dtype(dtype).str,
+              'template_ids': [[key, value] for key, value in sorted(template_ids.items())],
+              'tilt_ids': [[key, value] for key, value in sorted(tilt_ids.items())]}
+    encoded = json.dumps(header).encode('utf-8')
+    prefix_size = len(MAGIC) + 4 + len(encoded)
+    encoded += b' ' * (-prefix_size % DATA_ALIGNMENT)
+
+    file.write(MAGIC)
+    file.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+    file.write(encoded)
+
+
+def is_packed(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_header(path):
+    """
+    Read only the header of a packed template bank.
+    :param path: Path of the packed bank.
+    :return: A tuple of the header dictionary and the offset of the data.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a packed template bank' % path)
+        header_size = int(np.frombuffer(file.read(4), dtype='<u4')[0])
+        header = json.loads(file.read(header_size).decode('utf-8'))
+
+    header['template_ids'] = dict([(key, json_value(value)) for key, value in header['template_ids']])
+    header['tilt_ids'] = dict([(key, json_value(value)) for key, value in header['tilt_ids']])
+    return header, len(MAGIC) + 4 + header_size
+
+
+def open_packed(path):
+    """
+    Map the packed density maps without reading them.
+    :param path: Path of the packed bank.
+    :return: A tuple of the read only np.memmap of shape (templates, tilts, d, d, d), template_ids and tilt_ids.
+    """
+    header, offset = read_header(path)
+    data = np.memmap(path, dtype=np.dtype(header['dtype']), mode='r', offset=offset, shape=tuple(header['shape']))
+    return data, header['template_ids'], header['tilt_ids']
+
+
+def load_packed_templates(path):
+    """
+    Load a packed bank with the same result as load_templates_3d. The density maps are views of a single memory map so
+    nothing is copied.
+    :param path: Path of the packed bank.
+    :return: A tuple of the tilted templates (tuple of tuples), template_ids and tilt_ids.
+    """
+    data, template_ids, tilt_ids = open_packed(path)
+    tilted_templates = tuple([tuple([TiltedTemplate(data[template_index, tilt_index], tilt_id, template_id)
+                                     for tilt_index, tilt_id in enumerate(sorted(tilt_ids.keys()))])
+                              for template_index, template_id in enumerate(sorted(template_ids.keys()))])
+    return tilted_templates, template_ids, tilt_ids
+
+
+def pack_templates(tilted_templates, template_ids, tilt_ids, out_path):
+    """
+    Save templates to a packed bank.
+    :param tilted_templates: tuple of tuples of TiltedTemplates (each group has the same template_id).
+    :param template_ids: Dictionary of template_id to its description.
+    :param tilt_ids: Dictionary of tilt_id to its euler angles.
+    :param out_path: Path of the packed bank.
+    """
+    first = tilted_templates[0][0].density_map
+    shape = (len(tilted_templates), len(tilted_templates[0])) + first.shape
+    with open(out_path, 'wb') as file:
+        write_header(file, shape, first.dtype, template_ids, tilt_ids)
+        for template_tuple in tilted_templates:
+            for tilted in template_tuple:
+                file.write(np.ascontiguousarray(tilted.density_map, dtype=first.dtype).tobytes())
+
+
+def pack_templates_3d(templates_path, out_path):
+    """
+    Convert the directory layout of load_templates_3d (template_ids.p, tilt_ids.p and a
+    <template_id>_<tilt_id>.npy file per tilt) to a packed bank. The tilts are copied one at a time.
+    :param templates_path: The templates directory, ending with a separator.
+    :param out_path: Path of the packed bank.
+    """
+    with open(templates_path + 'template_ids.p', 'rb') as file:
+        template_ids = pickle.load(file)
+    with open(templates_path + 'tilt_ids.p', 'rb') as file:
+        tilt_ids = pickle.load(file)
+
+    def tilt_path(template_id, tilt_id):
+        return templates_path + str(template_id) + '_' + str(tilt_id) + '.npy'
+
+    template_keys = sorted(template_ids.keys())
+    tilt_keys = sorted(tilt_ids.keys())
+    first = np.load(tilt_path(template_keys[0], tilt_keys[0]), mmap_mode='r')
+    shape = (len(template_keys), len(tilt_keys)) + first.shape
+
+    with open(out_path, 'wb') as file:
+        write_header(file, shape, first.dtype, template_ids, tilt_ids)
+        for template_id in template_keys:
+            for tilt_id in tilt_keys:
+                density_map = np.load(tilt_path(template_id, tilt_id))
+                assert density_map.shape == first.shape
+                file.write(np.ascontiguousarray(density_map, dtype=first.dtype).tobytes())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert a templates directory to a packed template bank.')
+    parser.add_argument('templates_path', nargs=1, type=str,
+                        help='The templates directory (containing template_ids.p and tilt_ids.p).')
+    parser.add_argument('out_path', nargs=1, type=str, help='Path of the packed bank to create.')
+    args = parser.parse_args(argv)
+
+    templates_path = args.templates_path[0]
+    if not templates_path.endswith(('/', '\\')):
+        templates_path += '/'
+    pack_templates_3d(templates_path, args.out_path[0])
+    print('Packed %s into %s' % (templates_path, args.out_path[0]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
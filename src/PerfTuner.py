@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+
+from TemplateFactory import TemplateFactory, Generator
+from TomogramFactory import load_tomogram
+import TiledScan
+import MachineProfile
+
+# The sample tomogram is cropped to this side so that the calibration stays short. The tile sizes are smaller, a
+# tile as large as the crop would only measure the whole volume scan again.
+CALIBRATION_SIDE = 128
+TILE_SIZES = (32, 48, 64, 96)
+BATCH_SIZES = (1, 2, 4, 8)
+REPEAT = 2
+# Besides the scan, a worker holds the tomogram, the max correlation and the blurred correlation
+VOLUMES_PER_JOB = 3
+
+
+def calibration_volume(density_map, side=CALIBRATION_SIDE):
+    # The center of the tomogram, at most side along every axis
+    return np.ascontiguousarray(density_map[tuple([slice((length - min(length, side)) // 2,
+                                                         (length - min(length, side)) // 2 + min(length, side))
+                                                   for length in density_map.shape])])
+
+
+def measure_scan(density_map, templates, tile_size, batch_size, repeat=REPEAT):
+    """
+    Time the scan of the volume with a tile size and a batch size and measure its peak memory.
+    :return: Dictionary of the tile size, the batch size, the padded FFT shape of an inner tile, the best seconds, the
+    voxels scanned per second and the peak bytes allocated by the scan.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        TiledScan.max_correlation(density_map, templates, tile_size, batch_size)
+        times.append(time.perf_counter() - start)
+
+    # Tracing the allocations slows the scan down, so it is measured apart
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    TiledScan.max_correlation(density_map, templates, tile_size, batch_size)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    if not tracing:
+        tracemalloc.stop()
+
+    kernel_shape = templates[0][0].density_map.shape
+    # The largest region, an inner tile
+    region_shape = max([[piece.stop - piece.start for piece in region]
+                        for _, region, _ in TiledScan.regions(density_map.shape, tile_size, kernel_shape)],
+                       key=lambda shape: np.prod(shape))
+    return {'tile_size': tile_size, 'batch_size': batch_size,
+            'fft_shape': list(TiledScan.fft_shape(region_shape, kernel_shape)), 'seconds': min(times),
+            'voxels_per_second': density_map.size / min(times), 'peak_bytes': peak}
+
+
+# The state of a calibration worker process, set once by init_worker
+worker_state = {}
+
+
+def init_worker(density_map, templates, tile_size, batch_size):
+    worker_state.update(density_map=density_map, templates=templates, tile_size=tile_size, batch_size=batch_size)
+
+
+def scan_in_worker(_):
+    TiledScan.max_correlation(worker_state['density_map'], worker_state['templates'], worker_state['tile_size'],
+                              worker_state['batch_size'])
+
+
+def worker_counts(max_workers):
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    return counts + [max_workers] if max_workers > 1 else counts
+
+
+def measure_scaling(density_map, templates, tile_size, batch_size, max_workers):
+    """
+    :return: List of dictionaries of a worker count and the scans per second the pool of that many processes reached.
+    """
+    scaling = []
+    for workers in worker_counts(max_workers):
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(density_map, templates, tile_size, batch_size)) as executor:
+            # Start the processes before the timing
+            list(executor.map(scan_in_worker, range(workers)))
+            start = time.perf_counter()
+            list(executor.map(scan_in_worker, range(REPEAT * workers)))
+            scaling.append({'workers': workers, 'scans_per_second': REPEAT * workers / (time.perf_counter() - start)})
+    return scaling
+
+
+def tune(template_paths, tomogram_path, out_path=MachineProfile.DEFAULT_PATH, memory_ceiling=None, max_workers=None):
+    """
+    Calibrate the scanning engine on the template bank and a sample tomogram and save the machine profile.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_path: Path of the sample tomogram.
+    :param out_path: Path of the machine profile.
+    :param memory_ceiling: Maximal bytes of all the workers together, None for no limit.
+    :param max_workers: Most workers tried. Default is the number of cores.
+    :return: The machine profile.
+    """
+    templates = list(TemplateFactory(Generator.LOAD).set_paths(template_paths).build())
+    density_map = load_tomogram(tomogram_path).density_map
+    volume = calibration_volume(density_map)
+    tilts = max([len(template) for template in templates])
+    # The peaks are measured on the crop, the ceiling is checked against them scaled per voxel to the whole tomogram.
+    # A tiled scan's peak grows slower than the volume so its scaled peak is on the safe side.
+    scale = density_map.size / float(volume.size)
+
+    scans = []
+    for tile_size in [size for size in TILE_SIZES if size < max(volume.shape)] + [None]:
+        for batch_size in [size for size in BATCH_SIZES if size <= tilts]:
+            print('Measuring tile size %s, batch size %d' % (tile_size, batch_size))
+            scan = measure_scan(volume, templates, tile_size, batch_size)
+            scan['tomogram_peak_bytes'] = int(scan['peak_bytes'] * scale)
+            scans.append(scan)
+    scan = MachineProfile.choose_scan(scans, memory_ceiling)
+
+    job_bytes = scan['tomogram_peak_bytes'] + VOLUMES_PER_JOB * density_map.size * np.dtype(np.float64).itemsize
+    print('Measuring the scaling with the workers')
+    scaling = measure_scaling(volume, templates, scan['tile_size'], scan['batch_size'],
+                              max_workers if max_workers is not None else os.cpu_count() or 1)
+    workers = MachineProfile.choose_workers(scaling, job_bytes, memory_ceiling)
+
+    profile = {'machine': {'node': platform.node(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'calibration': {'tomogram': tomogram_path, 'shape': list(volume.shape),
+                               'tomogram_shape': list(density_map.shape), 'templates': len(templates), 'tilts': tilts},
+               'memory_ceiling': memory_ceiling, 'scans': scans, 'scaling': scaling, 'job_bytes': job_bytes,
+               'settings': {'tile_size': scan['tile_size'], 'batch_size': scan['batch_size'], 'workers': workers}}
+    MachineProfile.save(out_path, profile)
+    print('Tile size %s, batch size %d, %d workers' % (scan['tile_size'], scan['batch_size'], workers))
+    print('Saved the machine profile to %s' % out_path)
+    return profile
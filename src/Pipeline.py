@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import pickle
+import time
+import os
+
+DEFAULT_PREFETCH_DEPTH = 1
+DEFAULT_WRITE_QUEUE = 4
+
+
+def atomic_write(path, write):
+    """
+    Write a file so readers never see it half written: write to a temporary file in the same directory, close it and
+    rename it over path.
+    :param path: The final path.
+    :param write: function(temporary path) that writes and closes the file. The temporary path keeps the extension.
+    """
+    root, extension = os.path.splitext(path)
+    temporary_path = '%s.partial%d-%d%s' % (root, os.getpid(), threading.get_ident(), extension)
+    try:
+        write(temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def atomic_pickle(path, obj):
+    def write(temporary_path):
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(obj, file)
+    atomic_write(path, write)
+
+
+class PipelineTimer:
+    """
+    Separates the time the main loop spends waiting for I/O from the time it computes.
+    """
+    def __init__(self):
+        self.io_wait = 0.0          # waiting for a tomogram to be loaded
+        self.write_wait = 0.0       # waiting for room in the writer queue, part of the time between two tomograms
+        self.flush_wait = 0.0       # waiting for the last writes after the loop
+        self.compute = 0.0          # the time between two tomograms
+
+    def report(self):
+        write = self.write_wait + self.flush_wait
+        return 'I/O wait %.2fs (read %.2fs, write %.2fs), compute %.2fs' % \
+               (self.io_wait + write, self.io_wait, write, self.compute - self.write_wait)
+
+
+class PrefetchReader:
+    """
+    Iterates over the tomograms of the paths in order while a thread pool loads the next ones.
+    """
+
+    def __init__(self, paths, load, depth=DEFAULT_PREFETCH_DEPTH, memory_cap=None, timer=None):
+        """
+        :param paths: The paths to load.
+        :param load: function(path) returning the loaded tomogram.
+        :param depth: Number of tomograms loaded ahead of the one being processed. 0 loads them one by one.
+        :param memory_cap: Maximal bytes of tomograms loaded or held at once, estimated by the file sizes: the unpickled
+        tomograms, or the pages of the MRC files load reads ahead. The next tomogram is always loaded when nothing else
+        is.
+        :param timer: A PipelineTimer to account the time in.
+        """
+        self.paths = list(paths)
+        self.load = load
+        self.depth = depth
+        self.memory_cap = memory_cap
+        self.timer = timer if timer is not None else PipelineTimer()
+
+    @staticmethod
+    def estimate_size(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=max(1, self.depth))
+        pending = deque()       # (future, estimated size) in the order of the paths
+        next_index = 0
+        held_size = 0           # size of the tomogram the consumer is working on
+
+        def submit_next():
+            size = self.estimate_size(self.paths[next_index])
+            pending.append((executor.submit(self.load, self.paths[next_index]), size))
+
+        try:
+            while next_index < len(self.paths) or len(pending) != 0:
+                if len(pending) == 0:
+                    submit_next()
+                    next_index += 1
+                future, held_size = pending.popleft()
+
+                # Keep depth loads in flight while the consumer works on this tomogram, under the memory cap
+                while next_index < len(self.paths) and len(pending) < self.depth:
+                    size = self.estimate_size(self.paths[next_index])
+                    used = held_size + sum([pending_size for _, pending_size in pending])
+                    if self.memory_cap is not None and used + size > self.memory_cap:
+                        break
+                    submit_next()
+                    next_index += 1
+
+                start = time.perf_counter()
+                tomogram = future.result()
+                self.timer.io_wait += time.perf_counter() - start
+
+                start = time.perf_counter()
+                yield tomogram
+                self.timer.compute += time.perf_counter() - start
+                held_size = 0
+        finally:
+            for future, _ in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+class BackgroundWriter:
+    """
+    Runs the writes of the results on a background thread with a bounded queue.
+    Use as a context manager, leaving it waits for all the writes and raises the first error.
+    """
+
+    def __init__(self, max_pending=DEFAULT_WRITE_QUEUE, timer=None):
+        """
+        :param max_pending: Maximal number of writes queued, submit blocks while the queue is full.
+        :param timer: A PipelineTimer to account the blocked time in.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.Semaphore(max(1, max_pending))
+        self.futures = []
+        self.timer = timer if timer is not None else PipelineTimer()
+
+    def submit(self, write, *args):
+        """
+        :param write: function(*args) doing the write, should use atomic_write.
+        """
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.timer.write_wait += time.perf_counter() - start
+
+        future = self.executor.submit(write, *args)
+        future.add_done_callback(lambda done: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        start = time.perf_counter()
+        self.executor.shutdown(wait=True)
+        self.timer.flush_wait += time.perf_counter() - start
+        for future in self.futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
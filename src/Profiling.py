@@ -0,0 +1,334 @@
+import copy
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not on Windows, the RSS peaks are then not recorded
+    resource = None
+
+# The stage timers of run_stages. blur and peak_detection are parts of candidate_selection.
+CANDIDATE_SELECTION = 'candidate_selection'
+BLUR = 'blur'
+PEAK_DETECTION = 'peak_detection'
+FEATURE_EXTRACTION = 'feature_extraction'
+LABELING = 'labeling'
+TILT_FINDING = 'tilt_finding'
+# Timers around the iteration of the factories, loading or generating each template and tomogram
+TEMPLATE_FACTORY_BUILD = 'template_factory_build'
+TOMOGRAM_FACTORY_BUILD = 'tomogram_factory_build'
+
+# Counters
+FFTS = 'ffts'                       # fftconvolve calls
+CORRELATIONS = 'correlations'       # signal.correlate calls of the tilt finder
+CANDIDATES = 'candidates'
+TEMPLATES_SCANNED = 'templates_scanned'
+
+MEGABYTE = 1 << 20
+# Number of source lines kept per stage by the memory profiling
+TOP_ALLOCATIONS = 10
+
+# The profiler of the run, None when profiling is disabled
+active = None
+
+
+def peak_rss():
+    """
+    :return: The peak resident set size of the process so far in bytes, None when it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def top_allocations(before, after, limit=TOP_ALLOCATIONS):
+    """
+    :param before: tracemalloc snapshot taken when the stage started.
+    :param after: tracemalloc snapshot taken when it ended.
+    :return: List of the source lines whose allocations grew the most, as dictionaries of the line ('file:lineno'),
+    the bytes and the count of the blocks still allocated at the end.
+    """
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+    statistics = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+    lines = []
+    for statistic in statistics[:limit]:
+        if statistic.size_diff <= 0:
+            break
+        frame = statistic.traceback[0]
+        lines.append({'line': '%s:%d' % (os.path.basename(frame.filename), frame.lineno),
+                      'bytes': statistic.size_diff, 'count': statistic.count_diff})
+    return lines
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageTimer:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        if self.profile.memory:
+            self.profile.enter_stage(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        memory = self.profile.exit_stage(self) if self.profile.memory else None
+        self.profile.add_time(self.name, wall, cpu, memory=memory)
+        return False
+
+
+class Profile:
+    """
+    Wall and CPU seconds per stage and counters. The CPU time is the process time, threads included.
+    With the memory profiling a stage also has:
+        traced_peak: the most bytes traced by tracemalloc above those allocated when the stage started, over its calls.
+        rss_peak: the peak RSS of the process when the stage ended, the largest over its calls.
+        rss_growth: the bytes by which the stage raised the peak RSS, summed over its calls. The stage that raises it
+            the most is the one to look at when a job runs out of memory.
+        top_allocations: the source lines whose allocations grew the most during the stage, see top_allocations.
+    """
+    def __init__(self, info=None):
+        self.info = info if info is not None else {}
+        self.stages = {}        # name -> {'wall': seconds, 'cpu': seconds, 'calls': count} and the memory fields
+        self.counters = {}
+
+    def add_time(self, name, wall, cpu, calls=1, memory=None):
+        stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['calls'] += calls
+        if memory is not None:
+            self.add_memory(stage, memory)
+
+    @staticmethod
+    def add_memory(stage, memory):
+        for key in ('traced_peak', 'rss_peak'):
+            if memory.get(key) is not None:
+                stage[key] = max(stage.get(key, 0), memory[key])
+        if memory.get('rss_growth') is not None:
+            stage['rss_growth'] = stage.get('rss_growth', 0) + memory['rss_growth']
+        if memory.get('top_allocations'):
+            # Keep the largest growth seen per line
+            lines = dict([(line['line'], line) for line in stage.get('top_allocations', [])])
+            for line in memory['top_allocations']:
+                if line['line'] not in lines or lines[line['line']]['bytes'] < line['bytes']:
+                    lines[line['line']] = line
+            stage['top_allocations'] = sorted(lines.values(), key=lambda line: -line['bytes'])[:TOP_ALLOCATIONS]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, report):
+        for name, stage in report['stages'].items():
+            self.add_time(name, stage['wall'], stage['cpu'], stage['calls'],
+                          memory=stage if 'traced_peak' in stage else None)
+        for name, n in report['counters'].items():
+            self.count(name, n)
+
+    def report(self):
+        return dict(self.info, stages=self.stages, counters=self.counters)
+
+
+class Profiler:
+    """
+    Collects a Profile per tomogram, the time outside of the tomograms goes to a separate Profile.
+    Threads evaluating tomograms at the same time (the workers of EvalServer) each have their own current tomogram and
+    stages being timed, the shared reports are updated under a lock. tracemalloc and the RSS are per process, so the
+    memory of a stage then includes what the other threads allocated meanwhile.
+    """
+    def __init__(self, memory=False, path=None):
+        """
+        :param memory: Also record the memory of every stage, see Profile. Tracing the allocations slows the run down.
+        :param path: Path to which the report is saved after every tomogram, so that a run killed for lack of memory
+        still leaves the report of the tomograms before. None saves only when asked to.
+        """
+        self.outside = Profile()
+        self.tomograms = []     # reports of the finished tomograms
+        self.memory = memory
+        self.path = path
+        self.lock = threading.RLock()
+        self.local = threading.local()     # current: the Profile of the thread's tomogram, running: its stages
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def current(self):
+        return getattr(self.local, 'current', self.outside)
+
+    @property
+    def running(self):
+        # The stages being timed by the thread, innermost last
+        if not hasattr(self.local, 'running'):
+            self.local.running = []
+        return self.local.running
+
+    def add_time(self, name, wall, cpu, memory=None):
+        with self.lock:
+            self.current.add_time(name, wall, cpu, memory=memory)
+
+    def enter_stage(self, stage_timer):
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is reset for the inner stage, keep what the enclosing stage has reached so far
+        if self.running:
+            self.running[-1].peak = max(self.running[-1].peak, peak)
+        tracemalloc.reset_peak()
+        stage_timer.start = current
+        stage_timer.peak = current
+        stage_timer.rss = peak_rss()
+        # Snapshots are slow, only the outermost stages get the source lines of their allocations
+        stage_timer.snapshot = tracemalloc.take_snapshot() if not self.running else None
+        self.running.append(stage_timer)
+
+    def exit_stage(self, stage_timer):
+        """
+        :return: The memory used by the stage, see Profile.
+        """
+        self.running.remove(stage_timer)
+        peak = max(tracemalloc.get_traced_memory()[1], stage_timer.peak)
+        if self.running:
+            self.running[-1].peak = max(self.running[-1].peak, peak)
+        rss = peak_rss()
+        memory = {'traced_peak': peak - stage_timer.start, 'rss_peak': rss,
+                  'rss_growth': rss - stage_timer.rss if rss is not None else None}
+        if stage_timer.snapshot is not None:
+            memory['top_allocations'] = top_allocations(stage_timer.snapshot, tracemalloc.take_snapshot())
+            stage_timer.snapshot = None
+        return memory
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.current.count(name, n)
+
+    def begin_tomogram(self):
+        self.local.current = Profile()
+
+    def end_tomogram(self, info):
+        """
+        :param info: Dictionary describing the tomogram, added to its report.
+        :return: The report of the tomogram.
+        """
+        with self.lock:
+            self.current.info = dict(info)
+            report = self.current.report()
+            self.tomograms.append(report)
+            self.local.current = self.outside
+        if self.path is not None:
+            self.save(self.path)
+        return report
+
+    def add_tomogram(self, report):
+        # A tomogram profiled in another process
+        with self.lock:
+            self.tomograms.append(report)
+
+    def report(self):
+        with self.lock:
+            aggregate = Profile()
+            for report in self.tomograms:
+                aggregate.merge(report)
+            aggregate.merge(self.outside.report())
+            if self.memory:
+                aggregate.info['peak_rss'] = peak_rss()
+                aggregate.info['peak_traced'] = tracemalloc.get_traced_memory()[1]
+            # A copy, the other threads keep updating the profiles
+            return copy.deepcopy({'tomograms': self.tomograms, 'outside_tomograms': self.outside.report(),
+                                  'aggregate': dict(aggregate.report(), tomograms=len(self.tomograms))})
+
+    def save(self, path):
+        # Under the lock so that two threads finishing tomograms do not write the file at the same time
+        with self.lock:
+            with open(path, 'w') as file:
+                json.dump(self.report(), file, indent=2)
+
+    def print_memory(self):
+        # The stages by how much they raised the peak RSS, the first suspects of an out of memory
+        stages = self.report()['aggregate']['stages']
+        for name, stage in sorted(stages.items(), key=lambda item: -(item[1].get('rss_growth') or 0)):
+            print('Stage %s: traced peak %.1f MB, RSS peak %s, RSS growth %s' %
+                  (name, stage['traced_peak'] / MEGABYTE,
+                   '%.1f MB' % (stage['rss_peak'] / MEGABYTE) if stage.get('rss_peak') is not None else 'unknown',
+                   '%.1f MB' % (stage['rss_growth'] / MEGABYTE) if stage.get('rss_growth') is not None else 'unknown'))
+            for line in stage.get('top_allocations', [])[:3]:
+                print('    %s: %.1f MB in %d blocks' % (line['line'], line['bytes'] / MEGABYTE, line['count']))
+
+
+def enable(memory=False, path=None):
+    """
+    :param memory: Also record the memory of every stage, see Profiler.
+    :param path: Path to which the report is saved after every tomogram, see Profiler.
+    """
+    global active
+    active = Profiler(memory, path)
+    return active
+
+
+def disable():
+    global active
+    if active is not None and active.memory:
+        tracemalloc.stop()
+    active = None
+
+
+def timer(name):
+    """
+    :return: A context manager adding its wall and CPU time to the stage name, doing nothing when disabled.
+    """
+    return StageTimer(active, name) if active is not None else NULL_TIMER
+
+
+def iterate(name, iterable):
+    """
+    Time every step of the iteration under the stage name, for the generators whose work is done as they are consumed.
+    :return: The iterable itself when disabled.
+    """
+    if active is None:
+        return iterable
+    return timed_iteration(name, iterable)
+
+
+def timed_iteration(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
+
+
+def begin_tomogram():
+    if active is not None:
+        active.begin_tomogram()
+
+
+def end_tomogram(info):
+    """
+    :return: The report of the tomogram, None when disabled.
+    """
+    return active.end_tomogram(info) if active is not None else None
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+
+from Constants import JUNK_ID
+from Hashing import file_hash
+from Pipeline import atomic_write
+
+NPZ_EXTENSION = '.npz'
+STAR_EXTENSION = '.star'
+COORDS_EXTENSIONS = ('.coords', '.txt')
+RESULT_EXTENSIONS = (NPZ_EXTENSION, STAR_EXTENSION) + COORDS_EXTENSIONS
+
+
+def is_result_path(path):
+    return str(path).lower().endswith(RESULT_EXTENSIONS)
+
+
+def picked_rows(table):
+    # The text formats only list the particles, not the junk
+    return np.flatnonzero(table.labels != JUNK_ID)
+
+
+def write_npz(path, table, source_path, source_hash):
+    columns = dict(positions=table.positions, tilt_ids=table.tilt_ids, labels=table.labels,
+                   suggested_labels=table.suggested_labels, scores=table.scores,
+                   source_path=np.array(source_path), source_hash=np.array(source_hash))
+    if table.features is not None:
+        columns['features'] = table.features
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, **columns)
+
+
+def write_star_header(file):
+    # RELION style particles STAR file, coordinates in voxels and class numbers starting from 1
+    file.write('data_particles\n\nloop_\n')
+    for number, name in enumerate(('_rlnMicrographName', '_rlnCoordinateX', '_rlnCoordinateY', '_rlnCoordinateZ',
+                                   '_rlnClassNumber', '_rlnAutopickFigureOfMerit')):
+        file.write('%s #%d\n' % (name, number + 1))
+
+
+def write_star_rows(file, source_path, positions, labels, scores):
+    for row in np.flatnonzero(labels != JUNK_ID):
+        x, y, z = positions[row]
+        file.write('%s %d %d %d %d %g\n' % (source_path, x, y, z, labels[row] + 1, scores[row]))
+
+
+def write_star(path, table, source_path, source_hash):
+    with open(path, 'w') as file:
+        file.write('# source %s sha256 %s\n\n' % (source_path, source_hash))
+        write_star_header(file)
+        write_star_rows(file, source_path, table.positions, table.labels, table.scores)
+
+
+def write_coords(path, table, source_path, source_hash):
+    # One particle per line: x y z label tilt_id
+    with open(path, 'w') as file:
+        file.write('# source %s sha256 %s\n' % (source_path, source_hash))
+        for row in picked_rows(table):
+            x, y, z = table.positions[row]
+            file.write('%d %d %d %d %d\n' % (x, y, z, table.labels[row], table.tilt_ids[row]))
+
+
+def write_results(path, table, source_path):
+    """
+    Save the evaluation results of a tomogram. Only the candidate table is saved, the tomogram is referenced by its
+    path and content hash. The format is chosen by the extension: .npz keeps all the columns, .star and .coords/.txt
+    list the picked particles.
+    :param path: Path of the results file.
+    :param table: The CandidateTable of the tomogram.
+    :param source_path: Path of the evaluated tomogram.
+    """
+    source_hash = file_hash(source_path)
+    source_path = os.path.abspath(source_path)
+    lower_path = str(path).lower()
+    if lower_path.endswith(NPZ_EXTENSION):
+        write = write_npz
+    elif lower_path.endswith(STAR_EXTENSION):
+        write = write_star
+    elif lower_path.endswith(COORDS_EXTENSIONS):
+        write = write_coords
+    else:
+        raise NotImplementedError('No result format for %s' % path)
+    atomic_write(path, lambda temporary_path: write(temporary_path, table, source_path, source_hash))
+
+
+def read_npz_results(path):
+    """
+    :param path: Path of an .npz results file.
+    :return: A dictionary of the saved columns.
+    """
+    with np.load(path) as data:
+        return dict([(name, data[name]) for name in data.files])
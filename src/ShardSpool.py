@@ -0,0 +1,307 @@
+import subprocess
+import threading
+import socket
+import json
+import time
+import sys
+import os
+import numpy as np
+
+from TemplateFactory import TemplateFactory, Generator
+from TomogramFactory import load_tomogram
+from AnalyzeTomogram import analyze_tomogram, analyze_tomogram_table, TRAIN_OUTPUTS, EVAL_OUTPUTS
+from Pipeline import atomic_write
+import CandidateSelector
+import FeaturesExtractor
+import TiltFinder
+import Labeler
+import ResultWriter
+from SvmEval import load_svm, create_analyzers, write_output
+from SvmTrain import features_hash
+
+# A spool is a directory on a filesystem shared by the nodes:
+#   spool.json      what to run (KIND_EVAL or KIND_FEATURES), the templates, the tomograms and the outputs
+#   pending/        <shard>.json files waiting for a worker
+#   leases/         <shard>.json.<worker> files of the shards being worked on, renewed by touching them
+#   done/           <shard>.json files of the finished shards
+#   results/        <tomogram index>.npz per tomogram results, written atomically so a shard run twice is harmless
+# A shard is only ever in one of pending/, leases/ or done/, it moves between them by atomic renames.
+KIND_EVAL = 'eval'
+KIND_FEATURES = 'features'
+SUPPORTED_KINDS = (KIND_EVAL, KIND_FEATURES)
+
+DEFAULT_SHARD_SIZE = 1
+DEFAULT_LEASE_SECONDS = 60.0
+DEFAULT_POLL_INTERVAL = 1.0
+
+SPOOL_NAME = 'spool.json'
+PENDING = 'pending'
+LEASES = 'leases'
+DONE = 'done'
+RESULTS = 'results'
+
+
+def json_dump(path, value):
+    def write(temporary_path):
+        with open(temporary_path, 'w') as file:
+            json.dump(value, file)
+    atomic_write(path, write)
+
+
+def json_load(path):
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def result_path(spool_path, tomogram_index):
+    return os.path.join(spool_path, RESULTS, '%d.npz' % tomogram_index)
+
+
+def create_spool(spool_path, kind, template_paths, tomogram_paths, out_paths=None, svm_path=None,
+                 shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Split the tomograms into shards waiting in a new spool.
+    :param spool_path: The spool directory, on a filesystem all the nodes see.
+    :param kind: KIND_EVAL to evaluate the tomograms or KIND_FEATURES for the feature phase of the training.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_paths: List of paths to the tomograms.
+    :param out_paths: For KIND_EVAL, optional list of the result paths of the tomograms (see svm_eval).
+    :param svm_path: For KIND_EVAL, path of the SVM.
+    :param shard_size: Number of tomograms per shard.
+    """
+    assert kind in SUPPORTED_KINDS
+    assert kind != KIND_EVAL or svm_path is not None
+    for directory in (PENDING, LEASES, DONE, RESULTS):
+        os.makedirs(os.path.join(spool_path, directory), exist_ok=True)
+
+    # Absolute paths, the workers may run from other directories
+    absolute = lambda paths: [os.path.abspath(path) for path in paths] if paths is not None else None
+    json_dump(os.path.join(spool_path, SPOOL_NAME),
+              {'kind': kind, 'svm': absolute([svm_path])[0] if svm_path is not None else None,
+               'templates': absolute(template_paths), 'tomograms': absolute(tomogram_paths),
+               'outs': absolute(out_paths)})
+    shard_count = 0
+    for start in range(0, len(tomogram_paths), shard_size):
+        json_dump(os.path.join(spool_path, PENDING, '%06d.json' % shard_count),
+                  {'shard': shard_count, 'tomograms': list(range(start, min(start + shard_size,
+                                                                            len(tomogram_paths))))})
+        shard_count += 1
+    print('Created spool %s with %d shards' % (spool_path, shard_count))
+
+
+def requeue_expired(spool_path, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Move back to pending/ the shards whose lease was not renewed for lease_seconds.
+    :return: The number of requeued shards.
+    """
+    requeued = 0
+    leases_path = os.path.join(spool_path, LEASES)
+    for name in os.listdir(leases_path):
+        path = os.path.join(leases_path, name)
+        try:
+            if time.time() - os.stat(path).st_mtime < lease_seconds:
+                continue
+            shard_name = name[:name.index('.json') + len('.json')]
+            os.rename(path, os.path.join(spool_path, PENDING, shard_name))
+            requeued += 1
+        except (OSError, ValueError):
+            # Renewed, finished or requeued by someone else in between
+            continue
+    return requeued
+
+
+class Lease:
+    """
+    A claimed shard. A thread touches the lease file while the shard is worked on, if the file disappears the shard was
+    requeued and the lease is lost.
+    """
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+        self.thread.start()
+
+    def renew(self):
+        while not self.finished.wait(self.lease_seconds / 3):
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost = True
+                return
+
+    def release(self, done_path):
+        """
+        Stop renewing and mark the shard done.
+        :return: False if the lease was lost, the shard is then left to the worker which claimed it again.
+        """
+        self.finished.set()
+        self.thread.join()
+        try:
+            os.rename(self.path, done_path)
+            return True
+        except OSError:
+            self.lost = True
+            return False
+
+
+def claim_shard(spool_path, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    :return: A tuple of the shard dictionary and its Lease, or None if no shard is pending.
+    """
+    pending_path = os.path.join(spool_path, PENDING)
+    for name in sorted(os.listdir(pending_path)):
+        lease_path = os.path.join(spool_path, LEASES, '%s.%s' % (name, worker_id))
+        try:
+            # Only one of the workers renaming the same file succeeds
+            os.rename(os.path.join(pending_path, name), lease_path)
+        except OSError:
+            continue
+        os.utime(lease_path)
+        return json_load(lease_path), Lease(lease_path, lease_seconds)
+    return None
+
+
+class ShardWorker:
+    """
+    Claims and runs shards of a spool until none is left. The SVM and the templates are loaded once.
+    """
+    def __init__(self, spool_path, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.spool_path = spool_path
+        self.worker_id = worker_id if worker_id is not None else '%s-%d' % (socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.spool = json_load(os.path.join(spool_path, SPOOL_NAME))
+
+        templates = list(TemplateFactory(Generator.LOAD).set_paths(self.spool['templates']).build())
+        if self.spool['kind'] == KIND_EVAL:
+            svm, _ = load_svm(self.spool['svm'])
+            self.labeler, self.features_extractor, self.candidate_selector, self.tilt_finder = \
+                create_analyzers(svm, templates)
+        else:
+            self.labeler = None
+            self.features_extractor = FeaturesExtractor.FeaturesExtractor(templates)
+            self.candidate_selector = CandidateSelector.CandidateSelector(templates)
+            self.tilt_finder = TiltFinder.TiltFinder(templates)
+
+    def run_tomogram(self, tomogram_index):
+        tomogram_path = self.spool['tomograms'][tomogram_index]
+        tomogram = load_tomogram(tomogram_path)
+        if self.spool['kind'] == KIND_EVAL:
+            (candidates, table) = analyze_tomogram_table(tomogram, self.labeler, self.features_extractor,
+                                                         self.candidate_selector, self.tilt_finder, set_labels=True,
+                                                         outputs=EVAL_OUTPUTS)
+            if self.spool['outs'] is not None:
+                write_output(self.spool['outs'][tomogram_index], tomogram, table, tomogram_path)
+            ResultWriter.write_results(result_path(self.spool_path, tomogram_index), table, tomogram_path)
+        else:
+            labeler = Labeler.PositionLabeler(tomogram.composition)
+            (candidates, feature_vectors, labels) = analyze_tomogram(tomogram, labeler, self.features_extractor,
+                                                                     self.candidate_selector, self.tilt_finder,
+                                                                     outputs=TRAIN_OUTPUTS)
+            x = np.array(feature_vectors, dtype=float).reshape(len(candidates), len(self.features_extractor.templates))
+
+            def write(temporary_path):
+                with open(temporary_path, 'wb') as file:
+                    np.savez(file, x=x, y=np.array(labels))
+            atomic_write(result_path(self.spool_path, tomogram_index), write)
+
+    def run(self):
+        """
+        :return: The number of shards this worker finished.
+        """
+        finished = 0
+        while True:
+            requeue_expired(self.spool_path, self.lease_seconds)
+            claimed = claim_shard(self.spool_path, self.worker_id, self.lease_seconds)
+            if claimed is None:
+                if len(os.listdir(os.path.join(self.spool_path, LEASES))) == 0:
+                    return finished
+                # Other workers hold the remaining shards, wait in case their leases expire
+                time.sleep(self.poll_interval)
+                continue
+
+            shard, lease = claimed
+            for tomogram_index in shard['tomograms']:
+                if lease.lost:
+                    break
+                self.run_tomogram(tomogram_index)
+            done_path = os.path.join(self.spool_path, DONE, '%06d.json' % shard['shard'])
+            if not lease.lost and lease.release(done_path):
+                finished += 1
+                print('%s finished shard %d' % (self.worker_id, shard['shard']))
+            else:
+                lease.finished.set()
+                print('%s lost the lease of shard %d' % (self.worker_id, shard['shard']))
+
+
+def spool_status(spool_path):
+    return dict([(directory, len(os.listdir(os.path.join(spool_path, directory))))
+                 for directory in (PENDING, LEASES, DONE)])
+
+
+def merge(spool_path, out_path):
+    """
+    Merge the per tomogram results of a finished spool.
+    KIND_FEATURES spools give the features cache of load_or_build_features (train -f / tune -f).
+    KIND_EVAL spools give a single .npz of all the candidate tables with a tomogram column, or a .star of all the
+    picked particles.
+    :param spool_path: The spool directory.
+    :param out_path: Path of the merged output.
+    """
+    status = spool_status(spool_path)
+    if status[PENDING] != 0 or status[LEASES] != 0:
+        raise RuntimeError('Spool %s is not finished: %d shards pending and %d leased' %
+                           (spool_path, status[PENDING], status[LEASES]))
+    spool = json_load(os.path.join(spool_path, SPOOL_NAME))
+    results = [ResultWriter.read_npz_results(result_path(spool_path, index))
+               for index in range(len(spool['tomograms']))]
+
+    if spool['kind'] == KIND_FEATURES:
+        x = np.concatenate([result['x'] for result in results])
+        y = np.concatenate([result['y'] for result in results])
+        groups = np.concatenate([[index] * len(result['y']) for index, result in enumerate(results)]).astype(int)
+
+        def write(temporary_path):
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, x=x, y=y, groups=groups, template_paths=np.array(spool['templates']),
+                         tomogram_paths=np.array(spool['tomograms']),
+                         inputs_hash=np.array(features_hash(spool['templates'], spool['tomograms']) or ''))
+        atomic_write(out_path, write)
+    elif str(out_path).lower().endswith(ResultWriter.STAR_EXTENSION):
+        atomic_write(out_path, lambda temporary_path: write_merged_star(temporary_path, results))
+    else:
+        columns = dict([(name, np.concatenate([result[name] for result in results]))
+                        for name in ('positions', 'tilt_ids', 'labels', 'suggested_labels', 'scores')])
+        columns['tomograms'] = np.concatenate([[index] * len(result['labels'])
+                                               for index, result in enumerate(results)]).astype(int)
+        columns['tomogram_paths'] = np.array(spool['tomograms'])
+
+        def write(temporary_path):
+            with open(temporary_path, 'wb') as file:
+                np.savez_compressed(file, **columns)
+        atomic_write(out_path, write)
+    print('Merged %d tomograms of %s into %s' % (len(results), spool_path, out_path))
+
+
+def write_merged_star(path, results):
+    with open(path, 'w') as file:
+        ResultWriter.write_star_header(file)
+        for result in results:
+            ResultWriter.write_star_rows(file, result['source_path'], result['positions'], result['labels'],
+                                         result['scores'])
+
+
+def run_local(spool_path, n_workers, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Run n_workers worker processes on this machine, standing in for the nodes, and wait for them.
+    """
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Main.py')
+    workers = [subprocess.Popen([sys.executable, main_path, 'worker', spool_path, '--lease', str(lease_seconds),
+                                 '--id', 'local%d' % index])
+               for index in range(n_workers)]
+    for worker in workers:
+        worker.wait()
+    print('Spool %s: %s' % (spool_path, spool_status(spool_path)))
@@ -0,0 +1,32 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+from CommonDataTypes import TemplateBank
+
+
+def publish_bank(bank):
+    """
+    Copy the density maps of a TemplateBank into a new shared memory block, so worker processes map them instead of
+    receiving a pickled copy each.
+    :param bank: TemplateBank
+    :return: A tuple of the SharedMemory, which the caller closes and unlinks when the workers are done, and the small
+    picklable descriptor to pass to attach_bank.
+    """
+    density_maps = np.ascontiguousarray(bank.density_maps)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, density_maps.nbytes))
+    np.ndarray(density_maps.shape, dtype=density_maps.dtype, buffer=memory.buf)[...] = density_maps
+    descriptor = {'name': memory.name, 'shape': density_maps.shape, 'dtype': density_maps.dtype.str,
+                  'template_ids': bank.template_ids, 'tilt_ids': bank.tilt_ids}
+    return memory, descriptor
+
+
+def attach_bank(descriptor):
+    """
+    Map a bank published by publish_bank. The density maps are read only.
+    :param descriptor: The descriptor returned by publish_bank.
+    :return: A tuple of the TemplateBank and the SharedMemory, which must stay referenced while the bank is used.
+    """
+    memory = shared_memory.SharedMemory(name=descriptor['name'])
+    density_maps = np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=memory.buf)
+    density_maps.flags.writeable = False
+    return TemplateBank(density_maps, descriptor['template_ids'], descriptor['tilt_ids']), memory
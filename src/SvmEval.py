@@ -1,46 +1,213 @@
+from concurrent.futures import ProcessPoolExecutor
 import pickle
+import os
 
 from TomogramGenerator import generate_tomogram_with_given_candidates
-from CommonDataTypes import Tomogram
+from CommonDataTypes import Tomogram, TemplateBank
 from TemplateFactory import TemplateFactory, Generator
-from TomogramFactory import TomogramFactory
+from TomogramFactory import TomogramFactory, load_tomogram, save_tomogram
 import Labeler
 import CandidateSelector
 import FeaturesExtractor
 import TiltFinder
-from AnalyzeTomogram import analyze_tomogram
+from AnalyzeTomogram import analyze_tomogram_table, EVAL_OUTPUTS
+import ResultWriter
+from Pipeline import PipelineTimer, BackgroundWriter, DEFAULT_PREFETCH_DEPTH
+from Classifiers import pass_through_rates
+from SharedBank import publish_bank, attach_bank
+from CorrelationCache import CorrelationCache, DEFAULT_CACHE_BYTES
+import Profiling
 
 
+def load_svm(svm_path):
+    """
+    :return: A tuple of the SVM and the classifier which sees the fully computed feature vectors.
+    """
+    with open(svm_path, 'rb') as file:
+        svm = pickle.load(file)
+    full_svm = svm.svm if hasattr(svm, 'feature_order') else svm
+    return svm, full_svm
+
+
+def create_analyzers(svm, templates, correlation_cache=None, scan_settings=None):
+    """
+    :param correlation_cache: Optional CorrelationCache serving the candidate selector and the features extractor.
+    :param scan_settings: The tile size and batch size of the candidate selector's scan, None for the machine profile's.
+    :return: A tuple of the labeler, the features extractor, the candidate selector and the tilt finder.
+    """
+    labeler = Labeler.SvmLabeler(svm)
+    candidate_selector = CandidateSelector.CandidateSelector(templates, correlation_cache=correlation_cache,
+                                                             scan_settings=scan_settings)
+    if hasattr(svm, 'feature_order'):
+        # A staged classifier, compute only the features it needs
+        features_extractor = FeaturesExtractor.LazyFeaturesExtractor(templates, svm, correlation_cache)
+    else:
+        features_extractor = FeaturesExtractor.FeaturesExtractor(templates, correlation_cache)
+    tilt_finder = TiltFinder.TiltFinder(templates)
+    return labeler, features_extractor, candidate_selector, tilt_finder
+
+
+def write_output(out_path, tomogram, table, tomogram_path):
+    # Result formats are written directly, other paths get the legacy pickle of the whole tomogram
+    if ResultWriter.is_result_path(out_path):
+        ResultWriter.write_results(out_path, table, tomogram_path)
+    else:
+        save_tomogram(out_path, tomogram)
+
+
+def reset_counters(full_svm, features_extractor):
+    if hasattr(full_svm, 'reset_counters'):
+        full_svm.reset_counters()
+    if hasattr(features_extractor, 'mean_features_computed'):
+        features_extractor.features_computed = 0
+        features_extractor.candidates_count = 0
+
+
+def collect_counters(full_svm, features_extractor):
+    """
+    :return: Dictionary of the counters of the lazy features extractor and the cascade, None for those not used.
+    """
+    lazy = hasattr(features_extractor, 'mean_features_computed')
+    return {'features_computed': features_extractor.features_computed if lazy else None,
+            'candidates_count': features_extractor.candidates_count if lazy else None,
+            'stage_counts': list(full_svm.stage_counts) if hasattr(full_svm, 'stage_counts') else None}
+
+
+def sum_counters(counters_list):
+    total = dict(counters_list[0])
+    for counters in counters_list[1:]:
+        for key, value in counters.items():
+            if value is None:
+                continue
+            total[key] = [a + b for a, b in zip(total[key], value)] if isinstance(value, list) else total[key] + value
+    return total
+
+
+def print_counters(counters, template_count):
+    if counters['candidates_count'] is not None:
+        mean = counters['features_computed'] / counters['candidates_count'] if counters['candidates_count'] else 0.0
+        print('Mean features computed per candidate: %.2f of %d' % (mean, template_count))
+    if counters['stage_counts'] is not None:
+        for stage, rate in zip(('prefilter', 'svm'), pass_through_rates(counters['stage_counts'])):
+            print('Stage %s pass-through rate: %.3f' % (stage, rate))
 
-def svm_eval(svm_path, template_paths, tomogram_paths, out_paths):
+
+# The state of an evaluation worker process, set once by init_worker
+worker_state = {}
+
+
+def init_worker(svm_path, bank_descriptor, correlation_cache, profile, scan_settings):
+    if profile is not None:
+        Profiling.enable(**profile)
+    svm, full_svm = load_svm(svm_path)
+    templates, memory = attach_bank(bank_descriptor)
+    worker_state.update(full_svm=full_svm, memory=memory,
+                        analyzers=create_analyzers(svm, templates, correlation_cache, scan_settings))
+
+
+def evaluate_in_worker(tomogram_path, out_path):
+    """
+    Evaluate a single tomogram in a worker process and write its output.
+    :return: A tuple of the counters of this tomogram (see collect_counters) and its Profiling report, None when the
+    profiling is disabled.
+    """
+    labeler, features_extractor, candidate_selector, tilt_finder = worker_state['analyzers']
+    reset_counters(worker_state['full_svm'], features_extractor)
+
+    tomogram = load_tomogram(tomogram_path)
+    (candidates, table) = analyze_tomogram_table(tomogram, labeler, features_extractor, candidate_selector,
+                                                 tilt_finder, set_labels=True, outputs=EVAL_OUTPUTS)
+    write_output(out_path, tomogram, table, tomogram_path)
+    profile = Profiling.active.tomograms.pop() if Profiling.active is not None else None
+    return collect_counters(worker_state['full_svm'], features_extractor), profile
+
+
+def largest_first(paths):
+    # Starting with the longest jobs balances the workers when the tomogram sizes differ
+    sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths]
+    return sorted(range(len(paths)), key=lambda index: -sizes[index])
+
+
+def svm_eval_parallel(svm_path, templates, tomogram_paths, out_paths, n_jobs, correlation_cache=None,
+                      scan_settings=None):
+    """
+    Evaluate the tomograms in a pool of n_jobs processes. The template bank is published once in shared memory and
+    every worker loads the SVM once. Each tomogram's output is written to its own out path, so the order is kept.
+    :return: The counters summed over the tomograms, see collect_counters.
+    """
+    bank = templates if isinstance(templates, TemplateBank) else TemplateBank.fromTemplates(templates)
+    memory, descriptor = publish_bank(bank)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker,
+                                 initargs=(svm_path, descriptor, correlation_cache,
+                                           {'memory': Profiling.active.memory}
+                                           if Profiling.active is not None else None, scan_settings)) as executor:
+            order = largest_first(tomogram_paths)
+            futures = dict([(index, executor.submit(evaluate_in_worker, tomogram_paths[index], out_paths[index]))
+                            for index in order])
+            counters_list = []
+            for index in range(len(tomogram_paths)):
+                counters, profile = futures[index].result()
+                counters_list.append(counters)
+                if profile is not None:
+                    Profiling.active.add_tomogram(profile)
+    finally:
+        memory.close()
+        memory.unlink()
+    return sum_counters(counters_list)
+
+
+def svm_eval(svm_path, template_paths, tomogram_paths, out_paths, prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+             memory_cap=None, n_jobs=1, correlation_cache_path=None, correlation_cache_bytes=DEFAULT_CACHE_BYTES,
+             scan_settings=None):
     """
     Evaluate the tomograms using the specified templates. If no candidates are present creates them. Labels all the
     candidates using the SVM.
     :param svm_path: Path from which the SVM will be loaded.
     :param template_paths: List of paths to the templates.
     :param tomogram_paths: List of paths to the tomograms.
-    :param out_paths: List of paths to which the results of the evaluation of the tomograms will be saved.
+    :param out_paths: List of paths to which the results of the evaluation of the tomograms will be saved. The format
+    is chosen by the extension, see ResultWriter.write_results.
+    :param prefetch_depth: Number of tomograms loaded in the background ahead of the one being evaluated.
+    :param memory_cap: Maximal bytes of tomograms loaded at once by the prefetching.
+    :param n_jobs: Number of tomograms evaluated in parallel by worker processes. 1 evaluates them in this process.
+    :param correlation_cache_path: Directory of a CorrelationCache, None to always compute the correlations.
+    :param correlation_cache_bytes: Maximal size of the CorrelationCache.
+    :param scan_settings: The tile size and batch size of the scan (see JobPlanner.plan), None for the machine
+    profile's.
     """
     print('Starting evaluation')
-    # Load the data
-    with open(svm_path, 'rb') as file:
-        svm = pickle.load(file)
     templates = list(TemplateFactory(Generator.LOAD).set_paths(template_paths).build())
+    correlation_cache = CorrelationCache(correlation_cache_path, correlation_cache_bytes) \
+        if correlation_cache_path is not None else None
 
-    labeler = Labeler.SvmLabeler(svm)
-    candidate_selector = CandidateSelector.CandidateSelector(templates)
-    features_extractor = FeaturesExtractor.FeaturesExtractor(templates)
-    tilt_finder = TiltFinder.TiltFinder(templates)
+    if n_jobs > 1 and len(tomogram_paths) > 1:
+        counters = svm_eval_parallel(svm_path, templates, tomogram_paths, out_paths,
+                                     min(n_jobs, len(tomogram_paths)), correlation_cache, scan_settings)
+        print_counters(counters, len(templates))
+        print('Evaluation finished')
+        return
 
-    tomograms = TomogramFactory(None).set_paths(tomogram_paths).build()
-    tomogram_outs = TomogramFactory(None).set_paths(out_paths).set_save(True).build()
+    # Load the data
+    svm, full_svm = load_svm(svm_path)
+    labeler, features_extractor, candidate_selector, tilt_finder = create_analyzers(svm, templates, correlation_cache,
+                                                                                   scan_settings)
+    reset_counters(full_svm, features_extractor)
 
-    for tomogram, save_tomogram in zip(tomograms, tomogram_outs):
+    timer = PipelineTimer()
+    tomograms = TomogramFactory(None).set_paths(tomogram_paths).set_prefetch(prefetch_depth, memory_cap, timer).build()
 
-        # Analyze the tomogram
-        (candidates, feature_vectors, predicted_labels) = analyze_tomogram(tomogram, labeler, features_extractor,
-                                                                           candidate_selector, tilt_finder, set_labels=True)
+    with BackgroundWriter(timer=timer) as writer:
+        for tomogram, tomogram_path, out_path in zip(tomograms, tomogram_paths, out_paths):
 
-        save_tomogram(tomogram)
+            # Analyze the tomogram
+            (candidates, table) = analyze_tomogram_table(tomogram, labeler, features_extractor, candidate_selector,
+                                                         tilt_finder, set_labels=True, outputs=EVAL_OUTPUTS)
+            writer.submit(write_output, out_path, tomogram, table, tomogram_path)
 
+    print(timer.report())
+    if correlation_cache is not None:
+        print('Correlation cache: %(hits)d hits, %(misses)d misses, %(too_large)d too large to cache' %
+              correlation_cache.stats())
+    print_counters(collect_counters(full_svm, features_extractor), len(templates))
     print('Evaluation finished')
@@ -1,6 +1,8 @@
-from sklearn.svm import SVC
 import numpy as np
+import hashlib
 import pickle
+import json
+import os
 
 from TemplateFactory import TemplateFactory
 from TomogramFactory import TomogramFactory
@@ -8,57 +10,210 @@ import CandidateSelector
 import FeaturesExtractor
 import Labeler
 import TiltFinder
+from Classifiers import CascadeClassifier, StagedClassifier, create_classifier, MULTICLASS_OVO
 
-from AnalyzeTomogram import analyze_tomogram
+from AnalyzeTomogram import analyze_tomogram, TRAIN_OUTPUTS
+from Pipeline import PipelineTimer, DEFAULT_PREFETCH_DEPTH
+from FeatureStore import FeatureStore
+from Hashing import templates_hash, paths_hash
+from CorrelationCache import CorrelationCache, DEFAULT_CACHE_BYTES
 
-def svm_train(svm_path, template_paths, tomogram_paths, source_svm=None, template_generator=None,
-              generate_tomograms=False):
+
+def build_training_set(template_paths, tomogram_paths, template_generator=None, generate_tomograms=False,
+                       prefetch_depth=DEFAULT_PREFETCH_DEPTH, memory_cap=None, checkpoint_path=None,
+                       correlation_cache_path=None, correlation_cache_bytes=DEFAULT_CACHE_BYTES):
     """
-    Train an SVM using the templates and tomograms specified. If template_generator is not None then the templates will
-    be generated. If generate_tomograms is True then the tomograms will be generated using the templates.
-    The result will be saved in svm_path. The SVM can start from an existing one given in source_svm.
-    :param svm_path: Path in which the SVM will be saved.
+    Run the candidate selection and the feature extraction on all the tomograms and label the candidates.
+    With a checkpoint_path every tomogram's features are saved to a FeatureStore as soon as they are computed, and the
+    tomograms already in the store (same path, content and templates) are skipped. Generated tomograms are new on every
+    run so they cannot be checkpointed.
     :param template_paths: List of paths to the templates.
     :param tomogram_paths: List of paths to the tomograms.
-    :param source_svm: Path to a source SVM to start with.
     :param template_generator: The generator to use for the templates. Choose from SUPPORTED_GENERATORS.
     :param generate_tomograms: Bool indicating whether to generate tomograms.
+    :param prefetch_depth: Number of tomograms loaded in the background ahead of the one being analyzed.
+    :param memory_cap: Maximal bytes of tomograms loaded at once by the prefetching.
+    :param checkpoint_path: Directory of the FeatureStore, None to keep the features only in memory. Not with
+    generate_tomograms.
+    :param correlation_cache_path: Directory of a CorrelationCache, None to always compute the correlations.
+    :param correlation_cache_bytes: Maximal size of the CorrelationCache.
+    :return: A tuple of the feature vectors, the labels and the index of the tomogram each candidate came from.
     """
-    print('Starting training...')
+    if generate_tomograms and checkpoint_path is not None:
+        raise ValueError('Generated tomograms cannot be checkpointed, a restarted run generates other tomograms')
+
     gf_templates = TemplateFactory(template_generator if template_generator is not None else 'LOAD')
     gf_templates.set_paths(template_paths)
     templates = list(gf_templates.build())
 
+    # The indices of the tomograms to analyze, the others are loaded from the checkpoint
+    pending = list(range(len(tomogram_paths)))
+    if checkpoint_path is not None:
+        store = FeatureStore(checkpoint_path)
+        bank_hash = templates_hash(templates)
+        keys = [FeatureStore.key(path, bank_hash) for path in tomogram_paths]
+        pending = [index for index, key in enumerate(keys) if key not in store]
+        if len(pending) != len(tomogram_paths):
+            print('Resuming from %s: %d of %d tomograms already done' %
+                  (checkpoint_path, len(tomogram_paths) - len(pending), len(tomogram_paths)))
+
     gf_tomograms = TomogramFactory(templates if generate_tomograms else None)
-    gf_tomograms.set_paths(tomogram_paths)
+    gf_tomograms.set_paths([tomogram_paths[index] for index in pending])
+    timer = PipelineTimer()
+    gf_tomograms.set_prefetch(prefetch_depth, memory_cap, timer)
     tomograms = gf_tomograms.build()
 
-    candidate_selector = CandidateSelector.CandidateSelector(templates)
-    features_extractor = FeaturesExtractor.FeaturesExtractor(templates)
+    correlation_cache = CorrelationCache(correlation_cache_path, correlation_cache_bytes) \
+        if correlation_cache_path is not None else None
+    candidate_selector = CandidateSelector.CandidateSelector(templates, correlation_cache=correlation_cache)
+    features_extractor = FeaturesExtractor.FeaturesExtractor(templates, correlation_cache)
     tilt_finder = TiltFinder.TiltFinder(templates)
 
-    # Training
-
     feature_vectors = []
     # a label is a template_id, where -1 is junk
     labels = []
+    # the tomogram of each candidate, used to keep tomograms whole when splitting for cross validation
+    groups = []
 
     # Generate the training set
-    for tomogram in tomograms:
+    for tomogram_index, tomogram in zip(pending, tomograms):
         labeler = Labeler.PositionLabeler(tomogram.composition)
 
         (candidates, single_iteration_feature_vectors, single_iteration_labels) = \
-            analyze_tomogram(tomogram, labeler, features_extractor, candidate_selector, tilt_finder)
+            analyze_tomogram(tomogram, labeler, features_extractor, candidate_selector, tilt_finder,
+                             outputs=TRAIN_OUTPUTS)
+
+        if checkpoint_path is not None:
+            x = np.array(single_iteration_feature_vectors, dtype=float).reshape(len(candidates), len(templates))
+            store.append(keys[tomogram_index], tomogram_paths[tomogram_index], x, np.array(single_iteration_labels))
+            continue
 
         feature_vectors.extend(single_iteration_feature_vectors)
         labels.extend(single_iteration_labels)
+        groups.extend([tomogram_index] * len(candidates))
+
+    if not generate_tomograms:
+        print(timer.report())
+    if correlation_cache is not None:
+        print('Correlation cache: %(hits)d hits, %(misses)d misses, %(too_large)d too large to cache' %
+              correlation_cache.stats())
+
+    if checkpoint_path is not None:
+        # Collect all the tomograms from the store, in the order of the paths
+        for tomogram_index, key in enumerate(keys):
+            x, y = store.load(key)
+            feature_vectors.extend(x.tolist())
+            labels.extend(y.tolist())
+            groups.extend([tomogram_index] * len(y))
+    return feature_vectors, labels, groups
+
+
+def absolute_paths(paths):
+    return [os.path.abspath(str(path)) for path in paths]
+
+
+def features_hash(template_paths, tomogram_paths, template_generator=None):
+    """
+    :return: The hex SHA-256 identifying the inputs of a features cache: the template generator and the contents of
+    the templates and the tomograms. None if one of the paths does not exist (yet).
+    """
+    paths = list(template_paths) + list(tomogram_paths)
+    if not all([os.path.exists(path) for path in paths]):
+        return None
+    generator = template_generator if template_generator is not None else 'LOAD'
+    identity = json.dumps([generator, len(template_paths), paths_hash(paths)])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def load_or_build_features(features_path, template_paths, tomogram_paths, template_generator=None,
+                           generate_tomograms=False):
+    """
+    Load the training set from the features cache if it was built from the same paths and the same contents of the
+    templates and the tomograms, otherwise build it and save it.
+    :param features_path: Path of the .npz features cache. If None nothing is cached.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_paths: List of paths to the tomograms.
+    :param template_generator: The generator to use for the templates. Choose from SUPPORTED_GENERATORS.
+    :param generate_tomograms: Bool indicating whether to generate tomograms.
+    :return: A tuple of the feature matrix, the labels and the tomogram index of each candidate.
+    """
+    if features_path is not None and os.path.exists(features_path):
+        cache = np.load(features_path)
+        inputs_hash = features_hash(template_paths, tomogram_paths, template_generator)
+        # merge writes absolute paths, the paths given may be relative
+        if absolute_paths(cache['template_paths']) != absolute_paths(template_paths) or \
+                absolute_paths(cache['tomogram_paths']) != absolute_paths(tomogram_paths):
+            print('Features cache %s was built from other paths, rebuilding it' % features_path)
+        elif 'inputs_hash' not in cache.files or inputs_hash is None or str(cache['inputs_hash']) != inputs_hash:
+            print('Features cache %s was built from other contents, rebuilding it' % features_path)
+        else:
+            print('Using cached features from %s' % features_path)
+            return cache['x'], cache['y'], cache['groups']
+
+    feature_vectors, labels, groups = build_training_set(template_paths, tomogram_paths, template_generator,
+                                                         generate_tomograms)
+    x = np.array(feature_vectors)
+    y = np.array(labels)
+    groups = np.array(groups)
+
+    if features_path is not None:
+        # Hashed after the build, generated templates and tomograms are written by it
+        inputs_hash = features_hash(template_paths, tomogram_paths, template_generator)
+        with open(features_path, 'wb') as file:
+            np.savez(file, x=x, y=y, groups=groups, template_paths=np.array(template_paths),
+                     tomogram_paths=np.array(tomogram_paths), inputs_hash=np.array(inputs_hash or ''))
+    return x, y, groups
+
+
+def svm_train(svm_path, template_paths, tomogram_paths, source_svm=None, template_generator=None,
+              generate_tomograms=False, cascade=False, multiclass=MULTICLASS_OVO, top_k=None, n_jobs=None,
+              lazy=False, prefetch_depth=DEFAULT_PREFETCH_DEPTH, memory_cap=None, checkpoint_path=None,
+              correlation_cache_path=None, correlation_cache_bytes=DEFAULT_CACHE_BYTES, features_path=None):
+    """
+    Train an SVM using the templates and tomograms specified. If template_generator is not None then the templates will
+    be generated. If generate_tomograms is True then the tomograms will be generated using the templates.
+    The result will be saved in svm_path. The SVM can start from an existing one given in source_svm.
+    :param svm_path: Path in which the SVM will be saved.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_paths: List of paths to the tomograms.
+    :param source_svm: Path to a source SVM to start with.
+    :param template_generator: The generator to use for the templates. Choose from SUPPORTED_GENERATORS.
+    :param generate_tomograms: Bool indicating whether to generate tomograms.
+    :param cascade: Bool indicating whether to put a linear junk prefilter in front of the SVM.
+    :param multiclass: The multiclass strategy of a new SVM. Choose from SUPPORTED_MULTICLASS.
+    :param top_k: Number of template scores kept per candidate by the one-vs-rest SVM.
+    :param n_jobs: Number of classes the one-vs-rest SVM trains in parallel.
+    :param lazy: Bool indicating whether to train staged classifiers for the lazy feature computation.
+    :param prefetch_depth: Number of tomograms loaded in the background ahead of the one being analyzed.
+    :param memory_cap: Maximal bytes of tomograms loaded at once by the prefetching.
+    :param checkpoint_path: Directory in which the features of every tomogram are saved as they are computed, so an
+    interrupted run resumes from the last finished tomogram.
+    :param correlation_cache_path: Directory of a CorrelationCache, None to always compute the correlations.
+    :param correlation_cache_bytes: Maximal size of the CorrelationCache.
+    :param features_path: Path of an .npz features cache built from the same paths (see load_or_build_features), e.g.
+    merged from a sharded run. Used instead of extracting the features.
+    """
+    print('Starting training...')
+    if features_path is not None:
+        feature_vectors, labels, _ = load_or_build_features(features_path, template_paths, tomogram_paths,
+                                                            template_generator, generate_tomograms)
+    else:
+        feature_vectors, labels, _ = build_training_set(template_paths, tomogram_paths, template_generator,
+                                                        generate_tomograms, prefetch_depth, memory_cap,
+                                                        checkpoint_path, correlation_cache_path,
+                                                        correlation_cache_bytes)
 
     # Get/Create a SVM
     if source_svm is not None:
         with open(source_svm, 'rb') as file:
             svm = pickle.load(file)
     else:
-        svm = SVC()
+        svm = create_classifier(multiclass, top_k, n_jobs)
+
+    if cascade and not isinstance(svm, CascadeClassifier):
+        svm = CascadeClassifier(svm)
+    if lazy and not isinstance(svm, StagedClassifier):
+        svm = StagedClassifier(svm)
 
     x = np.array(feature_vectors)
     y = np.array(labels)
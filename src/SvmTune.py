@@ -0,0 +1,65 @@
+from sklearn.svm import SVC
+from sklearn.model_selection import GridSearchCV, GroupKFold
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables HalvingGridSearchCV)
+from sklearn.model_selection import HalvingGridSearchCV
+import joblib
+import numpy as np
+import pickle
+
+from SvmTrain import load_or_build_features
+
+SEARCH_GRID = 'grid'
+SEARCH_HALVING = 'halving'
+SUPPORTED_SEARCHES = (SEARCH_GRID, SEARCH_HALVING)
+
+DEFAULT_FOLDS = 5
+PARAM_GRID = {'C': np.logspace(-1, 3, 5),
+              'gamma': ['scale'] + list(np.logspace(-3, 1, 5))}
+
+
+def svm_tune(svm_path, template_paths, tomogram_paths, features_path=None, template_generator=None,
+             generate_tomograms=False, search=SEARCH_GRID, n_jobs=-1, folds=DEFAULT_FOLDS):
+    """
+    Search the SVM hyperparameters with cross validation and save the best SVM. The features are extracted once and
+    cached in features_path so following searches skip the candidate selection and the feature extraction.
+    The folds are grouped by tomogram so candidates of the same tomogram are never split between train and test.
+    :param svm_path: Path in which the best SVM will be saved.
+    :param template_paths: List of paths to the templates.
+    :param tomogram_paths: List of paths to the tomograms.
+    :param features_path: Path of the .npz features cache.
+    :param template_generator: The generator to use for the templates. Choose from SUPPORTED_GENERATORS.
+    :param generate_tomograms: Bool indicating whether to generate tomograms.
+    :param search: The search strategy. Choose from SUPPORTED_SEARCHES.
+    :param n_jobs: Number of worker processes, -1 for all the cores.
+    :param folds: Maximal number of cross validation folds.
+    """
+    print('Starting tuning...')
+    x, y, groups = load_or_build_features(features_path, template_paths, tomogram_paths, template_generator,
+                                          generate_tomograms)
+
+    if len(np.unique(y)) == 1:
+        print("SVM training must contain more than one label type (all candidates are the same label)")
+        exit()
+    group_count = len(np.unique(groups))
+    if group_count < 2:
+        print("Tuning needs at least two tomograms to create grouped folds")
+        exit()
+
+    cv = GroupKFold(n_splits=min(folds, group_count))
+    if search == SEARCH_GRID:
+        searcher = GridSearchCV(SVC(), PARAM_GRID, cv=cv)
+    elif search == SEARCH_HALVING:
+        searcher = HalvingGridSearchCV(SVC(), PARAM_GRID, cv=cv)
+    else:
+        raise NotImplementedError('The search %s is not implemented' % search)
+
+    # Each (parameters, fold) fit runs in its own process
+    with joblib.parallel_backend('loky', n_jobs=n_jobs):
+        searcher.fit(x, y, groups=groups)
+
+    print('Best parameters: %s (score %.3f)' % (searcher.best_params_, searcher.best_score_))
+
+    with open(svm_path, 'wb') as file:
+        pickle.dump(searcher.best_estimator_, file)
+
+    print('Tuning finished!')
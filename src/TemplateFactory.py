@@ -2,7 +2,10 @@ from enum import Enum, auto
 import pickle
 import numpy as np
 
-import TemplateGenerator
+import PackedTemplates
+import LazyTemplateBank
+import Profiling
+from Pipeline import atomic_pickle
 
 
 # TODO: Place holders for template generator
@@ -10,15 +13,35 @@ import TemplateGenerator
 def template_loader(paths, save):
     if not save:
         for path in paths:
+            if PackedTemplates.is_packed(path):
+                yield from packed_template_loader([path])
+                continue
             with open(path, 'rb') as file:
                 yield pickle.load(file)
     else:
         for path in paths:
-            with open(path, 'wb') as file:
-                yield lambda x: pickle.dump(x, file)
+            yield lambda x, path=path: atomic_pickle(path, x)
+
+
+def packed_template_loader(paths):
+    # Every packed bank holds all its templates, the density maps are views of the bank's memory map
+    for path in paths:
+        tilted_templates, template_ids, tilt_ids = PackedTemplates.load_packed_templates(path)
+        for template in tilted_templates:
+            yield template
+
+
+def lazy_template_loader(paths, transform=None, byte_budget=LazyTemplateBank.DEFAULT_BYTE_BUDGET):
+    # Every path is a templates directory or a packed bank, the tilts are loaded when accessed
+    for path in paths:
+        bank = LazyTemplateBank.LazyTemplateBank(path, transform=transform, byte_budget=byte_budget)
+        for template in bank:
+            yield template
 
 
 def template_generator_solid(paths):
+    # The generator loads scipy.ndimage, only the generating commands import it
+    import TemplateGenerator
     templates = TemplateGenerator.generate_tilted_templates()
     for i, path in enumerate(paths):
         template = templates[i]
@@ -65,6 +88,8 @@ class Generator(Enum):
     LOAD = auto()
     SOLID = auto()
     FUZZY = auto()
+    PACKED = auto()
+    LAZY = auto()
 
 
 class TemplateFactory:
@@ -73,6 +98,8 @@ class TemplateFactory:
         self.kind = kind
         self.paths = None
         self.save = False
+        self.transform = None
+        self.byte_budget = LazyTemplateBank.DEFAULT_BYTE_BUDGET
 
     def set_paths(self, paths):
         self.paths = paths
@@ -82,7 +109,14 @@ class TemplateFactory:
         self.save = True
         return self
 
+    def set_byte_budget(self, byte_budget):
+        self.byte_budget = byte_budget
+        return self
+
     def build(self):
+        return Profiling.iterate(Profiling.TEMPLATE_FACTORY_BUILD, self.build_generator())
+
+    def build_generator(self):
         # Assert that all the required values are set
         assert self.paths is not None
 
@@ -93,6 +127,10 @@ class TemplateFactory:
             return template_generator_solid(self.paths)
         elif self.kind == Generator.FUZZY:
             return template_generator_fuzzy(self.paths)
+        elif self.kind == Generator.PACKED:
+            return packed_template_loader(self.paths)
+        elif self.kind == Generator.LAZY:
+            return lazy_template_loader(self.paths, self.transform, self.byte_budget)
         else:
             raise NotImplementedError('The generator %s is not implemented' % str(self.kind))
 
@@ -100,16 +138,22 @@ class TemplateFactory:
 class NormalizedTemplateFactory(TemplateFactory) :
     def __init__(self, kind):
         TemplateFactory.__init__(self, kind)
+        if kind == Generator.LAZY:
+            # normalize every tilt when it is loaded rather than loading them all here
+            self.transform = LazyTemplateBank.normalize_transform
 
-    def build(self):
-        for template in TemplateFactory.build(self):
-            yield self.normalize(template)
+    def build_generator(self):
+        for template in TemplateFactory.build_generator(self):
+            yield template if self.kind == Generator.LAZY else self.normalize(template)
 
     def normalize(self, template):
         from math import sqrt
         for tilted_template in template:
             factor = sqrt(np.sum(np.square(tilted_template.density_map))) #calculate the L2 norm of the template
-            if factor != 0:
+            if factor != 0 and not tilted_template.density_map.flags.writeable:
+                # a view of a packed bank, normalize into a copy
+                tilted_template.density_map = tilted_template.density_map / factor
+            elif factor != 0:
                 tilted_template.density_map /= factor
             else:
                 print("Error normalizing template: L2 norm is zero")
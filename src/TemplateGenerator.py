@@ -52,9 +52,8 @@ def rotate3d(dm, eu_angle):
 
 
 def show3d(dm):
-    import matplotlib
-    matplotlib.use('TkAgg')
-    import matplotlib.pyplot as plt
+    from VisualUtils import pyplot
+    plt = pyplot()
     d = int(dm.shape[2]**0.5)+1
     fig, axarr = plt.subplots(d,d)
     for z in range(dm.shape[2]):
@@ -158,9 +157,8 @@ def generate_tilted_templates():
 
 
 if __name__ == '__main__':
-    import matplotlib
-    matplotlib.use('TkAgg')
-    import matplotlib.pyplot as plt
+    from VisualUtils import pyplot
+    plt = pyplot()
 
     tilted_templates, template_ids, tilt_ids = load_templates_3d(r'C:\Users\Matan\PycharmProjects\Workshop\Chimera\Templates\\')
     print('Done!')
@@ -12,15 +12,11 @@
 
 
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
+from VisualUtils import pyplot
+plt = pyplot()
 from matplotlib.widgets import Slider
 
 def show3d(dm):
-    import matplotlib
-    matplotlib.use('TkAgg')
-    import matplotlib.pyplot as plt
     d = int(dm.shape[2]**0.5)+1
     fig, axarr = plt.subplots(d,d)
     for z in range(dm.shape[2]):
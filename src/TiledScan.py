@@ -0,0 +1,120 @@
+import itertools
+import numpy as np
+from scipy import fft
+
+import Profiling
+from Observers import notify
+
+
+def regions(shape, tile_size, halo):
+    """
+    Split a volume into tiles. Each tile is convolved with a halo of the voxels around it, so that the correlation
+    inside the tile is the one of the whole volume.
+    :param shape: The shape of the volume.
+    :param tile_size: Side of the tiles, None for a single tile of the whole volume. Axes of size 1 are not split.
+    :param halo: The halo along every axis, the kernel shape.
+    :return: List of tuples of slices: the tile in the volume, the region convolved (the tile and its halo clipped to
+    the volume) and the tile in the region.
+    """
+    axes = []
+    for side, halo_side in zip(shape, halo):
+        step = side if tile_size is None or side == 1 else tile_size
+        ranges = []
+        for start in range(0, side, step):
+            end = min(start + step, side)
+            region_start = 0 if tile_size is None else max(0, start - halo_side)
+            region_end = side if tile_size is None else min(side, end + halo_side)
+            ranges.append((slice(start, end), slice(region_start, region_end),
+                           slice(start - region_start, end - region_start)))
+        axes.append(ranges)
+    return [tuple(zip(*combination)) for combination in itertools.product(*axes)]
+
+
+def tilt_batches(template_tuple, batch_size):
+    """
+    :return: List of lists of the density maps of consecutive tilts, at most batch_size of the same shape in each.
+    """
+    batches = []
+    for tilted in template_tuple:
+        density_map = tilted.density_map
+        if batches and len(batches[-1]) < batch_size and batches[-1][0].shape == density_map.shape:
+            batches[-1].append(density_map)
+        else:
+            batches.append([density_map])
+    return batches
+
+
+def convolved_axes(region_shape, kernel_shape):
+    # Axes of size 1 in both, the z axis of 2D tomograms, are left out of the FFT as signal.fftconvolve does
+    return tuple([axis for axis, (region, kernel) in enumerate(zip(region_shape, kernel_shape))
+                  if region > 1 or kernel > 1])
+
+
+def fft_shape(region_shape, kernel_shape):
+    """
+    :return: The padded shape of the linear convolution along the convolved axes, fast for the FFT.
+    """
+    return tuple([fft.next_fast_len(region_shape[axis] + kernel_shape[axis] - 1, True)
+                  for axis in convolved_axes(region_shape, kernel_shape)])
+
+
+def batch_max_correlation(region, kernels, kernels_fft, shape):
+    """
+    Convolve the region with every kernel of a batch, sharing the FFT of the region.
+    :param kernels: Array of the stacked kernels, (batch,) + kernel shape.
+    :param kernels_fft: Their FFT padded to shape.
+    :param shape: The padded shape, see fft_shape.
+    :return: The maximum over the kernels of the convolutions, cropped as signal.fftconvolve mode 'same'.
+    """
+    axes = convolved_axes(region.shape, kernels.shape[1:])
+    batch_axes = tuple([axis + 1 for axis in axes])
+    convolutions = fft.irfftn(fft.rfftn(region, shape, axes=axes)[np.newaxis] * kernels_fft, shape, axes=batch_axes)
+    start = [(kernel - 1) // 2 for kernel in kernels.shape[1:]]
+    return np.max(convolutions[(slice(None),) + tuple([slice(first, first + side)
+                                                       for first, side in zip(start, region.shape)])], axis=0)
+
+
+def max_correlation(density_map, templates, tile_size=None, batch_size=1, observers=()):
+    """
+    The maximal correlation over all the templates and tilts at every position of the volume.
+    :param density_map: The tomogram's density map.
+    :param templates: tuple of tuples of TiltedTemplates, or a template bank indexed the same way.
+    :param tile_size: Side of the tiles the volume is scanned by, None to scan it whole.
+    :param batch_size: Number of tilts convolved with each FFT of the volume or tile.
+    :param observers: Observers receiving template_scanned, see Observers.Observer.
+    :return: Array of the shape of the density map.
+    """
+    # Imported here since JobPlanner uses the tiling without the convolution
+    from scipy import signal
+    if tile_size is None and batch_size == 1:
+        result = signal.fftconvolve(density_map, templates[0][0].density_map, mode='same')
+        Profiling.count(Profiling.FFTS)
+    else:
+        result = np.full(density_map.shape, -np.inf,
+                         dtype=np.result_type(density_map.dtype, templates[0][0].density_map.dtype, np.float32))
+
+    for template_index, template_tuple in enumerate(templates):
+        # Let a lazy template bank load the next template while this one is scanned
+        if template_index + 1 < len(templates) and hasattr(templates[template_index + 1], 'prefetch'):
+            templates[template_index + 1].prefetch()
+        Profiling.count(Profiling.TEMPLATES_SCANNED)
+        Profiling.count(Profiling.FFTS, len(template_tuple))
+        if tile_size is None and batch_size == 1:
+            for tilted in template_tuple:
+                # result is an array representing the maximum on all correlations generated by all the templates and
+                # tilts for each 3-position.
+                result = np.maximum(result, signal.fftconvolve(density_map, tilted.density_map, mode='same'))
+        else:
+            for batch in tilt_batches(template_tuple, batch_size):
+                kernels = np.stack(batch)
+                kernels_fft = {}    # by padded shape, the inner tiles all share one
+                for tile, region, inner in regions(density_map.shape, tile_size, kernels.shape[1:]):
+                    region_map = density_map[region]
+                    shape = fft_shape(region_map.shape, kernels.shape[1:])
+                    if shape not in kernels_fft:
+                        axes = convolved_axes(region_map.shape, kernels.shape[1:])
+                        kernels_fft[shape] = fft.rfftn(kernels, shape, axes=tuple([axis + 1 for axis in axes]))
+                    correlation = batch_max_correlation(region_map, kernels, kernels_fft[shape], shape)
+                    np.maximum(result[tile], correlation[inner], out=result[tile])
+        notify(observers, 'template_scanned', template_index, len(templates))
+    return result
@@ -1,5 +1,6 @@
 from scipy import signal
 from Constants import JUNK_ID
+import Profiling
 
 class TiltFinder:
     def __init__(self, templates):
@@ -13,6 +14,7 @@ class TiltFinder:
         max_correlation = 0
         best_tilt = -1
 
+        Profiling.count(Profiling.CORRELATIONS, len(template))
         for tilted_template in template:
             correlation = signal.correlate(tomogram.density_map, tilted_template.density_map, mode='same')
             #correlation = signal.fftconvolve(tomogram.density_map, tilted_template.density_map, mode='same')
@@ -1,11 +1,14 @@
 import pickle
-import TomogramGenerator
-from CommonDataTypes import Candidate
+import MrcFile
+from Pipeline import atomic_write, atomic_pickle, PrefetchReader
+from CommonDataTypes import Candidate, Tomogram
+import Profiling
 
 
 # TODO: place holders for the tomogram generators
 # TODO: move to other file
 def tomogram_generator(paths, templates):
+    import TomogramGenerator
     criteria = (Candidate.fromTuple(1, 0, 10, 10), Candidate.fromTuple(1, 2, 27, 18), Candidate.fromTuple(0, 0, 10, 28))
     for path in paths:
         tomogram = TomogramGenerator.generate_tomogram_with_given_candidates(templates, criteria)
@@ -14,15 +17,48 @@ def tomogram_generator(paths, templates):
         yield tomogram
 
 
+def mrc_tomogram_loader(path):
+    # The density is memory mapped, nothing is read until it is accessed. MRC files have no composition.
+    density_map, header = MrcFile.open_mrc(path)
+    return Tomogram(density_map, (), header.voxel_size)
+
+
+def prefetch_tomogram(path):
+    # The prefetch thread reads the pages of MRC files ahead, else the disk reads would happen on the first access
+    tomogram = load_tomogram(path)
+    if MrcFile.is_mrc_path(path):
+        MrcFile.read_ahead(tomogram.density_map)
+    return tomogram
+
+
+def mrc_tomogram_saver(path, tomogram):
+    voxel_size = getattr(tomogram, 'voxel_size', None)
+    atomic_write(path, lambda temporary_path: MrcFile.write_mrc(temporary_path, tomogram.density_map,
+                                                                voxel_size if voxel_size is not None else 1.0))
+
+
+def load_tomogram(path):
+    if MrcFile.is_mrc_path(path):
+        return mrc_tomogram_loader(path)
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def save_tomogram(path, tomogram):
+    if MrcFile.is_mrc_path(path):
+        mrc_tomogram_saver(path, tomogram)
+    else:
+        atomic_pickle(path, tomogram)
+
+
 def tomogram_loader(paths, save):
     if not save:
         for path in paths:
-            with open(path, 'rb') as file:
-                yield pickle.load(file)
+            yield load_tomogram(path)
     else:
+        # Every saver opens, writes and closes its file only when it is called
         for path in paths:
-            with open(path, 'wb') as file:
-                yield lambda x: pickle.dump(x, file)
+            yield lambda x, path=path: save_tomogram(path, x)
 
 
 class TomogramFactory:
@@ -30,6 +66,9 @@ class TomogramFactory:
         self.templates = templates
         self.save = False
         self.paths = None
+        self.prefetch_depth = None
+        self.memory_cap = None
+        self.timer = None
 
     def set_paths(self, paths):
         self.paths = paths
@@ -39,11 +78,25 @@ class TomogramFactory:
         self.save = value
         return self
 
+    def set_prefetch(self, depth, memory_cap=None, timer=None):
+        """
+        Load the next tomograms in the background, see Pipeline.PrefetchReader.
+        """
+        self.prefetch_depth = depth
+        self.memory_cap = memory_cap
+        self.timer = timer
+        return self
+
     def build(self):
+        return Profiling.iterate(Profiling.TOMOGRAM_FACTORY_BUILD, self.build_generator())
+
+    def build_generator(self):
         # Assert that all the required values are set
         assert self.paths is not None
 
         # build the appropriate generator
+        if self.templates is None and not self.save and self.prefetch_depth is not None:
+            return PrefetchReader(self.paths, prefetch_tomogram, self.prefetch_depth, self.memory_cap, self.timer)
         if self.templates is None:
             return tomogram_loader(self.paths, self.save)
         else:
@@ -34,11 +34,12 @@ def randomize_spaced_out_points(space, separation, n_points):
     obj = poisson_disk.pds(space[0], space[1], space[2], separation, n_points)
     return obj.randomize_spaced_points()
 
-def generate_random_candidates(template_side_len, criteria, dim=2):
+def generate_random_candidates(template_side_len, criteria, dim=2, tomogram_side=TOMOGRAM_DIMENSION):
     """
     :param template_side_len:  we assume templates are cubes
     :param criteria: list of integers. criteria[i] means how many instances of template_id==i should appear in the resulting tomogram
     :param dim 2 for 2D 3 for 3D
+    :param tomogram_side: the side of the square or cube tomogram the candidates are placed in
     :return: a random list of candidates according to the criteria
     """
     n = sum(criteria)
@@ -57,7 +58,7 @@ def generate_random_candidates(template_side_len, criteria, dim=2):
     else:
         assert(dim == 3)
 
-    COM_valid_space = [TOMOGRAM_DIMENSION - 2*x for x in gap_shape]
+    COM_valid_space = [tomogram_side - 2*x for x in gap_shape]
 
     if dim==2:
         COM_valid_space[2] = 1
@@ -73,16 +74,17 @@ def generate_random_candidates(template_side_len, criteria, dim=2):
     return [Candidate(SixPosition(pos_id[0], EulerAngle.rand_tilt_id()), label=pos_id[1]) for pos_id in zip(points, flat_ids)]
 
 
-def generate_random_tomogram(templates, template_side, criteria, dim=2):
+def generate_random_tomogram(templates, template_side, criteria, dim=2, tomogram_side=TOMOGRAM_DIMENSION):
     """
     :param templates:  list of lists: first dimension is different template_ids second dimension is tilt_id
     :param template_side: we assume the templates are square with this side length
     :param criteria: list of integers. criteria[i] means how many instances of template_id==i should appear in the resulting tomogram
     :param dim 2 for 2D 3 for 3D
+    :param tomogram_side: the side of the square or cube tomogram
     :return: a random Tomogram according to the criteria
     """
-    candidates = generate_random_candidates(template_side, criteria, dim)
-    return generate_tomogram_with_given_candidates(templates, candidates, TOMOGRAM_DIMENSIONS_3D if dim == 3 else TOMOGRAM_DIMENSIONS_2D )
+    candidates = generate_random_candidates(template_side, criteria, dim, tomogram_side)
+    return generate_tomogram_with_given_candidates(templates, candidates, (tomogram_side,) * 3 if dim == 3 else (tomogram_side, tomogram_side, 1))
 
 
 if __name__ == '__main__':
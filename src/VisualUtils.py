@@ -1,13 +1,27 @@
+import os
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider
 
-def show3d(dm):
+
+def interactive():
+    # Windows always has a desktop, elsewhere windows need an X11 or Wayland display
+    return os.name == 'nt' or bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def pyplot():
+    """
+    Import pyplot for the debugging tools. Tk is chosen only when there is a display and MPLBACKEND does not name a
+    backend, so batch runs keep matplotlib's default which needs none.
+    :return: The matplotlib.pyplot module.
+    """
     import matplotlib
-    matplotlib.use('TkAgg')
+    if 'MPLBACKEND' not in os.environ and interactive():
+        matplotlib.use('TkAgg')
     import matplotlib.pyplot as plt
+    return plt
+
+
+def show3d(dm):
+    plt = pyplot()
     d = int(dm.shape[2]**0.5)+1
     fig, axarr = plt.subplots(d,d)
     for z in range(dm.shape[2]):
@@ -17,6 +31,8 @@ def show3d(dm):
     plt.show()
 
 def slider3d(dm):
+    from matplotlib.widgets import Slider
+    plt = pyplot()
     ax = plt.subplot()
     plt.subplots_adjust(left=0.25, bottom=0.25)
 
@@ -0,0 +1,289 @@
+import json
+import random
+import time
+import numpy as np
+from sklearn.svm import SVC
+
+from CommonDataTypes import EulerAngle, Tomogram, TiltedTemplate
+from Constants import DISTANCE_THRESHOLD, JUNK_ID
+import TomogramGenerator
+import CandidateSelector
+import MachineProfile
+import FeaturesExtractor
+import Labeler
+import TiltFinder
+import Noise
+from AnalyzeTomogram import analyze_tomogram_table, EVAL_OUTPUTS
+from benchmarks import SyntheticData
+
+# The benchmark set
+DEFAULT_TOMOGRAMS = 4       # tomograms to train on, and as many to evaluate
+DEFAULT_SIZE = 200
+DEFAULT_TEMPLATES = 2
+FULL_TILTS = 12             # tilts the particles are generated with
+DEFAULT_SEED = 0
+
+# The grid of configurations
+DEFAULT_TILT_COUNTS = (12, 6, 3)
+DEFAULT_BINNINGS = (1, 2)
+DEFAULT_THRESHOLDS = (25, 50)
+DEFAULT_DTYPES = ('float64', 'float32')
+
+# The radius within which a candidate matches a particle, the one PositionLabeler uses (it compares the distance with
+# the square of DISTANCE_THRESHOLD)
+MATCH_DISTANCE = DISTANCE_THRESHOLD ** 2
+
+
+class Config:
+    """
+    The speed knobs of a run of the pipeline.
+    """
+    def __init__(self, tilts, binning, threshold, dtype):
+        self.tilts = tilts              # tilts per template searched, out of FULL_TILTS
+        self.binning = binning          # factor by which the tomograms and the templates are downsampled
+        self.threshold = threshold      # the correlation threshold of the candidate selector
+        self.dtype = dtype              # the dtype of the density maps
+
+    def key(self):
+        return 'tilts%d-bin%d-threshold%g-%s' % (self.tilts, self.binning, self.threshold, self.dtype)
+
+
+def config_grid(tilt_counts=DEFAULT_TILT_COUNTS, binnings=DEFAULT_BINNINGS, thresholds=DEFAULT_THRESHOLDS,
+                dtypes=DEFAULT_DTYPES):
+    return [Config(tilts, binning, threshold, dtype) for tilts in tilt_counts for binning in binnings
+            for threshold in thresholds for dtype in dtypes]
+
+
+class BenchmarkSet:
+    """
+    Seeded synthetic tomograms of known composition, split into a training and an evaluation half.
+    """
+    def __init__(self, n_tomograms=DEFAULT_TOMOGRAMS, size=DEFAULT_SIZE, n_templates=DEFAULT_TEMPLATES, noise=True,
+                 seed=DEFAULT_SEED):
+        self.previous_tilts = SyntheticData.set_tilts(FULL_TILTS, 2)
+        self.tilts = list(EulerAngle.Tilts)
+        self.bank = SyntheticData.synthetic_bank(n_templates, 2)
+        template_side = self.bank[0][0].density_map.shape[0]
+        criteria = SyntheticData.particle_criteria(n_templates, template_side, 2, size)
+        tomograms = []
+        for index in range(2 * n_tomograms):
+            random.seed(seed + index)
+            np.random.seed(seed + index)
+            tomogram = TomogramGenerator.generate_random_tomogram(self.bank, template_side, criteria, 2, size)
+            tomograms.append(Noise.make_noisy_tomogram(tomogram) if noise else tomogram)
+        self.train = tomograms[:n_tomograms]
+        self.test = tomograms[n_tomograms:]
+
+    def restore_tilts(self):
+        EulerAngle.Tilts = self.previous_tilts
+
+
+def bin_density_map(density_map, factor, reduce):
+    """
+    Downsample the axes longer than 1 by factor, cutting the remainder.
+    :param reduce: np.sum or np.mean over the factor ** dim voxels of a bin.
+    """
+    if factor == 1:
+        return density_map
+    shape = []
+    for side in density_map.shape:
+        shape += [side // factor, factor] if side > 1 else [side, 1]
+    trimmed = density_map[tuple([slice(0, side - side % factor) if side > 1 else slice(None)
+                                 for side in density_map.shape])]
+    return reduce(trimmed.reshape(shape), axis=tuple(range(1, len(shape), 2)))
+
+
+def configure_bank(bank, config):
+    """
+    :return: The bank with every (FULL_TILTS // config.tilts)th tilt, binned and cast. The templates are averaged so
+    that the correlations with the summed tomograms keep their scale.
+    """
+    step = max(1, len(bank[0]) // config.tilts)
+    return tuple([tuple([TiltedTemplate(bin_density_map(tilted.density_map, config.binning, np.mean)
+                                        .astype(config.dtype), tilted.tilt_id, tilted.template_id)
+                         for tilted in template[::step]]) for template in bank])
+
+
+def configure_tomogram(tomogram, config):
+    return Tomogram(bin_density_map(tomogram.density_map, config.binning, np.sum).astype(config.dtype),
+                    tomogram.composition)
+
+
+def truth(tomogram):
+    """
+    :return: A tuple of the positions, the labels and the tilt ids of the particles as arrays.
+    """
+    return (np.array([candidate.six_position.COM_position for candidate in tomogram.composition], dtype=float)
+            .reshape(-1, 3), np.array([candidate.label for candidate in tomogram.composition]),
+            np.array([candidate.six_position.tilt_id for candidate in tomogram.composition]))
+
+
+def unbinned_positions(positions, binning):
+    # The center of the bin in the original voxels, the z axis of the 2D benchmark set is not binned
+    positions = np.array(positions, dtype=float).reshape(-1, 3)
+    positions[:, :2] = positions[:, :2] * binning + (binning - 1) / 2.0
+    return positions
+
+
+def match(predicted, actual, max_distance=MATCH_DISTANCE):
+    """
+    Match the predicted positions to the actual ones one to one, closest pairs first.
+    :param predicted: (n, 3) array.
+    :param actual: (m, 3) array.
+    :return: A tuple of the arrays of the predicted indices and of their matched actual indices.
+    """
+    if len(predicted) == 0 or len(actual) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    distances = np.linalg.norm(predicted[:, np.newaxis, :] - actual[np.newaxis, :, :], axis=2)
+    pairs = np.argwhere(distances <= max_distance)
+    pairs = pairs[np.argsort(distances[pairs[:, 0], pairs[:, 1]], kind='stable')]
+    used_predicted = np.zeros(len(predicted), dtype=bool)
+    used_actual = np.zeros(len(actual), dtype=bool)
+    matched = []
+    for predicted_index, actual_index in pairs:
+        if not used_predicted[predicted_index] and not used_actual[actual_index]:
+            used_predicted[predicted_index] = used_actual[actual_index] = True
+            matched.append((predicted_index, actual_index))
+    matched = np.array(matched, dtype=int).reshape(-1, 2)
+    return matched[:, 0], matched[:, 1]
+
+
+def tilt_errors(predicted_tilts, actual_tilts, tilts, template_ids):
+    """
+    :param tilts: The EulerAngles indexed by the tilt ids.
+    :param template_ids: The template of every pair, the angles are compared modulo the template's symmetry.
+    :return: Array of the sum of the absolute differences of the Euler angles of every pair, in degrees.
+    """
+    def angles(tilt_ids):
+        return np.array([[angle or 0.0 for angle in (tilts[tilt_id].Phi, tilts[tilt_id].Theta, tilts[tilt_id].Psi)]
+                         for tilt_id in tilt_ids], dtype=float).reshape(-1, 3)
+    periods = np.array([360.0 / SyntheticData.template_symmetry_2d(template_id) for template_id in template_ids])
+    periods = periods.reshape(-1, 1)
+    differences = np.abs(angles(predicted_tilts) - angles(actual_tilts)) % periods
+    return np.sum(np.minimum(differences, periods - differences), axis=1)
+
+
+def train_svm(benchmark, bank, config, scan_settings=MachineProfile.DEFAULT_SETTINGS):
+    """
+    Train an SVM on the training half of the benchmark set with the candidates the configuration selects, labeled by
+    their match with the particles.
+    :return: The SVM, None when the candidates have a single label.
+    """
+    selector = CandidateSelector.CandidateSelector(bank, threshold=config.threshold, scan_settings=scan_settings)
+    extractor = FeaturesExtractor.FeaturesExtractor(bank)
+    features, labels = [], []
+    for tomogram in benchmark.train:
+        binned = configure_tomogram(tomogram, config)
+        candidates = selector.select(binned)
+        positions, particle_labels, _ = truth(tomogram)
+        candidate_labels = np.full(len(candidates), JUNK_ID)
+        candidate_indices, particle_indices = match(unbinned_positions(candidates.positions, config.binning),
+                                                    positions)
+        candidate_labels[candidate_indices] = particle_labels[particle_indices]
+        features += [extractor.extract_features(binned, candidate) for candidate in candidates]
+        labels += list(candidate_labels)
+    if len(set(labels)) < 2:
+        return None
+    return SVC().fit(np.array(features), np.array(labels))
+
+
+def run_config(benchmark, config, scan_settings=MachineProfile.DEFAULT_SETTINGS):
+    """
+    Train and evaluate the pipeline under the configuration.
+    :return: Dictionary of the configuration, the throughput in particles per second of the evaluation and its
+    precision, recall, F1 and mean tilt error. The metrics are None when the SVM could not be trained.
+    """
+    bank = configure_bank(benchmark.bank, config)
+    result = {'tilts': config.tilts, 'binning': config.binning, 'threshold': config.threshold, 'dtype': config.dtype}
+    svm = train_svm(benchmark, bank, config, scan_settings)
+    if svm is None:
+        return dict(result, particles_per_second=None, precision=None, recall=None, f1=None, tilt_error=None)
+
+    labeler = Labeler.SvmLabeler(svm)
+    selector = CandidateSelector.CandidateSelector(bank, threshold=config.threshold, scan_settings=scan_settings)
+    extractor = FeaturesExtractor.FeaturesExtractor(bank)
+    tilt_finder = TiltFinder.TiltFinder(bank)
+
+    seconds = 0.0
+    particles = predicted_count = true_positives = 0
+    errors = []
+    for tomogram in benchmark.test:
+        binned = configure_tomogram(tomogram, config)
+        start = time.perf_counter()
+        (candidates, table) = analyze_tomogram_table(binned, labeler, extractor, selector, tilt_finder,
+                                                     set_labels=True, outputs=EVAL_OUTPUTS)
+        seconds += time.perf_counter() - start
+
+        positions, labels, tilt_ids = truth(tomogram)
+        predicted = table.labels != JUNK_ID
+        predicted_indices, particle_indices = match(unbinned_positions(table.positions[predicted], config.binning),
+                                                    positions)
+        correct = table.labels[predicted][predicted_indices] == labels[particle_indices]
+        particles += len(positions)
+        predicted_count += int(np.sum(predicted))
+        true_positives += int(np.sum(correct))
+        errors += list(tilt_errors(table.tilt_ids[predicted][predicted_indices][correct],
+                                   tilt_ids[particle_indices][correct], benchmark.tilts,
+                                   labels[particle_indices][correct]))
+
+    precision = true_positives / predicted_count if predicted_count else 0.0
+    recall = true_positives / particles if particles else 0.0
+    return dict(result, particles_per_second=particles / seconds if seconds > 0 else None, precision=precision,
+                recall=recall, f1=2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+                tilt_error=float(np.mean(errors)) if errors else None)
+
+
+def pareto_front(results):
+    """
+    Mark the results no other result beats on both the throughput and the F1.
+    :return: The results sorted by decreasing throughput, with a 'pareto' flag.
+    """
+    ranked = sorted([result for result in results if result['f1'] is not None],
+                    key=lambda result: (-result['particles_per_second'], -result['f1']))
+    best_f1 = -1.0
+    for result in ranked:
+        result['pareto'] = result['f1'] > best_f1
+        best_f1 = max(best_f1, result['f1'])
+    failed = [dict(result, pareto=False) for result in results if result['f1'] is None]
+    return ranked + failed
+
+
+def run_sweep(configs, n_tomograms=DEFAULT_TOMOGRAMS, size=DEFAULT_SIZE, n_templates=DEFAULT_TEMPLATES, noise=True,
+              seed=DEFAULT_SEED, scan_settings=MachineProfile.DEFAULT_SETTINGS):
+    """
+    Run every configuration on the same benchmark set.
+    :param scan_settings: The scan settings of the candidate selection, the default ones rather than the machine
+    profile's so that tuning the machine does not move the results.
+    :return: The results dictionary, see run_config and pareto_front.
+    """
+    benchmark = BenchmarkSet(n_tomograms, size, n_templates, noise, seed)
+    try:
+        results = []
+        for config in configs:
+            print('Sweeping %s' % config.key())
+            results.append(run_config(benchmark, config, scan_settings))
+    finally:
+        benchmark.restore_tilts()
+    return {'set': {'tomograms': n_tomograms, 'size': size, 'templates': n_templates, 'full_tilts': FULL_TILTS,
+                    'noise': noise, 'seed': seed, 'scan_settings': dict(scan_settings)},
+            'results': pareto_front(results)}
+
+
+def save_sweep(path, sweep):
+    with open(path, 'w') as file:
+        json.dump(sweep, file, indent=2)
+
+
+def print_pareto_table(sweep):
+    print('%5s %4s %9s %8s %12s %9s %7s %6s %10s  %s' % ('tilts', 'bin', 'threshold', 'dtype', 'particles/s',
+                                                       'precision', 'recall', 'F1', 'tilt error', 'pareto'))
+    for result in sweep['results']:
+        if result['f1'] is None:
+            print('%5d %4d %9g %8s  no SVM, the candidates have a single label' %
+                  (result['tilts'], result['binning'], result['threshold'], result['dtype']))
+            continue
+        print('%5d %4d %9g %8s %12.1f %9.3f %7.3f %6.3f %10s  %s' %
+              (result['tilts'], result['binning'], result['threshold'], result['dtype'], result['particles_per_second'],
+               result['precision'], result['recall'], result['f1'],
+               '%.1f' % result['tilt_error'] if result['tilt_error'] is not None else '-',
+               '*' if result['pareto'] else ''))
@@ -0,0 +1,124 @@
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks import StageBench
+
+# The directory of Main.py, the commands and the imports run from it like Main.py does
+SOURCE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(SOURCE_DIRECTORY, 'Main.py')
+
+# The command lines of Main.py timed from the start of the interpreter to its exit
+COMMANDS = (('help', ['--help']), ('plan-help', ['plan', '--help']), ('tune-perf-help', ['tune-perf', '--help']),
+            ('eval-help', ['eval', '--help']), ('train-help', ['train', '--help']))
+# These commands need none of HEAVY_MODULES
+LIGHT_COMMANDS = ('help', 'plan-help', 'tune-perf-help')
+# The modules timed alone
+MODULES = ('Main', 'JobPlanner', 'MachineProfile', 'SvmEval', 'SvmTrain')
+HEAVY_MODULES = ('sklearn', 'scipy.signal', 'scipy.stats', 'scipy.ndimage', 'matplotlib')
+
+DEFAULT_REPEAT = 5
+# Imports listed per command, the slowest first
+SLOWEST_IMPORTS = 5
+
+
+def command_arguments(key):
+    """
+    :param key: 'python' for the bare interpreter, 'command <name>' for COMMANDS or 'module <name>' for MODULES.
+    :return: The arguments of the interpreter.
+    """
+    kind, _, name = key.partition(' ')
+    if kind == 'command':
+        return [MAIN_PATH] + dict(COMMANDS)[name]
+    if kind == 'module':
+        return ['-c', 'import %s' % name]
+    return ['-c', 'pass']
+
+
+def run_interpreter(arguments, capture=False):
+    return subprocess.run([sys.executable] + arguments, cwd=SOURCE_DIRECTORY, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE if capture else subprocess.DEVNULL, universal_newlines=True)
+
+
+def time_interpreter(arguments, repeat):
+    """
+    :return: Dictionary of the best and mean wall seconds of the interpreter run over the repeats.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_interpreter(arguments)
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def import_times(arguments):
+    """
+    Run the interpreter once with -X importtime.
+    :return: Dictionary of every imported module and its cumulative import seconds.
+    """
+    output = run_interpreter(['-X', 'importtime'] + arguments, capture=True).stderr
+    modules = {}
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        modules[fields[2].strip()] = int(fields[1]) / 1e6
+    return modules
+
+
+def heavy(modules):
+    # scipy imports its subpackages lazily, they are only listed by their modules
+    return [package for package in HEAVY_MODULES
+            if [name for name in modules if name == package or name.startswith(package + '.')]]
+
+
+def run_import_benchmarks(repeat=DEFAULT_REPEAT):
+    """
+    Time the bare interpreter, the commands and the imports of the modules, each in a new interpreter.
+    :return: The results dictionary, its entries have the timing, the heavy modules loaded and the slowest imports.
+    """
+    keys = ['python'] + ['command %s' % name for name, _ in COMMANDS] + ['module %s' % name for name in MODULES]
+    results = {'environment': StageBench.environment(), 'repeat': repeat, 'entries': {}}
+    for key in keys:
+        print('Timing %s' % key)
+        arguments = command_arguments(key)
+        entry = time_interpreter(arguments, repeat)
+        modules = import_times(arguments)
+        entry['heavy_modules'] = heavy(modules)
+        entry['slowest_imports'] = sorted(modules.items(), key=lambda item: -item[1])[:SLOWEST_IMPORTS]
+        results['entries'][key] = entry
+    return results
+
+
+def heavy_imports(results):
+    """
+    :return: List of tuples of the light commands which loaded heavy modules and those modules.
+    """
+    return [(name, results['entries']['command %s' % name]['heavy_modules']) for name in LIGHT_COMMANDS
+            if results['entries'].get('command %s' % name, {}).get('heavy_modules')]
+
+
+def compare_results(results, baseline, threshold):
+    """
+    :return: List of the comparisons of the entries in both results, as StageBench.compare_results.
+    """
+    comparisons = []
+    for key, entry in sorted(results['entries'].items()):
+        previous = baseline.get('entries', {}).get(key)
+        if previous is None:
+            continue
+        ratio = entry['seconds'] / previous['seconds'] if previous['seconds'] > 0 else float('inf')
+        comparisons.append({'case': key, 'stage': 'startup', 'baseline': previous['seconds'],
+                            'current': entry['seconds'], 'ratio': ratio, 'regression': ratio > 1 + threshold})
+    return comparisons
+
+
+def print_results(results):
+    for key, entry in sorted(results['entries'].items()):
+        print('%-32s %.4fs%s' % (key, entry['seconds'],
+                                 '  loads %s' % ' '.join(entry['heavy_modules']) if entry['heavy_modules'] else ''))
+        for name, seconds in entry['slowest_imports']:
+            print('    %-28s %.4fs' % (name, seconds))
@@ -0,0 +1,210 @@
+import json
+import os
+import platform
+import random
+import time
+import numpy as np
+import scipy
+import sklearn
+from sklearn.svm import SVC
+
+from CommonDataTypes import EulerAngle
+from Constants import JUNK_ID
+import TomogramGenerator
+import CandidateSelector
+import MachineProfile
+import FeaturesExtractor
+import Labeler
+import TiltFinder
+from benchmarks import SyntheticData
+
+# The stages timed for every case
+PDS = 'pds'
+SELECT = 'select'
+EXTRACT_FEATURES = 'extract_features'
+POSITION_LABEL = 'position_label'
+SVM_FIT = 'svm_fit'
+SVM_PREDICT = 'svm_predict'
+FIND_BEST_TILT = 'find_best_tilt'
+STAGES = (PDS, SELECT, EXTRACT_FEATURES, POSITION_LABEL, SVM_FIT, SVM_PREDICT, FIND_BEST_TILT)
+
+# The default matrix, 3D tomograms are smaller so the suite runs in minutes. Below 128 the 3D tomograms hold too few
+# particles for the labeled stages (see SyntheticData.particle_criteria), above it the extraction alone takes minutes.
+DEFAULT_DIMS = (2, 3)
+DEFAULT_SIZES_2D = (200, 300)
+DEFAULT_SIZES_3D = (128,)
+DEFAULT_TEMPLATE_COUNTS = (2, 4)
+DEFAULT_TILT_COUNTS = (4, 8)
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 0
+
+# A stage is a regression when it is slower than the baseline by more than this fraction
+DEFAULT_THRESHOLD = 0.2
+# Stages faster than this in both runs are too noisy to compare
+MIN_COMPARED_SECONDS = 1e-3
+
+
+class Case:
+    def __init__(self, dim, size, templates, tilts):
+        self.dim = dim
+        self.size = size            # side of the tomogram
+        self.templates = templates  # number of templates
+        self.tilts = tilts          # number of tilts per template
+
+    def key(self):
+        return '%dd-size%d-templates%d-tilts%d' % (self.dim, self.size, self.templates, self.tilts)
+
+
+def case_matrix(dims=DEFAULT_DIMS, sizes_2d=DEFAULT_SIZES_2D, sizes_3d=DEFAULT_SIZES_3D,
+                template_counts=DEFAULT_TEMPLATE_COUNTS, tilt_counts=DEFAULT_TILT_COUNTS):
+    """
+    :return: List of the Cases of every combination.
+    """
+    return [Case(dim, size, templates, tilts) for dim in dims for size in (sizes_2d if dim == 2 else sizes_3d)
+            for templates in template_counts for tilts in tilt_counts]
+
+
+def time_call(function, repeat):
+    """
+    :return: A tuple of the timing dictionary (best and mean seconds over the repeats) and the result of the last call.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}, result
+
+
+def run_case(case, repeat=DEFAULT_REPEAT, seed=DEFAULT_SEED, scan_settings=MachineProfile.DEFAULT_SETTINGS):
+    """
+    Generate the bank and the tomogram of the case and time every stage on them.
+    :param scan_settings: The tile size and the batch size of the candidate selection, see MachineProfile.settings.
+    :return: Dictionary describing the case, its sizes and the timing of every stage, None for a stage that could not
+    run on the tomogram (the SVM needs two labels, the tilt search labeled particles). Such a case is under-populated.
+    """
+    previous_tilts = SyntheticData.set_tilts(case.tilts, case.dim)
+    try:
+        random.seed(seed)
+        np.random.seed(seed)
+        bank = SyntheticData.synthetic_bank(case.templates, case.dim)
+        template_side = bank[0][0].density_map.shape[0]
+        criteria = SyntheticData.particle_criteria(case.templates, template_side, case.dim, case.size)
+
+        stages = {}
+        space = [case.size - 4 * ((template_side - 1) // 2)] * 3
+        if case.dim == 2:
+            space[2] = 1
+        stages[PDS], _ = time_call(lambda: TomogramGenerator.randomize_spaced_out_points(
+            space, template_side * (case.dim ** 0.5), sum(criteria)), repeat)
+
+        random.seed(seed)
+        tomogram = TomogramGenerator.generate_random_tomogram(bank, template_side, criteria, case.dim, case.size)
+
+        selector = CandidateSelector.CandidateSelector(bank, case.dim, scan_settings=scan_settings)
+        stages[SELECT], candidates = time_call(lambda: selector.select(tomogram), repeat)
+
+        extractor = FeaturesExtractor.FeaturesExtractor(bank)
+        stages[EXTRACT_FEATURES], features = time_call(
+            lambda: [extractor.extract_features(tomogram, candidate) for candidate in candidates], repeat)
+
+        labeler = Labeler.PositionLabeler(tomogram.composition)
+        stages[POSITION_LABEL], labels = time_call(lambda: [labeler.label(candidate) for candidate in candidates],
+                                                   repeat)
+
+        if len(set(labels)) > 1:
+            x, y = np.array(features), np.array(labels)
+            stages[SVM_FIT], svm = time_call(lambda: SVC().fit(x, y), repeat)
+            stages[SVM_PREDICT], _ = time_call(lambda: svm.predict(x), repeat)
+        else:
+            stages[SVM_FIT] = stages[SVM_PREDICT] = None
+
+        tilt_finder = TiltFinder.TiltFinder(bank)
+        particles = [candidate for candidate in candidates if candidate.label != JUNK_ID]
+        if particles:
+            stages[FIND_BEST_TILT], _ = time_call(
+                lambda: [tilt_finder.find_best_tilt(tomogram, candidate) for candidate in particles], repeat)
+        else:
+            stages[FIND_BEST_TILT] = None
+    finally:
+        EulerAngle.Tilts = previous_tilts
+
+    return {'dim': case.dim, 'size': case.size, 'templates': case.templates, 'tilts': case.tilts,
+            'particles': sum(criteria), 'candidates': len(candidates), 'labeled_particles': len(particles),
+            'labels': len(set(labels)), 'stages': stages}
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'sklearn': sklearn.__version__, 'machine': platform.machine(), 'system': platform.system(),
+            'cpus': os.cpu_count()}
+
+
+def run_benchmarks(cases, repeat=DEFAULT_REPEAT, seed=DEFAULT_SEED, scan_settings=MachineProfile.DEFAULT_SETTINGS):
+    """
+    Run the cases, each seeded the same so two runs time the same work.
+    :param cases: List of Cases, see case_matrix.
+    :param scan_settings: The scan settings of the candidate selection. The default ones rather than the machine
+    profile's, so that tuning the machine does not move the results.
+    :return: The results dictionary, saved by save_results.
+    """
+    results = {'environment': environment(), 'repeat': repeat, 'seed': seed, 'scan_settings': dict(scan_settings),
+               'cases': {}}
+    for case in cases:
+        print('Benchmarking %s' % case.key())
+        results['cases'][case.key()] = run_case(case, repeat, seed, scan_settings)
+    return results
+
+
+def save_results(path, results):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare the best times of the stages of the cases found in both results.
+    :param threshold: Fraction by which a stage may be slower than the baseline before it is flagged.
+    :return: List of the comparisons as dictionaries of the case, the stage, the seconds of both runs, their ratio and
+    whether it is a regression.
+    """
+    comparisons = []
+    for key, case in sorted(results['cases'].items()):
+        if key not in baseline['cases']:
+            continue
+        for stage in STAGES:
+            current = case['stages'].get(stage)
+            previous = baseline['cases'][key]['stages'].get(stage)
+            if current is None or previous is None:
+                continue
+            if max(current['seconds'], previous['seconds']) < MIN_COMPARED_SECONDS:
+                continue
+            ratio = current['seconds'] / previous['seconds'] if previous['seconds'] > 0 else float('inf')
+            comparisons.append({'case': key, 'stage': stage, 'baseline': previous['seconds'],
+                                'current': current['seconds'], 'ratio': ratio, 'regression': ratio > 1 + threshold})
+    return comparisons
+
+
+def print_results(results):
+    for key, case in sorted(results['cases'].items()):
+        under_populated = None in case['stages'].values()
+        print('%s (%d candidates%s)' % (key, case['candidates'],
+                                        ', UNDER-POPULATED: %d labeled particles, %d labels'
+                                        % (case.get('labeled_particles', 0), case.get('labels', 0))
+                                        if under_populated else ''))
+        for stage in STAGES:
+            timing = case['stages'].get(stage)
+            print('    %-16s %s' % (stage, '%.4fs' % timing['seconds'] if timing is not None
+                                    else 'not run, too few particles'))
+
+
+def print_comparisons(comparisons):
+    for comparison in comparisons:
+        print('%-40s %-16s %.4fs -> %.4fs  x%.2f%s' %
+              (comparison['case'], comparison['stage'], comparison['baseline'], comparison['current'],
+               comparison['ratio'], '  REGRESSION' if comparison['regression'] else ''))
@@ -0,0 +1,101 @@
+import numpy as np
+
+from CommonDataTypes import EulerAngle, TiltedTemplate
+from Constants import TEMPLATE_DIMENSION, TEMPLATE_DIMENSIONS_2D, TEMPLATE_DIMENSIONS_3D
+import TemplateGenerator
+
+# Fraction of the particles a lattice spaced by the separation holds that are placed. The Poisson disk sampling
+# exits the process when it cannot place them all, so this stays well below what it can place.
+PARTICLE_DENSITY = 0.3
+
+
+def set_tilts(n_tilts, dim):
+    """
+    Make EulerAngle.Tilts the n_tilts tilts of the synthetic banks, the tilt ids of the generated tomograms are drawn
+    from it.
+    :return: The previous tilts, to restore them.
+    """
+    previous = EulerAngle.Tilts
+    if dim == 2:
+        EulerAngle.Tilts = [EulerAngle(theta, None, None) for theta in np.linspace(0, 90, n_tilts, endpoint=False)]
+    else:
+        # spread the tilts over the three angles
+        angles = [np.linspace(0, end, n_tilts, endpoint=False) for end in (90, 60, 45)]
+        EulerAngle.Tilts = [EulerAngle(phi, theta, psi) for phi, theta, psi in zip(*angles)]
+    return previous
+
+
+def fill_with_disk(dm, radius, center):
+    x, y = np.ogrid[:dm.shape[0], :dm.shape[1]]
+    dm[(x - center[0]) ** 2 + (y - center[1]) ** 2 <= radius ** 2] = 1
+    return dm
+
+
+def template_shape_2d(template_id):
+    # Alternate keyholes and L shapes of decreasing size so that every template differs. Neither maps onto itself
+    # under a rotation, so every tilt of a template is a different image, see template_symmetry_2d. They are centered
+    # on their center of mass, where the candidate selector puts them.
+    dm = np.zeros(TEMPLATE_DIMENSIONS_2D)
+    size = TEMPLATE_DIMENSION / (4 + template_id // 2)
+    center = TEMPLATE_DIMENSION / 2
+    if template_id % 2 == 0:
+        fill_with_disk(dm[:, :, 0], size, (center, center))
+        fill_with_disk(dm[:, :, 0], size / 2, (center + 1.25 * size, center))
+    else:
+        TemplateGenerator.fill_with_square(dm[:, :, 0], 2 * size)
+        dm[int(center):, int(center):, 0] = 0
+    center_of_mass = [np.sum(np.indices(dm.shape[:2])[axis] * dm[:, :, 0]) / np.sum(dm) for axis in (0, 1)]
+    return np.roll(dm, [int(round(TEMPLATE_DIMENSION // 2 - value)) for value in center_of_mass], axis=(0, 1))
+
+
+def template_symmetry_2d(template_id):
+    """
+    :return: The order of the rotational symmetry of the 2D template, the tilts 360 / order degrees apart are the same
+    image. The keyholes and the L shapes only have a mirror symmetry.
+    """
+    return 1
+
+
+def template_shape_3d(template_id):
+    dm = np.zeros(TEMPLATE_DIMENSIONS_3D)
+    size = int(TEMPLATE_DIMENSION / (4 + template_id // 2))
+    if template_id % 2 == 0:
+        # fill_with_sphere fills from the corner, center it through a view
+        offset = TEMPLATE_DIMENSION // 2 - size
+        TemplateGenerator.fill_with_sphere(dm[offset:, offset:, offset:], size)
+    else:
+        TemplateGenerator.fill_with_cube(dm, 2 * size)
+    return dm
+
+
+def synthetic_bank(n_templates, dim):
+    """
+    Generate a template bank tilted by EulerAngle.Tilts, see set_tilts.
+    :param n_templates: Number of templates.
+    :param dim: 2 or 3.
+    :return: tuple of tuples of TiltedTemplates.
+    """
+    bank = []
+    for template_id in range(n_templates):
+        if dim == 2:
+            dm = template_shape_2d(template_id)
+            tilted = [TemplateGenerator.rotate2d(dm, tilt.Phi) for tilt in EulerAngle.Tilts]
+        else:
+            dm = template_shape_3d(template_id)
+            tilted = [TemplateGenerator.rotate3d(dm, tilt) for tilt in EulerAngle.Tilts]
+        bank.append(tuple([TiltedTemplate(density_map, tilt_id, template_id)
+                           for tilt_id, density_map in enumerate(tilted)]))
+    return tuple(bank)
+
+
+def particle_criteria(n_templates, template_side, dim, tomogram_side):
+    """
+    :return: The criteria of generate_random_tomogram, as many particles as the tomogram holds comfortably spread
+    over the templates.
+    """
+    # The same margins and separation as TomogramGenerator.generate_random_candidates
+    valid_side = tomogram_side - 4 * ((template_side - 1) // 2)
+    separation = template_side * (dim ** 0.5)
+    particles = max(1, int(PARTICLE_DENSITY * (valid_side // separation) ** dim))
+    return [particles // n_templates + (1 if template_id < particles % n_templates else 0)
+            for template_id in range(n_templates)]
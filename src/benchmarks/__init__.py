@@ -0,0 +1 @@
+# Benchmarks of the pipeline on synthetic data, run through "Main.py bench"